@@ -0,0 +1,107 @@
+"""Moves old, settled loans out of BorrowingTransactions into its archive table.
+
+Usage: python archive.py [--days 365] [--batch 5000] [--pause 0.05]
+
+A loan can be archived once it has been returned, its fine (if any) is paid and
+its return is more than --days old. A loan returned on time is never marked paid,
+having nothing to pay, so a FineAmount of 0 counts as settled too. Each batch is
+its own short write transaction, so the desk keeps working while a large backlog
+drains. Loan history stays whole
+through the LoanHistory view over both tables (migration 6).
+"""
+import argparse
+import json
+import time
+
+import database
+from database import unit_of_work
+
+ARCHIVE_DAYS = 365
+BATCH_SIZE = 5000
+
+# The newest loan is never archived: with it gone, SQLite could hand its TransactionID
+# to the next loan and the archive would then hold a different loan under the same id.
+# Matches the partial index idx_transactions_archivable (migration 6) term for term
+SETTLED = "ReturnDate IS NOT NULL AND (PaidStatus = 'Paid' OR COALESCE(FineAmount, 0) = 0)"
+ARCHIVABLE = f"""
+    SELECT TransactionID FROM BorrowingTransactions
+    WHERE {SETTLED} AND ReturnDate < DATE('now', ?)
+    AND TransactionID < (SELECT MAX(TransactionID) FROM BorrowingTransactions)
+    ORDER BY ReturnDate
+    LIMIT ?
+"""
+COPY_TO_ARCHIVE = """
+    INSERT INTO BorrowingTransactionsArchive
+        (TransactionID, BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus, BranchID)
+    SELECT TransactionID, BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus, BranchID
+    FROM BorrowingTransactions
+    WHERE TransactionID IN (SELECT value FROM json_each(?))
+"""
+DELETE_ARCHIVED = "DELETE FROM BorrowingTransactions WHERE TransactionID IN (SELECT value FROM json_each(?))"
+TABLE_SIZES = f"""
+    SELECT (SELECT COUNT(*) FROM BorrowingTransactions),
+           (SELECT COUNT(*) FROM BorrowingTransactions WHERE NOT ({SETTLED})),
+           (SELECT COUNT(*) FROM BorrowingTransactionsArchive)
+"""
+
+# Statements archiving runs, with sample parameters, for project.py check-plans
+QUERY_PLAN_CHECKS = [
+    ("archive: archivable loans", ARCHIVABLE, ("-365 days", BATCH_SIZE)),
+    ("archive: copy to archive", COPY_TO_ARCHIVE, ("[1, 2]",)),
+    ("archive: delete archived", DELETE_ARCHIVED, ("[1, 2]",)),
+    ("archive: table sizes", TABLE_SIZES, ()),
+]
+FULL_SCAN_ALLOWED = {"archive: table sizes"}   # counts whole tables for the summary line
+
+
+def archive_batch(cursor, days, batch_size):
+    """Moves up to batch_size archivable loans in the caller's transaction; returns how many"""
+    ids = [row[0] for row in cursor.execute(ARCHIVABLE, (f"-{int(days)} days", batch_size))]
+    if ids:
+        id_list = json.dumps(ids)
+        cursor.execute(COPY_TO_ARCHIVE, (id_list,))
+        cursor.execute(DELETE_ARCHIVED, (id_list,))
+    return len(ids)
+
+
+def archive_loans(days=ARCHIVE_DAYS, batch_size=BATCH_SIZE, pause=0.0, max_batches=None):
+    """Archives loans settled more than days ago, batch by batch, until none are left
+
+    pause seconds are slept between batches to leave room for other writers.
+    Returns the number of loans moved.
+    """
+    moved = batches = 0
+    start = time.perf_counter()
+    while max_batches is None or batches < max_batches:
+        count = database.run_transaction(lambda cursor: archive_batch(cursor, days, batch_size))
+        if not count:
+            break
+        moved += count
+        batches += 1
+        print(f"{moved:>10} loans archived | {moved / (time.perf_counter() - start):>8.0f} rows/s")
+        if pause:
+            time.sleep(pause)
+    return moved
+
+
+def table_sizes():
+    """(hot rows, hot rows still outstanding, archived rows)"""
+    with unit_of_work() as cursor:
+        return cursor.execute(TABLE_SIZES).fetchone()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive returned, paid loans")
+    parser.add_argument("--days", type=int, default=ARCHIVE_DAYS, help="archive loans returned more than this long ago")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="loans moved per transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to wait between batches")
+    args = parser.parse_args()
+    try:
+        moved = archive_loans(args.days, args.batch, args.pause)
+        hot, outstanding, archived = table_sizes()
+        print(f"\nArchived {moved} loans. BorrowingTransactions holds {hot} rows "
+              f"({outstanding} open or unpaid); the archive holds {archived}.")
+    except KeyboardInterrupt:
+        print("\nInterrupted; every finished batch is already committed.")
+    finally:
+        database.close()
@@ -0,0 +1,1766 @@
+"""Benchmarks for the library system, run against generated throwaway databases.
+
+Usage: python benchmark.py fines [--sizes 1000 10000 100000]
+       python benchmark.py search [--items 1000000]
+       python benchmark.py pages [--items 1000000]
+       python benchmark.py sessions [--sessions 1 2 4 8]
+       python benchmark.py stress [--processes 8] [--seconds 5] [--legacy]
+       python benchmark.py events [--events 10000] [--registrations 1000000]
+       python benchmark.py http [--clients 32] [--seconds 10]
+       python benchmark.py suite [--loans 10000 1000000] [--output results.json] [--baseline old.json]
+       python benchmark.py cache [--sessions 500] [--loans 100000]
+       python benchmark.py archive [--loans 1000000] [--days 365]
+       python benchmark.py reports [--loans 1000000] [--chunk 500000]
+       python benchmark.py holds [--queues 100 1000 10000] [--cycles 200]
+       python benchmark.py registrations [--attempts 10000] [--capacity 100] [--processes 16] [--legacy]
+       python benchmark.py catalog [--items 1000000]
+       python benchmark.py queries [--loans 100000] [--calls 5000]
+       python benchmark.py session [--visits 500] [--loans 100000]
+       python benchmark.py recommend [--loans 1000000] [--lookups 1000]
+       python benchmark.py fuzzy [--items 1000000] [--queries 200]
+       python benchmark.py commits [--sessions 1 8 32] [--seconds 3]
+       python benchmark.py journal [--records 1000000] [--copies 100000]
+       python benchmark.py notices [--loans 3000000] [--batch 5000]
+       python benchmark.py branches [--items 10000 100000 1000000] [--branches 50] [--holds 500]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import platform
+import resource
+import socket
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import archive
+import catalog
+import database
+import querylog
+import recommend
+import reports
+import server
+import services
+import datagen
+import journal
+import notices
+from datagen import ITEM_TYPES, WORDS, create_database, vocabulary
+from database import unit_of_work
+
+
+def use_database(path, pool_size=database.POOL_SIZE, trace=None, query_log=None,
+                 durability=database.DEFAULT_DURABILITY, group_commit=False):
+    """Points the services at another database file, returning its pool"""
+    return database.configure(path, pool_size, trace, query_log, durability, group_commit)
+
+
+def seed_loans(db, loans, seed=0):
+    """Fills db with one item, borrower and copy per ten loans, a third of loans still open"""
+    rng = random.Random(seed)
+    borrowers = max(1, loans // 10)
+    db.executemany("INSERT INTO Borrowers (BorrowerID, Name, Email) VALUES (?, ?, ?)",
+                   ((i, f"Borrower {i}", f"b{i}@example.com") for i in range(1, borrowers + 1)))
+    db.executemany("INSERT INTO LibraryItem (ItemID, Title, ItemType, AuthorCreator) VALUES (?, ?, 'Book', ?)",
+                   ((i, f"Title {i}", f"Author {i % 97}") for i in range(1, borrowers + 1)))
+    db.executemany("INSERT INTO LibraryCopy (CopyID, Status, ItemID) VALUES (?, 'onShelf', ?)",
+                   ((i, i) for i in range(1, borrowers + 1)))
+
+    def rows():
+        for _ in range(loans):
+            borrowed = rng.randint(0, 120)
+            returned = borrowed - rng.randint(1, 20) if rng.random() > 0.33 else None
+            yield (rng.randint(1, borrowers), rng.randint(1, borrowers),
+                   f"-{borrowed} days", f"-{borrowed - 14} days",
+                   None if returned is None else f"-{max(returned, 0)} days",
+                   rng.choice(("Paid", "Unpaid")))
+
+    db.executemany(
+        "INSERT INTO BorrowingTransactions (BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus) "
+        "VALUES (?, ?, DATE('now', ?), DATE('now', ?), DATE('now', ?), 0, ?)",
+        rows()
+    )
+    db.commit()
+    return borrowers
+
+
+def seed_catalog(db, items, seed=0):
+    """Fills db with items whose titles are random runs of words from vocabulary()"""
+    rng = random.Random(seed)
+    words, weights = vocabulary(rng)
+
+    def rows():
+        for i in range(1, items + 1):
+            title = " ".join(rng.choices(words, weights, k=rng.randint(2, 5))).title()
+            yield (i, f"{title} {i}", rng.choice(ITEM_TYPES), f"Author {rng.randint(1, items // 20 + 1)}")
+
+    db.executemany("INSERT INTO LibraryItem (ItemID, Title, ItemType, AuthorCreator) VALUES (?, ?, ?, ?)", rows())
+    db.commit()
+
+
+def time_calls(func, args_list):
+    """Returns the mean latency of func over args_list in milliseconds"""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) * 1000 / len(args_list)
+
+
+def bench_fines(sizes, requests=50):
+    """Compares the old sweep-then-sum fine check with the lazy per-borrower read"""
+    def sweep(borrower_id):
+        services.calculate_fines()
+        with unit_of_work() as cursor:
+            cursor.execute("SELECT SUM(FineAmount) FROM BorrowingTransactions WHERE BorrowerID=? AND PaidStatus='Unpaid'",
+                           (borrower_id,))
+            return cursor.fetchone()[0] or 0
+
+    def lazy(borrower_id):
+        with unit_of_work() as cursor:
+            return services.outstanding_fines(cursor, borrower_id)
+
+    print(f"{'Loans':>10} | {'Sweep (ms)':>12} | {'Lazy (ms)':>12} | Max difference")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = os.path.join(tmp, f"fines_{size}.db")
+            db = create_database(path)
+            borrowers = seed_loans(db, size)
+            db.close()
+            use_database(path)
+
+            sample = [(random.randint(1, borrowers),) for _ in range(requests)]
+            sweep_ms = time_calls(sweep, sample)
+            lazy_ms = time_calls(lazy, sample)
+            difference = max(abs(sweep(b) - lazy(b)) for (b,) in sample)
+            print(f"{size:>10} | {sweep_ms:>12.3f} | {lazy_ms:>12.3f} | {difference:.4f}")
+
+
+def bench_search(items, queries=20):
+    """Compares LIKE '%term%' title search with the full-text index"""
+    searches = ["history", "golden river", "mach", "lost city", "cook", "silent night", "kalo", "quonex",
+                "Author 12", "DVD"]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "search.db")
+        db = create_database(path)
+        start = time.perf_counter()
+        seed_catalog(db, items)
+        print(f"Loaded {items} items with the search index in {time.perf_counter() - start:.1f}s\n")
+        db.close()
+        use_database(path)
+
+        def like(term):
+            with unit_of_work() as cursor:
+                cursor.execute("SELECT * FROM LibraryItem WHERE Title LIKE ?", (f"%{term}%",))
+                return len(cursor.fetchall())
+
+        def fts(term):
+            with unit_of_work() as cursor:
+                cursor.execute(services.keyset_query(services.SEARCH_ITEMS, services.SEARCH_ORDER),
+                               (services.search_query(term), -1, 0))
+                return len(cursor.fetchall())
+
+        def first_page(term):
+            return len(services.KeysetPager(services.SEARCH_ITEMS, services.SEARCH_ORDER, (services.search_query(term),)).rows)
+
+        print(f"{'Query':<14} | {'LIKE (ms)':>10} | {'Rows':>8} | {'FTS (ms)':>10} | {'Rows':>8} | {'FTS page (ms)':>13}")
+        for term in searches:
+            like_ms = time_calls(like, [(term,)] * queries)
+            fts_ms = time_calls(fts, [(term,)] * queries)
+            page_ms = time_calls(first_page, [(term,)] * queries)
+            print(f"{term:<14} | {like_ms:>10.2f} | {like(term):>8} | {fts_ms:>10.2f} | {fts(term):>8} | {page_ms:>13.2f}")
+
+
+def measure(func):
+    """Returns (milliseconds, peak KiB allocated) for one call of func"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_pages(items):
+    """Compares fetchall-then-slice listing with keyset pages on a large catalog"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pages.db")
+        db = create_database(path)
+        seed_catalog(db, items)
+        db.close()
+        use_database(path)
+
+        middle = items // services.ITEMS_PER_PAGE // 2
+        pager = services.KeysetPager(services.ALL_ITEMS, services.ITEM_ORDER)
+
+        def fetch_all():
+            with unit_of_work() as cursor:
+                cursor.execute("SELECT * FROM LibraryItem")
+                rows = cursor.fetchall()
+            return rows[middle * services.ITEMS_PER_PAGE:(middle + 1) * services.ITEMS_PER_PAGE]
+
+        cases = [
+            ("fetchall, then slice", fetch_all),
+            ("keyset first page", lambda: services.KeysetPager(services.ALL_ITEMS, services.ITEM_ORDER)),
+            ("keyset next page", pager.next_page),
+            ("keyset jump to middle", lambda: pager.jump_to(middle)),
+            ("keyset previous page", pager.previous_page),
+        ]
+        print(f"{items} items, page {middle + 1} is the middle\n")
+        print(f"{'Operation':<24} | {'Time (ms)':>10} | {'Peak memory (KiB)':>18}")
+        for name, func in cases:
+            elapsed, peak = measure(func)
+            print(f"{name:<24} | {elapsed:>10.2f} | {peak:>18.1f}")
+
+
+def seed_shelf(db, items, copies_per_item=1, borrowers=1000):
+    """Fills db with a generated catalog, copies of every item on the shelf and some borrowers"""
+    seed_catalog(db, items)
+    db.executemany("INSERT INTO LibraryCopy (Status, ItemID) VALUES ('onShelf', ?)",
+                   ((item,) for item in range(1, items + 1) for _ in range(copies_per_item)))
+    db.executemany("INSERT INTO Borrowers (BorrowerID, Name, Email) VALUES (?, ?, ?)",
+                   ((i, f"Borrower {i}", f"b{i}@example.com") for i in range(1, borrowers + 1)))
+    db.commit()
+
+
+def run_sessions(sessions, session):
+    """Runs session(number) on that many threads at once, returning (seconds, operations)"""
+    counts = [0] * sessions
+
+    def worker(number):
+        counts[number] = session(number)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sum(counts)
+
+
+def bench_sessions(session_counts, cycles=200, items=10000):
+    """Borrow/return throughput with several desk sessions sharing the connection pool"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.db")
+        db = create_database(path)
+        seed_shelf(db, items)
+        db.close()
+
+        print(f"{'Sessions':>8} | {'Operations':>10} | {'Seconds':>8} | {'Ops/second':>10}")
+        for sessions in session_counts:
+            use_database(path, pool_size=sessions)
+
+            def session(number):
+                rng = random.Random(number)
+                # Each session works its own slice of the catalog so loans never collide
+                first = number * (items // sessions) + 1
+                operations = 0
+                for _ in range(cycles):
+                    item_id = rng.randint(first, first + items // sessions - 1)
+                    # A patron browses a search page before borrowing
+                    services.search(rng.choice(WORDS))
+                    services.available_copies(item_id)
+                    try:
+                        loan = services.borrow(number + 1, item_id)
+                    except services.Unavailable:
+                        continue
+                    services.return_loan(loan.transaction_id)
+                    operations += 2
+                return operations
+
+            seconds, operations = run_sessions(sessions, session)
+            print(f"{sessions:>8} | {operations:>10} | {seconds:>8.2f} | {operations / seconds:>10.0f}")
+        database.close()
+
+
+LEGACY_AVAILABLE_COPY = "SELECT CopyID FROM LibraryCopy WHERE ItemID=? AND Status='onShelf' LIMIT 1"
+
+
+def legacy_checkout(borrower_id, item_id):
+    """The old borrow path: pick a copy, then record the loan in a separate step"""
+    with unit_of_work() as cursor:
+        cursor.execute(LEGACY_AVAILABLE_COPY, (item_id,))
+        copy = cursor.fetchone()
+    if not copy:
+        return None
+    time.sleep(0.001)  # the gap the patron's terminal leaves between the two steps
+    with unit_of_work() as cursor:
+        cursor.execute(services.INSERT_LOAN, (borrower_id, copy[0]))
+        cursor.execute("UPDATE LibraryCopy SET Status='Borrow' WHERE CopyID=?", (copy[0],))
+        return cursor.lastrowid, copy[0]
+
+
+def stress_worker(path, worker, seconds, legacy):
+    """One process borrowing and returning item 1 until the deadline; returns (borrows, returns)"""
+    use_database(path, pool_size=1)
+    rng = random.Random(worker)
+    borrows = returns = 0
+    held = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if held and (rng.random() < 0.5 or len(held) > 2):
+            transaction_id = held.pop(rng.randrange(len(held)))
+            if database.run_transaction(lambda cursor: services.checkin_loan(cursor, transaction_id)):
+                returns += 1
+            continue
+        borrower_id = rng.randint(1, 1000)
+        if legacy:
+            loan = legacy_checkout(borrower_id, 1)
+        else:
+            loan = database.run_transaction(lambda cursor: services.checkout_item(cursor, borrower_id, 1))
+        if loan:
+            held.append(loan[0])
+            borrows += 1
+    database.close()
+    return borrows, returns
+
+
+DOUBLE_LOANS = """
+    SELECT CopyID, COUNT(*) FROM BorrowingTransactions
+    WHERE ReturnDate IS NULL GROUP BY CopyID HAVING COUNT(*) > 1
+"""
+STATUS_MISMATCHES = """
+    SELECT COUNT(*) FROM LibraryCopy lc
+    WHERE (lc.Status = 'Borrow') != EXISTS (
+        SELECT 1 FROM BorrowingTransactions bt WHERE bt.CopyID = lc.CopyID AND bt.ReturnDate IS NULL)
+"""
+
+
+def bench_stress(processes, seconds, copies=3, legacy=False):
+    """Hammers one item with a few copies from many processes and checks no copy is loaned twice"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stress.db")
+        db = create_database(path)
+        seed_shelf(db, items=1, copies_per_item=copies)
+        db.close()
+        # Migrate once here; the workers then open an up-to-date file
+        use_database(path, pool_size=1)
+        database.close()
+
+        monitor = sql.connect(path, timeout=30)
+        worst = 0
+        with multiprocessing.Pool(processes) as workers:
+            result = workers.starmap_async(stress_worker, [(path, n, seconds, legacy) for n in range(processes)])
+            while not result.ready():
+                # Sample while the workers run: a second open loan on a copy is a double loan
+                worst = max([worst] + [count for _, count in monitor.execute(DOUBLE_LOANS)])
+                time.sleep(0.005)
+            totals = result.get()
+
+        double_loans = monitor.execute(DOUBLE_LOANS).fetchall()
+        mismatches = monitor.execute(STATUS_MISMATCHES).fetchone()[0]
+        monitor.close()
+
+    borrows = sum(b for b, _ in totals)
+    returns = sum(r for _, r in totals)
+    print(f"{processes} processes, {copies} copies, {seconds}s, {'legacy' if legacy else 'atomic'} borrow path")
+    print(f"Borrows: {borrows}   Returns: {returns}   ({(borrows + returns) / seconds:.0f} ops/second)")
+    print(f"Most open loans seen on one copy: {max(worst, 1) if borrows else 0}")
+    print(f"Copies on loan twice at the end: {len(double_loans)}")
+    print(f"Copies whose status disagrees with their loans: {mismatches}")
+    ok = worst <= 1 and not double_loans and not mismatches
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+LEGACY_EVENT_LIST = """
+    SELECT e.DateTime, e.EventID, EventID, EventName, EventType,
+           strftime('%Y-%m-%d %H:%M', DateTime) as FormattedDate,
+           Location, Capacity -
+           (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID) as RemainingSpots
+    FROM Events e
+    WHERE DateTime >= datetime('now')
+    ORDER BY e.DateTime, e.EventID LIMIT ? OFFSET ?
+"""
+
+
+def seed_events(db, events, registrations, seed=0):
+    """Fills db with upcoming events and registrations spread over them"""
+    rng = random.Random(seed)
+    borrowers = max(1, registrations // events * 2)
+    db.executemany("INSERT OR IGNORE INTO Borrowers (BorrowerID, Name, Email) VALUES (?, ?, ?)",
+                   ((i, f"Borrower {i}", f"b{i}@example.com") for i in range(1, borrowers + 1)))
+    db.executemany(
+        "INSERT INTO Events (EventID, EventName, EventType, DateTime, Location, Capacity) "
+        "VALUES (?, ?, ?, datetime('now', ?), 'Main Hall', ?)",
+        ((i, f"Event {i}", rng.choice(("Book Club", "Workshop", "Lecture")), f"+{rng.randint(1, 365)} days",
+          borrowers) for i in range(1, events + 1)))
+    per_event = registrations // events
+    db.executemany("INSERT INTO EventRegistration (EventID, BorrowerID) VALUES (?, ?)",
+                   ((event, borrower) for event in range(1, events + 1)
+                    for borrower in rng.sample(range(1, borrowers + 1), per_event)))
+    db.commit()
+
+
+def bench_events(events, registrations, repeats=20):
+    """Compares event listings that count registrations per row with the stored counters"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "events.db")
+        db = create_database(path)
+        seed_events(db, events, registrations)
+        db.close()
+        use_database(path)
+        stored = services.keyset_query(services.UPCOMING_EVENTS, services.EVENT_ORDER)
+
+        def listing(query, limit):
+            with unit_of_work() as cursor:
+                cursor.execute(query, (limit, 0))
+                return cursor.fetchall()
+
+        if listing(LEGACY_EVENT_LIST, events) != listing(stored, events):
+            print("FAIL: counted and stored remaining spots differ")
+        print(f"{events} events, {registrations} registrations\n")
+        print(f"{'Listing':<14} | {'Counted (ms)':>12} | {'Stored (ms)':>12}")
+        for name, limit in (("first page", services.ITEMS_PER_PAGE), ("all events", events)):
+            before = time_calls(listing, [(LEGACY_EVENT_LIST, limit)] * repeats)
+            after = time_calls(listing, [(stored, limit)] * repeats)
+            print(f"{name:<14} | {before:>12.2f} | {after:>12.2f}")
+        database.close()
+
+
+def percentile(values, fraction):
+    """The value at fraction (0-1) of the way through values, which must be sorted"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def http_request(reader, writer, method, target, payload=None):
+    """Sends one keep-alive request and returns (status, decoded JSON body)"""
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                 + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) != b"\r\n":
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def http_client(port, number, deadline, items, borrowers, events, latencies):
+    """One kiosk: loops over a browse-heavy mix of requests until deadline, timing each"""
+    rng = random.Random(number)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    async def timed(name, method, target, payload=None):
+        start = time.perf_counter()
+        result = await http_request(reader, writer, method, target, payload)
+        latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        return result
+
+    while time.perf_counter() < deadline:
+        roll = rng.random()
+        if roll < 0.5:
+            await timed("search", "GET", f"/search?q={rng.choice(WORDS)}&page={rng.randint(0, 2)}")
+        elif roll < 0.7:
+            await timed("item details", "GET", f"/items/{rng.randint(1, items)}")
+        elif roll < 0.8:
+            await timed("events", "GET", f"/events?page={rng.randint(0, 4)}")
+        elif roll < 0.85:
+            await timed("fines", "GET", f"/borrowers/{rng.randint(1, borrowers)}/fines")
+        elif roll < 0.9:
+            await timed("register event", "POST", f"/events/{rng.randint(1, events)}/registrations",
+                        {"borrower_id": rng.randint(1, borrowers)})
+        else:
+            status, loan = await timed("borrow", "POST", "/loans",
+                                       {"borrower_id": rng.randint(1, borrowers), "item_id": rng.randint(1, items)})
+            if status == 201:
+                await timed("return", "POST", f"/loans/{loan['transaction_id']}/return")
+    writer.close()
+
+
+def bench_http(clients, seconds, items=10000, borrowers=1000, events=500):
+    """Runs server.py on a seeded database and reports latency and throughput from local kiosks"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "http.db")
+        db = create_database(path)
+        seed_shelf(db, items, copies_per_item=2, borrowers=borrowers)
+        seed_events(db, events, events * 10)
+        db.close()
+
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=server.run, args=("127.0.0.1", port, path, database.POOL_SIZE, ready))
+        process.start()
+        try:
+            if not ready.wait(30):
+                print("FAIL: server did not start")
+                return
+            latencies = {}
+
+            async def drive():
+                deadline = time.perf_counter() + seconds
+                await asyncio.gather(*(http_client(port, number, deadline, items, borrowers, events, latencies)
+                                       for number in range(clients)))
+
+            start = time.perf_counter()
+            asyncio.run(drive())
+            elapsed = time.perf_counter() - start
+        finally:
+            process.terminate()
+            process.join()
+
+        total = sum(len(values) for values in latencies.values())
+        print(f"{clients} clients for {elapsed:.1f}s: {total} requests, {total / elapsed:.0f} requests/s\n")
+        print(f"{'Endpoint':<16} | {'Requests':>8} | {'p50 (ms)':>9} | {'p99 (ms)':>9}")
+        everything = []
+        for name, values in sorted(latencies.items()):
+            values.sort()
+            everything.extend(values)
+            print(f"{name:<16} | {len(values):>8} | {percentile(values, 0.5):>9.2f} | {percentile(values, 0.99):>9.2f}")
+        everything.sort()
+        print(f"{'all':<16} | {total:>8} | {percentile(everything, 0.5):>9.2f} | {percentile(everything, 0.99):>9.2f}")
+
+
+REGRESSION = 1.25  # suite flags an operation whose p50 grew past this factor of the baseline
+NOISE_MS = 0.1     # and by more than this, so sub-millisecond jitter is not reported
+
+
+def latency_stats(samples):
+    """Summary of a list of latencies in milliseconds"""
+    samples = sorted(samples)
+    return {"runs": len(samples), "mean_ms": round(sum(samples) / len(samples), 4),
+            "p50_ms": round(percentile(samples, 0.5), 4), "p95_ms": round(percentile(samples, 0.95), 4),
+            "max_ms": round(samples[-1], 4)}
+
+
+def suite_operations(rng, counts):
+    """(name, setup, timed call, cleanup) for each menu operation, drawing arguments from rng
+
+    setup returns the arguments for the timed call and cleanup(args, result) undoes what
+    it changed, so every run sees the same database.
+    """
+    items, borrowers = counts["LibraryItem"], counts["Borrowers"]
+    middle = items // services.ITEMS_PER_PAGE // 2
+    with unit_of_work() as cursor:
+        idle = [row[0] for row in cursor.execute(
+            "SELECT BorrowerID FROM Borrowers b WHERE NOT EXISTS (SELECT 1 FROM BorrowingTransactions bt "
+            "WHERE bt.BorrowerID = b.BorrowerID AND bt.PaidStatus = 'Unpaid') LIMIT 1000")]
+        shelved = [row[0] for row in cursor.execute("SELECT ItemID FROM LibraryItem WHERE AvailableCopies > 0 LIMIT 1000")]
+        event_types = [row[0] for row in cursor.execute(services.EVENT_TYPES)]
+        upcoming = [row[0] for row in cursor.execute("SELECT EventID FROM Events WHERE DateTime >= datetime('now') "
+                                                     "AND RegisteredCount < Capacity LIMIT 1000")]
+
+    def none():
+        return ()
+
+    def borrower():
+        return (rng.randint(1, borrowers),)
+
+    def make_loan():
+        return (services.borrow(rng.choice(idle), rng.choice(shelved)).transaction_id,)
+
+    def delete_loan(transaction_id):
+        with unit_of_work() as cursor:
+            cursor.execute("DELETE FROM BorrowingTransactions WHERE TransactionID=? RETURNING CopyID", (transaction_id,))
+            cursor.execute("UPDATE LibraryCopy SET Status='onShelf' WHERE CopyID=?", cursor.fetchone())
+
+    def undo_borrow(args, loan):
+        services.return_loan(loan.transaction_id)
+        delete_loan(loan.transaction_id)
+
+    def undo_return(args, result):
+        delete_loan(args[0])
+
+    def undo_registration(args, result):
+        with unit_of_work() as cursor:
+            cursor.execute("DELETE FROM EventRegistration WHERE EventID=? AND BorrowerID=?", args)
+
+    def unregistered():
+        return rng.choice(upcoming), rng.randint(1, borrowers)
+
+    pager = services.list_items()
+    return [
+        ("list_all_items: first page", none, services.list_items, None),
+        ("list_all_items: next page", none, lambda: pager.next_page() or pager.jump_to(0), None),
+        ("list_all_items: jump to middle", none, lambda: services.list_items(middle), None),
+        ("search_by_title: common word", lambda: (rng.choice(WORDS[:5]),), services.search, None),
+        ("search_by_title: any word", lambda: (rng.choice(WORDS),), services.search, None),
+        ("search_by_title: page 3", lambda: (rng.choice(WORDS[:5]), 2), services.search, None),
+        ("view_book_details", lambda: (rng.randint(1, items),), services.available_copies, None),
+        ("borrow_item", lambda: (rng.choice(idle), rng.choice(shelved)), services.borrow, undo_borrow),
+        ("return_item: open loans", borrower, services.open_loans, None),
+        ("return_item: return", make_loan, services.return_loan, undo_return),
+        ("view_borrowed_books", borrower, services.borrowed_books, None),
+        ("pay_fines: amount due", borrower, services.fines_due, None),
+        ("calculate_fines: one borrower", borrower, services.calculate_fines, None),
+        ("calculate_fines: all", none, services.calculate_fines, None),
+        ("find_event: upcoming", none, services.upcoming_events, None),
+        ("find_event: by type", lambda: (None, rng.choice(event_types)), services.upcoming_events, None),
+        ("find_event: by name", lambda: (str(rng.randint(1, 9)),), services.upcoming_events, None),
+        ("find_event: event types", none, services.event_types, None),
+        ("register_event", unregistered, services.register_for_event, undo_registration),
+    ]
+
+
+def run_operation(setup, call, cleanup, repeat):
+    """Times call(*setup()) repeat times, running cleanup after each; returns latencies in ms"""
+    samples = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        try:
+            result = call(*args)
+        except services.ServiceError:
+            continue
+        samples.append((time.perf_counter() - start) * 1000)
+        if cleanup:
+            cleanup(args, result)
+    return samples
+
+
+def bench_suite(sizes, seed=0, repeat=20, output=None, baseline=None, keep=None):
+    """Times every menu operation on generated databases of each size and writes JSON results"""
+    results = {
+        "meta": {
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                     text=True).stdout.strip() or None,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sql.sqlite_version,
+            "machine": platform.machine(),
+            "seed": seed,
+            "repeat": repeat,
+        },
+        "sizes": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for loans in sizes:
+            path = os.path.join(keep or tmp, f"suite_{loans}_{seed}.db")
+            start = time.perf_counter()
+            if keep and os.path.exists(path):
+                counts = None
+            else:
+                counts = datagen.generate(path, loans, seed)
+            built = time.perf_counter() - start
+            use_database(path)
+            if counts is None:
+                with unit_of_work() as cursor:
+                    counts = {table: cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                              for table in ("LibraryItem", "LibraryCopy", "Borrowers", "BorrowingTransactions",
+                                            "Events", "EventRegistration", "Personnel")}
+            print(f"\n{loans} loans ({counts['LibraryItem']} items, {counts['Borrowers']} borrowers, "
+                  f"{counts['Events']} events), built in {built:.1f}s")
+            print(f"{'Operation':<34} | {'p50 (ms)':>9} | {'p95 (ms)':>9} | {'max (ms)':>9}")
+            rng = random.Random(seed)
+            operations = {}
+            for name, setup, call, cleanup in suite_operations(rng, counts):
+                samples = run_operation(setup, call, cleanup, repeat)
+                if not samples:
+                    continue
+                operations[name] = latency_stats(samples)
+                stats = operations[name]
+                print(f"{name:<34} | {stats['p50_ms']:>9.3f} | {stats['p95_ms']:>9.3f} | {stats['max_ms']:>9.3f}")
+            database.close()
+            results["sizes"].append({"loans": loans, "rows": counts, "operations": operations})
+
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults written to {output}")
+    if baseline:
+        return compare_results(baseline, results)
+    return True
+
+
+def compare_results(baseline_path, results):
+    """Prints each operation's p50 against a previous results file; False if any grew past REGRESSION"""
+    with open(baseline_path) as file:
+        baseline = {size["loans"]: size["operations"] for size in json.load(file)["sizes"]}
+    regressions = 0
+    print(f"\nAgainst {baseline_path}:")
+    print(f"{'Loans':>9} | {'Operation':<34} | {'Before':>9} | {'After':>9} | Change")
+    for size in results["sizes"]:
+        before = baseline.get(size["loans"], {})
+        for name, stats in size["operations"].items():
+            if name not in before:
+                continue
+            ratio = stats["p50_ms"] / max(before[name]["p50_ms"], 1e-6)
+            grew = stats["p50_ms"] - before[name]["p50_ms"]
+            flag = "  SLOWER" if ratio > REGRESSION and grew > NOISE_MS else ""
+            regressions += bool(flag)
+            print(f"{size['loans']:>9} | {name:<34} | {before[name]['p50_ms']:>9.3f} | {stats['p50_ms']:>9.3f} "
+                  f"| {ratio:.2f}x{flag}")
+    print(f"\n{regressions} operations slower than {REGRESSION}x their baseline.")
+    return not regressions
+
+
+def browse_session(rng, titles, counts):
+    """One patron at a kiosk: a search, a few item and event pages, now and then a loan or a sign-up"""
+    pager = services.search(rng.choice(WORDS[:10]))
+    pager.next_page()
+    for _ in range(4):
+        item_id = titles.draw()
+        services.get_item(item_id)
+        services.available_copies(item_id)
+    event_pager = services.upcoming_events()
+    types = services.event_types()
+    services.upcoming_events(event_type=rng.choice(types))
+    for event_id, *_ in event_pager.rows[:2]:
+        services.get_event(event_id)
+    try:
+        if rng.random() < 0.1:
+            loan = services.borrow(rng.randint(1, counts["Borrowers"]), titles.draw())
+            services.return_loan(loan.transaction_id)
+        if rng.random() < 0.05 and event_pager.rows:
+            services.register_for_event(event_pager.rows[0][0], rng.randint(1, counts["Borrowers"]))
+    except services.ServiceError:
+        pass
+
+
+def bench_cache(sessions, loans, seed=0):
+    """Counts SQLite statements and time for the same browse sessions with the read cache off and on"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+        counts = datagen.generate(path, loans, seed)
+        statements = []
+
+        def trace(statement):
+            # Trigger bodies show up as "-- TRIGGER" lines; they run inside the statement that fired them
+            if not statement.startswith("--"):
+                statements.append(statement)
+
+        print(f"{sessions} browse sessions on {loans} loans ({counts['LibraryItem']} items)\n")
+        print(f"{'Read cache':<10} | {'Statements':>10} | {'Per session':>11} | {'Seconds':>8} | {'Hit rate':>8}")
+        for enabled in (False, True):
+            # Each run starts from a copy so the loans and sign-ups of the first don't skew the second
+            run_path = os.path.join(tmp, f"cache_{enabled}.db")
+            source, target = sql.connect(path), sql.connect(run_path)
+            source.backup(target)
+            source.close()
+            target.close()
+            use_database(run_path, trace=trace)
+            services.read_cache.clear()
+            services.read_cache.enabled = enabled
+            statements.clear()
+            hits, misses = services.read_cache.hits, services.read_cache.misses
+            rng = random.Random(seed)
+            titles = datagen.Popularity(random.Random(seed), counts["LibraryItem"], exponent=0.8)
+            start = time.perf_counter()
+            for _ in range(sessions):
+                browse_session(rng, titles, counts)
+            elapsed = time.perf_counter() - start
+            database.close()
+            hits, misses = services.read_cache.hits - hits, services.read_cache.misses - misses
+            rate = f"{hits / (hits + misses):.0%}" if hits + misses else "-"
+            queries = sum(1 for statement in statements if statement not in ("BEGIN", "BEGIN IMMEDIATE", "COMMIT"))
+            print(f"{'on' if enabled else 'off':<10} | {queries:>10} | {queries / sessions:>11.1f} | {elapsed:>8.2f} "
+                  f"| {rate:>8}")
+        services.read_cache.enabled = services.read_cache.ttl > 0
+        print("\nStatements exclude BEGIN and COMMIT.")
+
+
+def bench_archive(loans, days, seed=0, requests=200):
+    """Times loan lookups and the fine run before and after archiving settled loans"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "archive.db")
+        counts = datagen.generate(path, loans, seed)
+        use_database(path)
+        rng = random.Random(seed)
+        borrowers = [(rng.randint(1, counts["Borrowers"]),) for _ in range(requests)]
+        operations = [("open_loans", lambda b: services.open_loans(b).rows),
+                      ("borrowed_books", lambda b: services.borrowed_books(b).rows),
+                      ("fines_due", services.fines_due),
+                      ("loan_history", lambda b: services.loan_history(b).rows)]
+
+        def timings():
+            result = {name: time_calls(call, borrowers) for name, call in operations}
+            start = time.perf_counter()
+            services.calculate_fines()
+            result["calculate_fines"] = (time.perf_counter() - start) * 1000
+            return result
+
+        try:
+            before = timings()
+            start = time.perf_counter()
+            moved = archive.archive_loans(days)
+            elapsed = time.perf_counter() - start
+            after = timings()
+            hot, outstanding, archived = archive.table_sizes()
+        finally:
+            database.close()
+        print(f"\nArchived {moved} of {counts['BorrowingTransactions']} loans in {elapsed:.1f}s; "
+              f"{hot} stay in BorrowingTransactions ({outstanding} open or unpaid), {archived} in the archive\n")
+        print(f"{'Operation':<16} | {'Before (ms)':>11} | {'After (ms)':>10}")
+        for name in before:
+            print(f"{name:<16} | {before[name]:>11.3f} | {after[name]:>10.3f}")
+        print(f"\nPer-borrower operations are means over {requests} borrowers; calculate_fines is one run.")
+
+
+def bench_reports(loans, chunk_size, seed=0):
+    """Times and sizes the NumPy report build, then times the same reports in SQL as a cross-check"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "reports.db")
+        counts = datagen.generate(path, loans, seed)
+        use_database(path)
+        try:
+            start = time.perf_counter()
+            built, clock = reports.build_reports(chunk_size)
+            elapsed = time.perf_counter() - start
+            # Memory comes from a second run: tracing allocations slows the first one several times over
+            _, peak = measure(lambda: reports.build_reports(chunk_size))
+            start = time.perf_counter()
+            reports.write_reports(built, os.path.join(tmp, "out"))
+            written = time.perf_counter() - start
+            start = time.perf_counter()
+            differences = reports.check_reports(built, clock)
+            checked = time.perf_counter() - start
+        finally:
+            database.close()
+    print(f"\n{counts['BorrowingTransactions']} loans, {counts['LibraryItem']} items, {counts['Borrowers']} borrowers, "
+          f"chunks of {chunk_size}\n")
+    print(f"NumPy reports    {elapsed:>8.2f}s  (peak {peak / 1024:.1f} MiB traced)")
+    print(f"CSV output       {written:>8.2f}s")
+    print(f"SQL cross-check  {checked:>8.2f}s  {'all reports match' if not differences else 'FAILED'}")
+    for difference in differences[:20]:
+        print(f"  {difference}")
+    return not differences
+
+
+EXPIRE_READY_HOLD = "UPDATE ItemHold SET ExpiresAt = datetime('now', '-1 minute') WHERE Status = 'Ready'"
+
+
+def bench_holds(queues, cycles):
+    """Hold placement, hand-over on return, pickup and expiry on one copy with long queues behind it"""
+    print(f"{'Queue':>6} | {'Place (ms)':>10} | {'Return (ms)':>11} | {'Collect (ms)':>12} | {'Expire (ms)':>11} | FIFO")
+    ok = True
+    for queue in queues:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "holds.db")
+            db = create_database(path)
+            seed_shelf(db, 1000, borrowers=queue + 1)
+            db.close()
+            use_database(path)
+            try:
+                # Borrower 1 has the only copy of item 1; everyone else queues for it
+                loan = services.borrow(1, 1)
+                waiting = list(range(2, queue + 2))
+                start = time.perf_counter()
+                positions = [services.place_hold(borrower, 1).position for borrower in waiting]
+                place = (time.perf_counter() - start) * 1000 / queue
+                fifo = positions == list(range(1, queue + 1))
+
+                returns = collects = 0.0
+                served = []
+                for borrower in waiting[:min(cycles, queue - 1)]:
+                    start = time.perf_counter()
+                    services.return_loan(loan.transaction_id)
+                    returns += time.perf_counter() - start
+                    start = time.perf_counter()
+                    loan = services.borrow(borrower, 1)
+                    collects += time.perf_counter() - start
+                    served.append(borrower)
+                rounds = len(served)
+                fifo = fifo and served == waiting[:rounds]
+
+                # The next patron never turns up, so the copy should pass to the one after
+                services.return_loan(loan.transaction_id)
+                with unit_of_work() as cursor:
+                    cursor.execute(EXPIRE_READY_HOLD)
+                start = time.perf_counter()
+                expired = services.expire_holds()
+                expire = (time.perf_counter() - start) * 1000
+                with unit_of_work() as cursor:
+                    ready = cursor.execute("SELECT BorrowerID FROM ItemHold WHERE Status = 'Ready'").fetchall()
+                if rounds + 1 < queue:
+                    fifo = fifo and expired == 1 and ready == [(waiting[rounds + 1],)]
+            finally:
+                database.close()
+        ok = ok and fifo
+        print(f"{queue:>6} | {place:>10.3f} | {returns * 1000 / max(rounds, 1):>11.3f} | "
+              f"{collects * 1000 / max(rounds, 1):>12.3f} | {expire:>11.3f} | {'ok' if fifo else 'FAILED'}")
+    print(f"\nReturn and collect are means over up to {cycles} hand-overs of the one copy.")
+    return ok
+
+
+LEGACY_EVENT_CAPACITY = """
+    SELECT e.Capacity, (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID)
+    FROM Events e WHERE e.EventID = ?
+"""
+LEGACY_INSERT_REGISTRATION = "INSERT INTO EventRegistration (EventID, BorrowerID, RegistrationDate) VALUES (?, ?, datetime('now'))"
+WAITLIST_ORDER = "SELECT BorrowerID FROM EventWaitlist WHERE EventID = ? ORDER BY WaitlistID"
+REGISTRATION_TOTALS = """
+    SELECT e.Capacity, e.RegisteredCount, (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID)
+    FROM Events e WHERE e.EventID = ?
+"""
+
+
+def legacy_register(event_id, borrower_id):
+    """The old sign-up path: count the registrations, then insert in a separate step"""
+    with unit_of_work() as cursor:
+        capacity, registered = cursor.execute(LEGACY_EVENT_CAPACITY, (event_id,)).fetchone()
+    if registered >= capacity:
+        return False
+    time.sleep(0.001)  # the gap between showing the spots left and the patron confirming
+    with unit_of_work() as cursor:
+        cursor.execute(LEGACY_INSERT_REGISTRATION, (event_id, borrower_id))
+    return True
+
+
+def registration_worker(path, borrowers, start_at, legacy):
+    """Signs each borrower up for event 1 from start_at on, waitlisting on a full event
+
+    Returns (registered, waitlisted, seconds spent).
+    """
+    use_database(path, pool_size=1)
+    registered = waitlisted = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    start = time.perf_counter()
+    for borrower_id in borrowers:
+        if legacy:
+            registered += legacy_register(1, borrower_id)
+            continue
+        try:
+            services.register_for_event(1, borrower_id)
+            registered += 1
+        except services.Unavailable:
+            services.join_waitlist(1, borrower_id)
+            waitlisted += 1
+    elapsed = time.perf_counter() - start
+    database.close()
+    return registered, waitlisted, elapsed
+
+
+def cancel_worker(path, borrowers):
+    use_database(path, pool_size=1)
+    for borrower_id in borrowers:
+        services.cancel_registration(1, borrower_id)
+    database.close()
+
+
+def bench_registrations(attempts, capacity, processes, legacy=False):
+    """Fires attempts sign-ups at one event from many processes at once, then cancels some
+
+    Passes when the event ends exactly full, everyone else is waitlisted, and cancelled
+    seats go to the front of the waitlist in the order it was joined.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "registrations.db")
+        db = create_database(path)
+        db.executemany("INSERT INTO Borrowers (BorrowerID, Name, Email) VALUES (?, ?, ?)",
+                       ((i, f"Borrower {i}", f"b{i}@example.com") for i in range(1, attempts + 1)))
+        db.execute("INSERT INTO Events (EventID, EventName, EventType, DateTime, Location, Capacity) "
+                   "VALUES (1, 'Author Talk', 'Talk', datetime('now', '+7 days'), 'Main Library Hall', ?)", (capacity,))
+        db.commit()
+        db.close()
+        use_database(path)   # migrate once before the workers open it
+        database.close()
+
+        borrowers = list(range(1, attempts + 1))
+        start_at = time.time() + 1.0   # every process starts firing at the same moment
+        with multiprocessing.Pool(processes) as workers:
+            totals = workers.starmap(registration_worker,
+                                     [(path, borrowers[n::processes], start_at, legacy) for n in range(processes)])
+        registered = sum(r for r, _, _ in totals)
+        waitlisted = sum(w for _, w, _ in totals)
+        elapsed = max(seconds for _, _, seconds in totals)
+
+        monitor = sql.connect(path, timeout=30)
+        _, counter, seats = monitor.execute(REGISTRATION_TOTALS, (1,)).fetchone()
+        queue = [row[0] for row in monitor.execute(WAITLIST_ORDER, (1,))]
+        print(f"{attempts} sign-ups for {capacity} seats from {processes} processes, "
+              f"{'legacy' if legacy else 'atomic'} path: {elapsed:.2f}s ({attempts / elapsed:.0f}/s)")
+        print(f"Registered: {seats} (counter {counter})   Waitlisted: {len(queue)}")
+        ok = seats == counter == registered == min(capacity, attempts) and len(queue) == waitlisted == attempts - seats
+
+        if not legacy and queue:
+            # Cancel a quarter of the seats from several processes at once
+            seated = [row[0] for row in monitor.execute("SELECT BorrowerID FROM EventRegistration WHERE EventID = 1")]
+            leaving = seated[:max(1, capacity // 4)]
+            with multiprocessing.Pool(processes) as workers:
+                workers.starmap(cancel_worker, [(path, leaving[n::processes]) for n in range(processes)])
+            promoted = queue[:len(leaving)]
+            now_seated = {row[0] for row in monitor.execute("SELECT BorrowerID FROM EventRegistration WHERE EventID = 1")}
+            _, counter, seats = monitor.execute(REGISTRATION_TOTALS, (1,)).fetchone()
+            in_order = set(promoted) <= now_seated and not now_seated & set(leaving)
+            rest = [row[0] for row in monitor.execute(WAITLIST_ORDER, (1,))]
+            print(f"Cancelled {len(leaving)}: seats {seats} (counter {counter}), "
+                  f"promoted in waitlist order: {'yes' if in_order else 'no'}, {len(rest)} still waiting")
+            ok = ok and in_order and seats == counter == capacity and rest == queue[len(leaving):]
+        monitor.close()
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+def retained(load):
+    """Returns (load(), seconds, KiB still allocated for the result), timing a run without tracing"""
+    start = time.perf_counter()
+    load()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    result = load()
+    size = tracemalloc.get_traced_memory()[0] / 1024
+    tracemalloc.stop()
+    return result, seconds, size
+
+
+def bench_catalog(items, added=1000):
+    """Load time and memory of the catalog snapshot against a fetchall of row tuples"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "catalog.db")
+        db = create_database(path)
+        seed_catalog(db, items)
+        db.execute("UPDATE LibraryItem SET YearPublished = 1900 + ItemID % 125")
+        db.commit()
+        db.close()
+        use_database(path)
+        try:
+            def fetch_all():
+                with unit_of_work() as cursor:
+                    return cursor.execute(catalog.ITEMS_AFTER, (0,)).fetchall()
+
+            def load_snapshot():
+                snapshot = catalog.CatalogSnapshot()
+                snapshot.refresh()
+                return snapshot
+
+            rows, fetch_seconds, fetch_kib = retained(fetch_all)
+            del rows
+            snapshot, snapshot_seconds, snapshot_kib = retained(load_snapshot)
+
+            with unit_of_work() as cursor:
+                cursor.executemany(services.INSERT_ITEM, ((f"New Title {i}", "Book", "Author 1", 2024)
+                                                          for i in range(added)))
+            start = time.perf_counter()
+            refreshed = snapshot.refresh()
+            refresh_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            unchanged = snapshot.refresh()
+            idle_ms = (time.perf_counter() - start) * 1000
+
+            middle = items // services.ITEMS_PER_PAGE // 2
+            keyset = services.KeysetPager(services.ALL_ITEMS, services.ITEM_ORDER)
+            keyset_ms = time_calls(keyset.jump_to, [(middle,), (0,)] * 50)
+            pager = catalog.SnapshotPager(snapshot, services.ITEMS_PER_PAGE)
+            snapshot_ms = time_calls(pager.jump_to, [(middle,), (0,)] * 50)
+        finally:
+            database.close()
+
+    print(f"{items} items\n")
+    print(f"{'Load':<26} | {'Seconds':>7} | {'MiB':>7} | {'Bytes/item':>10}")
+    for name, seconds, kib in (("fetchall of tuples", fetch_seconds, fetch_kib),
+                               ("CatalogSnapshot", snapshot_seconds, snapshot_kib)):
+        print(f"{name:<26} | {seconds:>7.2f} | {kib / 1024:>7.1f} | {kib * 1024 / items:>10.0f}")
+    print(f"\nRefresh after {added} new items: {refreshed} read in {refresh_ms:.2f} ms; "
+          f"with nothing new: {unchanged} read in {idle_ms:.3f} ms")
+    print(f"Page jump, keyset query: {keyset_ms:.3f} ms; snapshot: {snapshot_ms:.4f} ms")
+
+
+def bench_queries(loans, calls, repeat=3, seed=0):
+    """Cost of the desk's lookups with the query log off and on, then the log itself"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "queries.db")
+        db = create_database(path)
+        borrowers = seed_loans(db, loans, seed)
+        db.close()
+        rng = random.Random(seed)
+        picks = [rng.randint(1, borrowers) for _ in range(calls)]
+
+        def lookups(borrower_id):
+            services.get_item(borrower_id)
+            services.fines_due(borrower_id)
+            services.loan_history(borrower_id, 0)
+
+        query_log = querylog.QueryLog(slow_ms=querylog.SLOW_MS)
+        best = {"off": float("inf"), "on": float("inf")}
+        for _ in range(repeat):   # alternated, keeping each mode's best run
+            for name, log in (("off", None), ("on", query_log)):
+                use_database(path, query_log=log)
+                try:
+                    time_calls(lookups, [(borrower_id,) for borrower_id in picks[:200]])   # warm the page cache
+                    best[name] = min(best[name], time_calls(lookups, [(borrower_id,) for borrower_id in picks]))
+                finally:
+                    database.close()
+        results = list(best.items())
+
+    print(f"{loans} loans, {calls} rounds of get_item + fines_due + loan_history\n")
+    print(f"{'Query log':<10} | {'ms/round':>8} | {'Overhead':>8}")
+    for name, ms in results:
+        print(f"{name:<10} | {ms:>8.3f} | {ms / results[0][1] - 1:>8.1%}")
+    query_log.dump(sys.stdout, top=10)
+
+
+def desk_visit(rng, borrower_id, items, use_session):
+    """One patron at the desk: look at their loans, borrow, return it, settle any fines"""
+    if use_session:
+        session = services.login(borrower_id)
+        session.borrowed_books()
+        try:
+            if session.fines_due() <= 0:
+                loan = session.borrow(rng.randint(1, items))
+                session.open_loans()
+                session.return_loan(loan.transaction_id)
+        except services.Unavailable:
+            pass
+        if session.fines_due() > 0:
+            session.pay_fines()
+        session.borrowed_books()
+        return
+
+    # The menus before sessions: every action asks for the Borrower ID and starts over
+    services.borrowed_books(borrower_id)
+    try:
+        if services.fines_due(borrower_id) <= 0:
+            loan = services.borrow(borrower_id, rng.randint(1, items))
+            services.open_loans(borrower_id)
+            services.return_loan(loan.transaction_id)
+    except services.Unavailable:
+        pass
+    if services.fines_due(borrower_id) > 0:
+        services.pay_fines(borrower_id)
+    services.borrowed_books(borrower_id)
+
+
+def bench_session(visits, loans, seed=0):
+    """Statements and time for the same desk visits with per-action lookups and with a BorrowerSession"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "session.db")
+        counts = datagen.generate(path, loans, seed)
+        statements = []
+
+        def trace(statement):
+            if not statement.startswith("--"):   # trigger bodies run inside the statement that fired them
+                statements.append(statement)
+
+        print(f"{visits} desk visits on {loans} loans: view loans, borrow, return, pay fines, view loans\n")
+        print(f"{'Borrower lookups':<16} | {'Statements':>10} | {'Per visit':>9} | {'Transactions':>12} | "
+              f"{'ms/visit':>8}")
+        for use_session in (False, True):
+            # Each run starts from a copy so the first run's payments don't change the second's fines
+            run_path = os.path.join(tmp, f"session_{use_session}.db")
+            source, target = sql.connect(path), sql.connect(run_path)
+            source.backup(target)
+            source.close()
+            target.close()
+            use_database(run_path, trace=trace)
+            statements.clear()
+            rng = random.Random(seed)
+            start = time.perf_counter()
+            for _ in range(visits):
+                desk_visit(rng, rng.randint(1, counts["Borrowers"]), counts["LibraryItem"], use_session)
+            elapsed = time.perf_counter() - start
+            database.close()
+            transactions = statements.count("BEGIN") + statements.count("BEGIN IMMEDIATE")
+            queries = len(statements) - transactions - statements.count("COMMIT")
+            print(f"{'session' if use_session else 'per action':<16} | {queries:>10} | {queries / visits:>9.1f} | "
+                  f"{transactions / visits:>12.1f} | {elapsed * 1000 / visits:>8.2f}")
+        print("\nStatements exclude BEGIN and COMMIT; transactions are counted per visit.")
+
+
+# What "also borrowed" costs worked out at request time from the loan tables
+LIVE_ALSO_BORROWED = """
+    SELECT other.ItemID, COUNT(DISTINCT h2.BorrowerID) AS CoBorrowers
+    FROM LoanHistory h
+    JOIN LibraryCopy lc ON lc.CopyID = h.CopyID
+    JOIN LoanHistory h2 ON h2.BorrowerID = h.BorrowerID
+    JOIN LibraryCopy other ON other.CopyID = h2.CopyID
+    WHERE lc.ItemID = ? AND other.ItemID != lc.ItemID
+    GROUP BY other.ItemID
+    ORDER BY CoBorrowers DESC, other.ItemID
+    LIMIT ?
+"""
+
+
+def bench_recommend(loans, lookups, seed=0):
+    """Build time and memory of the recommendation batch, then lookups against working it out live"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "recommend.db")
+        counts = datagen.generate(path, loans, seed)
+        use_database(path)
+        try:
+            start = time.perf_counter()
+            tables, figures = recommend.build_recommendations()
+            built = time.perf_counter() - start
+            # Memory comes from a second run: tracing allocations slows the first one several times over
+            _, peak = measure(recommend.build_recommendations)
+            start = time.perf_counter()
+            recommend.store_recommendations(tables)
+            stored = time.perf_counter() - start
+
+            rng = random.Random(seed)
+            items = [rng.randint(1, counts["LibraryItem"]) for _ in range(lookups)]
+            popular = [row[1] for row in tables["TrendingItems"][:10]]
+            timings = {}
+            with unit_of_work() as cursor:
+                for name, query, sample in (("precomputed", services.ALSO_BORROWED, items),
+                                            ("precomputed, popular", services.ALSO_BORROWED, popular),
+                                            ("live SQL", LIVE_ALSO_BORROWED, items[:20]),
+                                            ("live SQL, popular", LIVE_ALSO_BORROWED, popular[:5])):
+                    start = time.perf_counter()
+                    for item_id in sample:
+                        cursor.execute(query, (item_id, 5)).fetchall()
+                    timings[name] = (time.perf_counter() - start) * 1000 / len(sample)
+                start = time.perf_counter()
+                for _ in range(lookups):
+                    cursor.execute(services.keyset_query(services.POPULAR_ITEMS, services.POPULAR_ORDER),
+                                   (services.ITEMS_PER_PAGE + 1, 0)).fetchall()
+                timings["popular now page"] = (time.perf_counter() - start) * 1000 / lookups
+        finally:
+            database.close()
+    print(f"\n{counts['BorrowingTransactions']} loans, {counts['LibraryItem']} items, {counts['Borrowers']} borrowers\n")
+    for name, value in figures.items():
+        print(f"{name:<24} {value:>12}")
+    for name, rows in tables.items():
+        print(f"{name:<24} {len(rows):>12} rows")
+    print(f"\nBatch build      {built:>8.2f}s  (peak {peak / 1024:.1f} MiB traced)")
+    print(f"Store            {stored:>8.2f}s")
+    print(f"\n{'Lookup':<22} | {'ms/call':>9}")
+    for name, value in timings.items():
+        print(f"{name:<22} | {value:>9.3f}")
+
+
+def typo(rng, word):
+    """word with one letter changed, dropped, added or swapped with the next"""
+    i = rng.randrange(len(word) - 1)
+    letter = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    edit = rng.choice("cdas")
+    if edit == "c":
+        return word[:i] + letter + word[i + 1:]
+    if edit == "d":
+        return word[:i] + word[i + 1:]
+    if edit == "a":
+        return word[:i] + letter + word[i:]
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def bench_fuzzy(items, queries, added=1000, seed=0):
+    """Recall and latency of typo-tolerant search for titles with one misspelt word"""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "fuzzy.db")
+        db = create_database(path)
+        seed_catalog(db, items, seed)
+        db.close()
+        use_database(path)
+        try:
+            def build():
+                index = catalog.TermIndex()
+                index.refresh()
+                return index
+
+            index, build_seconds, size = retained(build)
+            services.terms = index
+            # Misspell one word of a random title; its item number stays out of the query
+            cases = []
+            with unit_of_work() as cursor:
+                while len(cases) < queries:
+                    title = cursor.execute("SELECT Title FROM LibraryItem WHERE ItemID = ?",
+                                           (rng.randint(1, items),)).fetchone()[0]
+                    words = title.lower().split()[:-1]
+                    long_words = [i for i, word in enumerate(words) if len(word) >= 4]
+                    if not long_words:
+                        continue
+                    i = rng.choice(long_words)
+                    cases.append((" ".join(words), " ".join(words[:i] + [typo(rng, words[i])] + words[i + 1:])))
+
+            def found(rows, words):
+                # Titles are words plus the item number; items with the same words can't be told apart
+                return any(row[1].lower().rsplit(" ", 1)[0] == words for row in rows)
+
+            exact = top1 = top10 = 0
+            exact_ms, fuzzy_ms = [], []
+            for words, query in cases:
+                start = time.perf_counter()
+                exact += found(services.search(query).rows, words)
+                exact_ms.append((time.perf_counter() - start) * 1000)
+                services.read_cache.clear()
+                start = time.perf_counter()
+                ranked = services.fuzzy_search(query).snapshot
+                fuzzy_ms.append((time.perf_counter() - start) * 1000)
+                top1 += found(ranked[:1], words)
+                top10 += found(ranked[:10], words)
+
+            def like(query):
+                with unit_of_work() as cursor:
+                    return cursor.execute("SELECT * FROM LibraryItem WHERE Title LIKE ?", (f"%{query}%",)).fetchall()
+
+            like_ms = time_calls(like, [(query,) for _, query in cases[:10]])
+            exact_ms.sort()
+            fuzzy_ms.sort()
+
+            with unit_of_work(immediate=True) as cursor:
+                cursor.executemany("INSERT INTO LibraryItem (Title, ItemType, AuthorCreator) VALUES (?, 'Book', ?)",
+                                   ((f"Quillotrex Volume {i}", f"Author {i}") for i in range(added)))
+            start = time.perf_counter()
+            index.refresh()
+            refresh_ms = (time.perf_counter() - start) * 1000
+            new_word = [term for term, _ in services.terms.similar("quilotrex", 1)]
+        finally:
+            database.close()
+    print(f"\n{items} items: {len(index)} distinct words indexed in {build_seconds:.2f}s, "
+          f"{size / 1024:.1f} MiB retained\n")
+    print(f"{'Search':<22} | {'Found':>6} | {'Found top 10':>12} | {'p50 ms':>8} | {'p95 ms':>8}")
+    print(f"{'exact full-text':<22} | {exact / queries:>6.0%} | {'':>12} | "
+          f"{percentile(exact_ms, 0.5):>8.2f} | {percentile(exact_ms, 0.95):>8.2f}")
+    print(f"{'fuzzy':<22} | {top1 / queries:>6.0%} | {top10 / queries:>12.0%} | "
+          f"{percentile(fuzzy_ms, 0.5):>8.2f} | {percentile(fuzzy_ms, 0.95):>8.2f}")
+    print(f"{'LIKE scan':<22} | {'':>6} | {'':>12} | {like_ms:>8.2f} |")
+    print(f"\nRefresh after {added} new items: {refresh_ms:.1f} ms; 'quilotrex' now finds {new_word}")
+
+
+def bench_commits(session_counts, seconds, items=10000):
+    """Borrow/return commits per second with and without group commit, at each durability
+
+    One borrow in ten names an unknown patron, so some writes in each group commit
+    fail and are rolled back on their own; the loan table is then checked against
+    the borrows that succeeded.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "commits.db")
+        db = create_database(path)
+        seed_shelf(db, items)
+        db.close()
+
+        print(f"{'Durability':<10} | {'Group':>5} | {'Sessions':>8} | {'Commits/s':>9} | {'Per batch':>9} | "
+              f"{'p50 ms':>7} | {'p99 ms':>7} | Checked")
+        ok = True
+        for durability in ("full", "normal"):
+            for group_commit in (False, True):
+                for sessions in session_counts:
+                    pool = use_database(path, pool_size=sessions + 1, durability=durability,
+                                        group_commit=group_commit)
+                    with unit_of_work() as cursor:
+                        loans_before = cursor.execute("SELECT COUNT(*) FROM BorrowingTransactions").fetchone()[0]
+                    latencies = [[] for _ in range(sessions)]
+                    borrowed = [0] * sessions
+                    stop_at = time.perf_counter() + seconds
+
+                    def session(number):
+                        rng = random.Random(number)
+                        # Each session works its own slice of the catalog so loans never collide
+                        first = number * (items // sessions) + 1
+                        writes = 0
+                        while time.perf_counter() < stop_at:
+                            item_id = rng.randint(first, first + items // sessions - 1)
+                            borrower_id = number + 1 if writes % 20 else 10 ** 9
+                            start = time.perf_counter()
+                            try:
+                                loan = services.borrow(borrower_id, item_id)
+                            except services.NotFound:
+                                loan = None
+                            middle = time.perf_counter()
+                            latencies[number].append(middle - start)
+                            writes += 1
+                            if loan is None:
+                                continue
+                            borrowed[number] += 1
+                            services.return_loan(loan.transaction_id)
+                            latencies[number].append(time.perf_counter() - middle)
+                            writes += 1
+                        return writes
+
+                    elapsed, writes = run_sessions(sessions, session)
+                    writer = pool.writer
+                    per_batch = f"{writer.writes / max(writer.commits, 1):.1f}" if writer else "1"
+                    database.close()
+                    check = sql.connect(path)
+                    loans, open_loans, lent_copies = check.execute(
+                        "SELECT (SELECT COUNT(*) FROM BorrowingTransactions), "
+                        "(SELECT COUNT(*) FROM BorrowingTransactions WHERE ReturnDate IS NULL), "
+                        "(SELECT COUNT(*) FROM LibraryCopy WHERE Status != 'onShelf')").fetchone()
+                    check.close()
+                    consistent = loans - loans_before == sum(borrowed) and not open_loans and not lent_copies
+                    ok = ok and consistent
+                    samples = sorted(sample * 1000 for part in latencies for sample in part)
+                    print(f"{durability:<10} | {'on' if group_commit else 'off':>5} | {sessions:>8} | "
+                          f"{writes / elapsed:>9.0f} | {per_batch:>9} | {percentile(samples, 0.5):>7.2f} | "
+                          f"{percentile(samples, 0.99):>7.2f} | {'ok' if consistent else 'MISMATCH'}")
+        return ok
+
+
+def write_kiosk_journal(path, records, copies, borrowers, seed=0):
+    """Writes a journal of random kiosk loans and returns against copies that all start on the shelf
+
+    About one record in twenty can't be applied (an unknown borrower, a copy already out,
+    a return of a copy on the shelf). Returns (outcome counts to expect, copies left out).
+    """
+    rng = random.Random(seed)
+    lent = set()
+    expected = {"borrow": 0, "return": 0, "conflicts": 0}
+    at = int(time.time()) - 30 * 86400
+    with journal.Journal(path, "Benchmark branch", sync=False) as kiosk:
+        for _ in range(records):
+            copy_id = rng.randint(1, copies)
+            at += rng.randint(0, 5)
+            mistake = rng.random() < 0.05
+            if copy_id in lent and not mistake:
+                kiosk.give_back(copy_id, at)
+                lent.discard(copy_id)
+                expected["return"] += 1
+            elif copy_id in lent:
+                kiosk.borrow(rng.randint(1, borrowers), copy_id, at)
+                expected["conflicts"] += 1
+            elif mistake:
+                if rng.random() < 0.5:
+                    kiosk.borrow(borrowers + 1, copy_id, at)
+                else:
+                    kiosk.give_back(copy_id, at)
+                expected["conflicts"] += 1
+            else:
+                kiosk.borrow(rng.randint(1, borrowers), copy_id, at)
+                lent.add(copy_id)
+                expected["borrow"] += 1
+    return expected, len(lent)
+
+
+def bench_journal(records, copies, seed=0, synced=2000):
+    """Offline journal append rate, and replay throughput, idempotence and conflicts on a large backlog"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "journal.db")
+        db = create_database(path)
+        seed_shelf(db, copies, borrowers=10000)
+        db.close()
+        journal_path = os.path.join(tmp, "kiosk.journal")
+
+        with journal.Journal(os.path.join(tmp, "synced.journal"), sync=True) as kiosk:
+            start = time.perf_counter()
+            for copy_id in range(1, synced + 1):
+                kiosk.borrow(1, copy_id)
+            append_ms = (time.perf_counter() - start) * 1000 / synced
+        start = time.perf_counter()
+        expected, still_out = write_kiosk_journal(journal_path, records, copies, 10000, seed)
+        write_seconds = time.perf_counter() - start
+        print(f"Appends: {append_ms:.3f} ms each with fsync; {records} unsynced in {write_seconds:.1f}s "
+              f"({os.path.getsize(journal_path) / 2 ** 20:.1f} MiB)")
+
+        # An interrupted replay: the first half of the file under the same journal id
+        half_path = os.path.join(tmp, "half.journal")
+        with open(journal_path, "rb") as source, open(half_path, "wb") as half:
+            half.write(source.read(journal.HEADER.size + records // 2 * journal.RECORD.size))
+
+        use_database(path)
+        try:
+            runs = []
+            for name, replayed in (("first half", half_path), ("whole journal", journal_path),
+                                   ("again", journal_path)):
+                start = time.perf_counter()
+                totals = journal.replay(replayed, report=None)
+                runs.append((name, totals, time.perf_counter() - start))
+            with unit_of_work() as cursor:
+                open_loans, lent_copies, conflicts = cursor.execute(
+                    "SELECT (SELECT COUNT(*) FROM BorrowingTransactions WHERE ReturnDate IS NULL), "
+                    "(SELECT COUNT(*) FROM LibraryCopy WHERE Status = 'Borrow'), "
+                    "(SELECT COUNT(*) FROM JournalConflict)").fetchone()
+        finally:
+            database.close()
+
+        print(f"\n{'Replay':<14} | {'Loans':>8} | {'Returns':>8} | {'Conflicts':>9} | {'Skipped':>8} | "
+              f"{'Seconds':>7} | {'Records/s':>9}")
+        for name, totals, seconds in runs:
+            done = totals["borrow"] + totals["return"] + totals["conflicts"]
+            print(f"{name:<14} | {totals['borrow']:>8} | {totals['return']:>8} | {totals['conflicts']:>9} | "
+                  f"{totals['skipped']:>8} | {seconds:>7.2f} | {done / seconds:>9.0f}")
+        applied = {key: runs[0][1][key] + runs[1][1][key] for key in expected}
+        ok = (applied == expected and runs[2][1]["skipped"] == records and open_loans == lent_copies == still_out
+              and conflicts == expected["conflicts"])
+        print(f"\nExpected {expected['borrow']} loans, {expected['return']} returns, {expected['conflicts']} conflicts "
+              f"and {still_out} copies out: {'ok' if ok else 'MISMATCH'}")
+        return ok
+
+
+def bench_notices(loans, batch_size, seed=0):
+    """Time and memory of a notice run over every open loan, then of the next run, which has nothing to do
+
+    Memory is the growth in peak RSS, as tracemalloc would slow the run several times over.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "notices.db")
+        db = create_database(path)
+        seed_loans(db, loans, seed)
+        db.close()
+        outbox = notices.Outbox(os.path.join(tmp, "outbox.jsonl"))
+        use_database(path)
+        try:
+            runs = []
+            for name in ("first run", "second run"):
+                before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.perf_counter()
+                results = notices.run(outbox.send, batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+                grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+                runs.append((name, results, elapsed, grown))
+            with unit_of_work() as cursor:
+                expected = dict(cursor.execute(
+                    "SELECT CASE WHEN DueDate < DATE('now') THEN 'overdue' ELSE 'due' END, COUNT(*) "
+                    "FROM BorrowingTransactions WHERE ReturnDate IS NULL AND DueDate <= DATE('now', ?) GROUP BY 1",
+                    (f"+{services.REMINDER_DAYS} days",)).fetchall())
+                open_loans = cursor.execute(
+                    "SELECT COUNT(*) FROM BorrowingTransactions WHERE ReturnDate IS NULL").fetchone()[0]
+        finally:
+            database.close()
+        sent = {}
+        with open(outbox.path, encoding="utf-8") as file:
+            for line in file:
+                notice = json.loads(line)
+                for loan in notice["loans"]:
+                    sent[(notice["kind"], loan[0])] = sent.get((notice["kind"], loan[0]), 0) + 1
+
+        print(f"{open_loans} open loans, {batch_size} per batch\n")
+        print(f"{'Run':<11} | {'Loans':>8} | {'Notices':>8} | {'Seconds':>8} | {'Loans/s':>8} | {'RSS +KiB':>9}")
+        for name, results, elapsed, grown in runs:
+            covered = sum(loans for loans, _ in results.values())
+            count = sum(sent for _, sent in results.values())
+            print(f"{name:<11} | {covered:>8} | {count:>8} | {elapsed:>8.2f} | {covered / elapsed:>8.0f} | {grown:>9}")
+        per_kind = {kind: sum(1 for sent_kind, _ in sent if sent_kind == kind) for kind in notices.KINDS}
+        ok = (max(sent.values(), default=1) == 1 and all(per_kind[kind] == expected.get(kind, 0) for kind in per_kind))
+        print(f"\nOutbox: {len(sent)} loans notified, each once; "
+              f"{'matches' if ok else 'DOES NOT MATCH'} the open loans due by then ({sum(expected.values())})")
+        return ok
+
+
+COUNT_AT_BRANCH = "SELECT COUNT(*) FROM LibraryCopy WHERE ItemID=? AND BranchID=? AND Status='onShelf'"
+SCAN_AT_BRANCH = "SELECT COUNT(*) FROM LibraryCopy NOT INDEXED WHERE ItemID=? AND BranchID=? AND Status='onShelf'"
+ROUTED_HOLDS = """
+    SELECT COUNT(*) FROM ItemHold h JOIN LibraryCopy lc ON lc.CopyID = h.CopyID
+    WHERE h.Status = 'Ready' AND lc.BranchID = h.BranchID
+"""
+
+
+def seed_branches(db, items, branches, copies_per_item, borrowers, seed=0):
+    """Spreads branches over a city around the main library and copies of every item over the branches"""
+    rng = random.Random(seed)
+    locations = {1: (51.5, -0.12)}
+    locations.update((i, (51.5 + rng.uniform(-0.2, 0.2), -0.12 + rng.uniform(-0.3, 0.3)))
+                     for i in range(2, branches + 1))
+    db.execute("INSERT INTO Branch (BranchID, Name, Latitude, Longitude) VALUES (1, 'Main Library', ?, ?) "
+               "ON CONFLICT (BranchID) DO UPDATE SET Latitude = excluded.Latitude, Longitude = excluded.Longitude",
+               locations[1])
+    db.executemany("INSERT INTO Branch (BranchID, Name, Latitude, Longitude) VALUES (?, ?, ?, ?)",
+                   ((i, f"Branch {i}", *locations[i]) for i in range(2, branches + 1)))
+    seed_catalog(db, items, seed)
+    db.executemany("INSERT INTO LibraryCopy (Status, ItemID, BranchID) VALUES ('onShelf', ?, ?)",
+                   ((item, rng.randint(1, branches)) for item in range(1, items + 1) for _ in range(copies_per_item)))
+    db.executemany("INSERT INTO Borrowers (BorrowerID, Name, Email) VALUES (?, ?, ?)",
+                   ((i, f"Borrower {i}", f"b{i}@example.com") for i in range(1, borrowers + 1)))
+    db.commit()
+    return locations
+
+
+def bench_branches(sizes, branches, holds, copies_per_item=3, lookups=20000, scans=20, seed=0):
+    """Per-branch availability as the catalog grows, and holds routed from the nearest branch with stock
+
+    Stock is the BranchStock primary-key lookup services.available_copies makes, Count
+    the same answer counted from the (ItemID, BranchID, Status) index on LibraryCopy,
+    and Scan that count without the index.
+    """
+    print(f"{branches} branches, {copies_per_item} copies of each item at random branches, {holds} holds routed\n")
+    print(f"{'Items':>8} | {'Stock (us)':>10} | {'Count (us)':>10} | {'Scan (us)':>10} | "
+          f"{'Place hold (ms)':>15} | {'Receive (ms)':>12} | {'Nearest':>7} | {'Ready':>5} | Counters")
+    ok = True
+    for items in sizes:
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "branches.db")
+            create_database(path).close()
+            use_database(path)   # migrates the copy, adding the branch tables
+            db = sql.connect(path)
+            locations = seed_branches(db, items, branches, copies_per_item, holds, seed)
+            db.close()
+            try:
+                probes = [(rng.randint(1, branches), rng.randint(1, items)) for _ in range(lookups)]
+                timings = []
+                with unit_of_work() as cursor:
+                    for query, params in ((services.BRANCH_AVAILABLE, probes), (COUNT_AT_BRANCH, probes),
+                                          (SCAN_AT_BRANCH, probes[:scans])):
+                        if query != services.BRANCH_AVAILABLE:
+                            params = [(item, branch) for branch, item in params]
+                        timings.append(time_calls(lambda *args: cursor.execute(query, args).fetchone(), params) * 1000)
+
+                # Each borrower holds an item for pickup at a branch without a copy of it on the shelf
+                requests = []
+                with unit_of_work() as cursor:
+                    while len(requests) < holds:
+                        branch, item = rng.randint(1, branches), rng.randint(1, items)
+                        if not cursor.execute(services.BRANCH_AVAILABLE, (branch, item)).fetchone()[1]:
+                            requests.append((len(requests) + 1, item, branch))
+                nearest = 0
+                placing = 0.0
+                for borrower, item, branch in requests:
+                    with unit_of_work() as cursor:
+                        stocked = cursor.execute(services.STOCKED_BRANCHES, (item,)).fetchall()
+                    expected = min(stocked, key=lambda row: services.distance_km(*locations[branch], row[2], row[3]))
+                    start = time.perf_counter()
+                    hold = services.place_hold(borrower, item, branch)
+                    placing += time.perf_counter() - start
+                    nearest += hold.transfer_from == expected[1]
+                with unit_of_work() as cursor:
+                    transfers = [row[0] for row in cursor.execute(
+                        "SELECT TransferID FROM CopyTransfer WHERE Status = 'Requested' ORDER BY TransferID")]
+                start = time.perf_counter()
+                for transfer_id in transfers:
+                    services.receive_transfer(transfer_id)
+                receiving = time.perf_counter() - start
+                with unit_of_work() as cursor:
+                    ready = cursor.execute(ROUTED_HOLDS).fetchone()[0]
+                drift = services.counter_drift()["BranchStock.AvailableCopies"]
+            finally:
+                database.close()
+        passed = nearest == ready == holds and not drift
+        ok = ok and passed
+        print(f"{items:>8} | {timings[0]:>10.1f} | {timings[1]:>10.1f} | {timings[2]:>10.1f} | "
+              f"{placing * 1000 / holds:>15.3f} | {receiving * 1000 / max(len(transfers), 1):>12.3f} | "
+              f"{nearest:>7} | {ready:>5} | {'ok' if not drift else f'{drift} stale'}")
+    print(f"\nStock and Count are means over {lookups} lookups, Scan over {scans}. Nearest counts holds "
+          "whose copy came from the closest branch with one on the shelf.")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fines = commands.add_parser("fines", help="fine check latency as the loan table grows")
+    fines.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+
+    search = commands.add_parser("search", help="LIKE title search against the full-text index")
+    search.add_argument("--items", type=int, default=1000000)
+
+    pages = commands.add_parser("pages", help="memory and latency of paging through the catalog")
+    pages.add_argument("--items", type=int, default=1000000)
+
+    sessions = commands.add_parser("sessions", help="borrow/return throughput with concurrent sessions")
+    sessions.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8])
+
+    stress = commands.add_parser("stress", help="multiprocess borrow/return of one item, checking for double loans")
+    stress.add_argument("--processes", type=int, default=8)
+    stress.add_argument("--seconds", type=float, default=5)
+    stress.add_argument("--copies", type=int, default=3)
+    stress.add_argument("--legacy", action="store_true", help="use the old select-then-update borrow path")
+
+    events = commands.add_parser("events", help="event listing with counted and stored registration totals")
+    events.add_argument("--events", type=int, default=10000)
+    events.add_argument("--registrations", type=int, default=1000000)
+
+    http = commands.add_parser("http", help="latency and throughput of server.py under local kiosk load")
+    http.add_argument("--clients", type=int, default=32)
+    http.add_argument("--seconds", type=float, default=10)
+
+    suite = commands.add_parser("suite", help="time every menu operation on generated databases")
+    suite.add_argument("--loans", type=int, nargs="+", default=[10000, 1000000])
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--repeat", type=int, default=20, help="timed runs per operation")
+    suite.add_argument("--output", help="write results as JSON to this file")
+    suite.add_argument("--baseline", help="compare with an earlier --output file, failing on regressions")
+    suite.add_argument("--keep", help="directory to keep generated databases in and reuse them from")
+
+    cache = commands.add_parser("cache", help="SQLite round-trips of browse sessions with and without the read cache")
+    cache.add_argument("--sessions", type=int, default=500)
+    cache.add_argument("--loans", type=int, default=100000)
+
+    archiving = commands.add_parser("archive", help="loan lookups and the fine run before and after archiving")
+    archiving.add_argument("--loans", type=int, default=1000000)
+    archiving.add_argument("--days", type=int, default=archive.ARCHIVE_DAYS)
+
+    reporting = commands.add_parser("reports", help="NumPy report build time and memory, cross-checked against SQL")
+    reporting.add_argument("--loans", type=int, default=1000000)
+    reporting.add_argument("--chunk", type=int, default=reports.CHUNK_SIZE)
+
+    holding = commands.add_parser("holds", help="hold queue operations on one copy with thousands of patrons waiting")
+    holding.add_argument("--queues", type=int, nargs="+", default=[100, 1000, 10000])
+    holding.add_argument("--cycles", type=int, default=200)
+
+    registrations = commands.add_parser("registrations", help="simultaneous sign-ups for one event, checking capacity")
+    registrations.add_argument("--attempts", type=int, default=10000)
+    registrations.add_argument("--capacity", type=int, default=100)
+    registrations.add_argument("--processes", type=int, default=16)
+    registrations.add_argument("--legacy", action="store_true", help="use the old count-then-insert sign-up path")
+
+    snapshot = commands.add_parser("catalog", help="memory and load time of the catalog snapshot against fetched tuples")
+    snapshot.add_argument("--items", type=int, default=1000000)
+
+    queries = commands.add_parser("queries", help="overhead of the query log on the desk lookups, and its report")
+    queries.add_argument("--loans", type=int, default=100000)
+    queries.add_argument("--calls", type=int, default=5000)
+
+    recommending = commands.add_parser("recommend", help="recommendation batch build, and lookups against live SQL")
+    recommending.add_argument("--loans", type=int, default=1000000)
+    recommending.add_argument("--lookups", type=int, default=1000)
+    fuzzy = commands.add_parser("fuzzy", help="recall and latency of typo-tolerant search on a large catalog")
+    fuzzy.add_argument("--items", type=int, default=1000000)
+    fuzzy.add_argument("--queries", type=int, default=200)
+    commits = commands.add_parser("commits", help="write throughput and latency with and without group commit")
+    commits.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32])
+    commits.add_argument("--seconds", type=float, default=3)
+    journaling = commands.add_parser("journal", help="offline kiosk journal appends, and bulk replay of a backlog")
+    journaling.add_argument("--records", type=int, default=1000000)
+    journaling.add_argument("--copies", type=int, default=100000)
+    noticing = commands.add_parser("notices", help="due and overdue notice runs over a million open loans")
+    noticing.add_argument("--loans", type=int, default=3000000)
+    noticing.add_argument("--batch", type=int, default=notices.BATCH_SIZE)
+    branching = commands.add_parser("branches", help="per-branch availability lookups and nearest-branch hold routing")
+    branching.add_argument("--items", type=int, nargs="+", default=[10000, 100000, 1000000])
+    branching.add_argument("--branches", type=int, default=50)
+    branching.add_argument("--holds", type=int, default=500)
+    session = commands.add_parser("session", help="statements per desk visit with and without a borrower session")
+    session.add_argument("--visits", type=int, default=500)
+    session.add_argument("--loans", type=int, default=100000)
+
+    args = parser.parse_args()
+    if args.command == "fines":
+        bench_fines(args.sizes)
+    elif args.command == "search":
+        bench_search(args.items)
+    elif args.command == "pages":
+        bench_pages(args.items)
+    elif args.command == "sessions":
+        bench_sessions(args.sessions)
+    elif args.command == "stress":
+        if not bench_stress(args.processes, args.seconds, args.copies, args.legacy):
+            sys.exit(1)
+    elif args.command == "events":
+        bench_events(args.events, args.registrations)
+    elif args.command == "http":
+        bench_http(args.clients, args.seconds)
+    elif args.command == "cache":
+        bench_cache(args.sessions, args.loans)
+    elif args.command == "archive":
+        bench_archive(args.loans, args.days)
+    elif args.command == "reports":
+        if not bench_reports(args.loans, args.chunk):
+            sys.exit(1)
+    elif args.command == "holds":
+        if not bench_holds(args.queues, args.cycles):
+            sys.exit(1)
+    elif args.command == "registrations":
+        if not bench_registrations(args.attempts, args.capacity, args.processes, args.legacy):
+            sys.exit(1)
+    elif args.command == "catalog":
+        bench_catalog(args.items)
+    elif args.command == "queries":
+        bench_queries(args.loans, args.calls)
+    elif args.command == "recommend":
+        bench_recommend(args.loans, args.lookups)
+    elif args.command == "fuzzy":
+        bench_fuzzy(args.items, args.queries)
+    elif args.command == "commits":
+        if not bench_commits(args.sessions, args.seconds):
+            sys.exit(1)
+    elif args.command == "journal":
+        if not bench_journal(args.records, args.copies):
+            sys.exit(1)
+    elif args.command == "notices":
+        if not bench_notices(args.loans, args.batch):
+            sys.exit(1)
+    elif args.command == "branches":
+        if not bench_branches(args.items, args.branches, args.holds):
+            sys.exit(1)
+    elif args.command == "session":
+        bench_session(args.visits, args.loans)
+    elif args.command == "suite":
+        if not bench_suite(args.loans, args.seed, args.repeat, args.output, args.baseline, args.keep):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""In-process read cache with LRU eviction, expiry and tag-based invalidation."""
+import collections
+import threading
+import time
+
+DEFAULT_TTL = 30.0     # seconds an entry stays fresh; bounds staleness from other processes
+DEFAULT_SIZE = 4096
+
+
+class ReadCache:
+    """Values by key, each filed under tags so a write can drop exactly the reads it affects
+
+    Entries expire ttl seconds after they are stored and the least recently used one is
+    evicted past size. Safe to share between threads; loaders run outside the lock.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.enabled = ttl > 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._entries = collections.OrderedDict()   # key -> (expires, value, tags)
+        self._tagged = collections.defaultdict(set)  # tag -> keys
+        self._version = 0                            # bumped by every invalidation
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the fresh value for key, or default, counting a hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value, tags=(), version=None):
+        """Stores value under key and tags, unless something was invalidated since version"""
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tagged[tag].add(key)
+            while len(self._entries) > self.size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key, tags, load):
+        """Returns the cached value for key, calling load() and caching its result on a miss"""
+        if not self.enabled:
+            return load()
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        # A write that lands while load() runs may make its result stale, so note the version first
+        version = self._version
+        value = load()
+        self.put(key, value, tags, version)
+        return value
+
+    def invalidate(self, *tags):
+        """Drops every entry filed under any of tags"""
+        with self._lock:
+            self._version += 1
+            for tag in tags:
+                for key in self._tagged.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._tagged.clear()
+
+    def stats(self):
+        """Counters since creation, plus the current entry count and hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
@@ -0,0 +1,255 @@
+"""Compact in-memory snapshot of the catalog for the browse paths.
+
+Items are held column by column: ItemIDs in an array, titles in a list, and
+ItemType, author and year dictionary-encoded as arrays of codes into one list of
+distinct values. CatalogItem records (__slots__) are made only for the rows
+actually shown, so a million items leave no per-item objects for the garbage
+collector to walk. The snapshot loads once and afterwards only reads items past
+the highest ItemID it holds. Items are only ever added (donations and bulk
+imports) and never edited or removed, so that watermark is all a refresh needs.
+Availability changes all the time and is not part of the snapshot; it comes from
+services.get_item().
+
+TermIndex holds the distinct words of titles and authors, each broken into
+trigrams, for typo-tolerant search: a misspelt word shares most of its trigrams
+with the right one. It indexes words rather than items because a catalog has far
+fewer distinct words than items, so its posting lists stay short however large
+the catalog grows, and it refreshes from the same ItemID watermark.
+"""
+import array
+import bisect
+import re
+import threading
+from collections import Counter
+
+import database
+from database import unit_of_work
+
+ITEMS_AFTER = """
+    SELECT ItemID, Title, ItemType, AuthorCreator, YearPublished
+    FROM LibraryItem WHERE ItemID > ? ORDER BY ItemID
+"""
+FETCH_SIZE = 10000
+TERMS_AFTER = "SELECT ItemID, Title, AuthorCreator FROM LibraryItem WHERE ItemID > ? ORDER BY ItemID"
+WORDS = re.compile(r"\w+")
+MIN_SIMILARITY = 0.3    # share of trigrams two words must have in common (pg_trgm's default)
+
+
+class CatalogItem:
+    """One catalog item; iterates like the (ItemID, Title, ItemType, AuthorCreator, YearPublished) row"""
+
+    __slots__ = ("item_id", "title", "item_type", "author", "year")
+    COLUMNS = ("ItemID", "Title", "ItemType", "AuthorCreator", "YearPublished")
+
+    def __init__(self, item_id, title, item_type, author, year):
+        self.item_id = item_id
+        self.title = title
+        self.item_type = item_type
+        self.author = author
+        self.year = year
+
+    def __iter__(self):
+        return iter((self.item_id, self.title, self.item_type, self.author, self.year))
+
+    def __repr__(self):
+        return f"CatalogItem({self.item_id!r}, {self.title!r}, {self.item_type!r}, {self.author!r}, {self.year!r})"
+
+
+class CatalogSnapshot:
+    """Every catalog item in ItemID order, brought up to date by refresh()"""
+
+    def __init__(self):
+        self._pool = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.ids = array.array("q")
+        self.titles = []
+        self.types = array.array("I")     # codes into values, as are authors and years
+        self.authors = array.array("I")
+        self.years = array.array("I")
+        self.values = []
+        self._codes = {}
+        self.watermark = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _encode(self, column):
+        """Codes for a column of values, adding the ones not seen before to values"""
+        codes = self._codes
+        for value in set(column).difference(codes):
+            codes[value] = len(self.values)
+            self.values.append(value)
+        return map(codes.__getitem__, column)
+
+    def refresh(self):
+        """Reads the items added since the last refresh; returns how many there were"""
+        with self._lock:
+            if self._pool is not database.get_pool():
+                # Pointed at another database since the last refresh: start over
+                self._reset()
+                self._pool = database.get_pool()
+            added = 0
+            with unit_of_work() as cursor:
+                cursor.execute(ITEMS_AFTER, (self.watermark,))
+                while rows := cursor.fetchmany(FETCH_SIZE):
+                    ids, titles, types, authors, years = zip(*rows)
+                    self.titles.extend(titles)
+                    self.types.extend(self._encode(types))
+                    self.authors.extend(self._encode(authors))
+                    self.years.extend(self._encode(years))
+                    # ids last: a reader that finds an id must find the rest of its row
+                    self.ids.extend(ids)
+                    added += len(rows)
+            if self.ids:
+                self.watermark = self.ids[-1]
+            return added
+
+    def item(self, index):
+        """The CatalogItem at a position in ItemID order"""
+        values = self.values
+        return CatalogItem(self.ids[index], self.titles[index], values[self.types[index]],
+                           values[self.authors[index]], values[self.years[index]])
+
+    def get(self, item_id):
+        """The item with item_id, or None"""
+        index = bisect.bisect_left(self.ids, item_id)
+        if index < len(self.ids) and self.ids[index] == item_id:
+            return self.item(index)
+        return None
+
+    def page(self, number, size):
+        return [self.item(index) for index in range(number * size, min((number + 1) * size, len(self.ids)))]
+
+
+class SnapshotPager:
+    """Pages through a CatalogSnapshot with the same interface as services.KeysetPager"""
+
+    columns = list(CatalogItem.COLUMNS)
+
+    def __init__(self, snapshot, page_size, page=0):
+        self.snapshot = snapshot
+        self.page_size = page_size
+        self.page = 0
+        self.rows = []
+        self.has_next = False
+        if not self.jump_to(page):
+            self.jump_to(0)
+
+    @property
+    def start(self):
+        """Position of the first row on this page within the whole result"""
+        return self.page * self.page_size
+
+    def jump_to(self, page):
+        """Moves to page (counting from 0); False if it would be empty"""
+        rows = self.snapshot.page(page, self.page_size) if page >= 0 else []
+        if not rows and page:
+            return False
+        self.page = page
+        self.rows = rows
+        self.has_next = (page + 1) * self.page_size < len(self.snapshot)
+        return True
+
+    def next_page(self):
+        return self.has_next and self.jump_to(self.page + 1)
+
+    def previous_page(self):
+        return self.page > 0 and self.jump_to(self.page - 1)
+
+
+def indexable(word):
+    """Words worth correcting: at least three characters and not a number"""
+    return len(word) >= 3 and not word.isdigit()
+
+
+def trigrams(word):
+    """A word's trigrams, padded with two spaces before and one after so its start weighs most"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TermIndex:
+    """Distinct lower-cased words of titles and authors, found by the trigrams they share with a query word"""
+
+    def __init__(self):
+        self._pool = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.terms = []
+        self._ids = {}
+        self._sizes = array.array("H")   # trigrams per term
+        self._uses = array.array("I")    # times each term appears in titles and authors
+        self.items = 0
+        self._postings = {}              # trigram: array of the ids of the terms that have it
+        self.watermark = 0
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, word):
+        return word in self._ids
+
+    def share(self, word):
+        """Roughly the fraction of items with word in their title or author; 0 for unindexed words"""
+        term_id = self._ids.get(word)
+        return self._uses[term_id] / self.items if term_id is not None else 0.0
+
+    def _add(self, words):
+        for word, uses in words.items():
+            if word in self._ids:
+                self._uses[self._ids[word]] += uses
+                continue
+            if not indexable(word):
+                continue
+            term_id = len(self.terms)
+            grams = trigrams(word)
+            self.terms.append(word)
+            self._sizes.append(len(grams))
+            self._uses.append(uses)
+            for gram in grams:
+                postings = self._postings.get(gram)
+                if postings is None:
+                    postings = self._postings[gram] = array.array("I")
+                postings.append(term_id)
+            self._ids[word] = term_id
+
+    def refresh(self):
+        """Indexes the words of items added since the last refresh; returns how many items there were"""
+        with self._lock:
+            if self._pool is not database.get_pool():
+                self._reset()
+                self._pool = database.get_pool()
+            added = 0
+            with unit_of_work() as cursor:
+                cursor.execute(TERMS_AFTER, (self.watermark,))
+                while rows := cursor.fetchmany(FETCH_SIZE):
+                    ids, titles, authors = zip(*rows)
+                    text = " ".join(titles) + " " + " ".join(filter(None, authors))
+                    self._add(Counter(WORDS.findall(text.lower())))
+                    self.watermark = ids[-1]
+                    self.items += len(rows)
+                    added += len(rows)
+            return added
+
+    def similar(self, word, limit=5, min_similarity=MIN_SIMILARITY):
+        """[(term, similarity)] for the terms closest to word, most similar first
+
+        Similarity is the Jaccard index of the two trigram sets.
+        """
+        grams = trigrams(word.lower())
+        shared = Counter()
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings:
+                shared.update(postings)
+        sizes, terms = self._sizes, self.terms
+        scored = [(count / (len(grams) + sizes[term_id] - count), terms[term_id])
+                  for term_id, count in shared.items()]
+        scored = [(term, score) for score, term in scored if score >= min_similarity]
+        scored.sort(key=lambda entry: (-entry[1], entry[0]))
+        return scored[:limit]
@@ -0,0 +1,678 @@
+"""Connection management for the library database.
+
+A bounded pool of SQLite connections, each opened in WAL mode with the pragmas
+below, and unit_of_work(), which lends one of them out for a single transaction.
+A pool configured with group_commit=True also runs a GroupCommitWriter, which
+run_transaction() hands its writes to so that many of them share one commit.
+"""
+import concurrent.futures
+import contextlib
+import queue
+import random
+import sqlite3 as sql
+import threading
+import time
+
+import querylog
+
+DB_PATH = "library.db"
+POOL_SIZE = 8
+ACQUIRE_TIMEOUT = 30  # seconds to wait for a free connection
+BUSY_RETRIES = 6
+BUSY_BACKOFF = 0.01   # seconds before the first retry, doubled after each one
+# Seconds a group commit stays open for more writes once none are queued. With 0 a
+# batch is whatever queued up while the previous one committed, so a lone writer
+# waits for nobody.
+GROUP_COMMIT_WAIT = 0.0
+GROUP_COMMIT_SIZE = 256    # writes per group commit at most
+
+# Applied to every new connection. WAL lets readers run alongside the writer.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "busy_timeout": 5000,
+    "cache_size": -16000,   # negative means KiB, so 16 MB per connection
+    "temp_store": "MEMORY",
+}
+
+# PRAGMA synchronous for each durability level a pool can be configured with
+DURABILITY = {
+    "full": "FULL",       # each commit is synced to disk before it returns: survives power loss
+    "normal": "NORMAL",   # the WAL is synced at checkpoints: survives the process dying, not the machine
+    "off": "OFF",         # never synced: for bulk loads and throwaway databases
+}
+DEFAULT_DURABILITY = "normal"
+
+# Schema changes, applied in order. PRAGMA user_version records how many have run.
+MIGRATIONS = [
+    # 1: per-borrower fine lookups
+    """
+    CREATE INDEX IF NOT EXISTS idx_transactions_borrower
+        ON BorrowingTransactions(BorrowerID, PaidStatus);
+    """,
+    # 2: index pack for the lookup paths used by the menus
+    """
+    CREATE INDEX IF NOT EXISTS idx_copy_item_status ON LibraryCopy(ItemID, Status);
+    CREATE INDEX IF NOT EXISTS idx_item_title_author ON LibraryItem(Title, AuthorCreator);
+    CREATE INDEX IF NOT EXISTS idx_transactions_open
+        ON BorrowingTransactions(BorrowerID, DueDate) WHERE ReturnDate IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_transactions_open_due
+        ON BorrowingTransactions(DueDate) WHERE ReturnDate IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_events_datetime ON Events(DateTime);
+    CREATE INDEX IF NOT EXISTS idx_events_type_datetime ON Events(EventType, DateTime);
+    CREATE INDEX IF NOT EXISTS idx_personnel_name_email ON Personnel(Name, Email);
+    """,
+    # 3: full-text search over the catalog, kept in sync with LibraryItem by triggers
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS LibraryItemSearch USING fts5(
+        Title, AuthorCreator, ItemType,
+        content='LibraryItem', content_rowid='ItemID',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS LibraryItemSearchInsert AFTER INSERT ON LibraryItem BEGIN
+        INSERT INTO LibraryItemSearch(rowid, Title, AuthorCreator, ItemType)
+        VALUES (NEW.ItemID, NEW.Title, NEW.AuthorCreator, NEW.ItemType);
+    END;
+    CREATE TRIGGER IF NOT EXISTS LibraryItemSearchDelete AFTER DELETE ON LibraryItem BEGIN
+        INSERT INTO LibraryItemSearch(LibraryItemSearch, rowid, Title, AuthorCreator, ItemType)
+        VALUES ('delete', OLD.ItemID, OLD.Title, OLD.AuthorCreator, OLD.ItemType);
+    END;
+    CREATE TRIGGER IF NOT EXISTS LibraryItemSearchUpdate
+        AFTER UPDATE OF Title, AuthorCreator, ItemType ON LibraryItem BEGIN
+        INSERT INTO LibraryItemSearch(LibraryItemSearch, rowid, Title, AuthorCreator, ItemType)
+        VALUES ('delete', OLD.ItemID, OLD.Title, OLD.AuthorCreator, OLD.ItemType);
+        INSERT INTO LibraryItemSearch(rowid, Title, AuthorCreator, ItemType)
+        VALUES (NEW.ItemID, NEW.Title, NEW.AuthorCreator, NEW.ItemType);
+    END;
+    INSERT INTO LibraryItemSearch(LibraryItemSearch) VALUES ('rebuild');
+    """,
+    # 4: availability and registration counters, kept current by triggers
+    """
+    ALTER TABLE LibraryItem ADD COLUMN AvailableCopies INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE Events ADD COLUMN RegisteredCount INTEGER NOT NULL DEFAULT 0;
+
+    CREATE TRIGGER CopyCounterInsert AFTER INSERT ON LibraryCopy
+    WHEN NEW.Status = 'onShelf' BEGIN
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies + 1 WHERE ItemID = NEW.ItemID;
+    END;
+    CREATE TRIGGER CopyCounterDelete AFTER DELETE ON LibraryCopy
+    WHEN OLD.Status = 'onShelf' BEGIN
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies - 1 WHERE ItemID = OLD.ItemID;
+    END;
+    CREATE TRIGGER CopyCounterUpdate AFTER UPDATE OF Status, ItemID ON LibraryCopy
+    WHEN OLD.Status IS NOT NEW.Status OR OLD.ItemID IS NOT NEW.ItemID BEGIN
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies - 1
+        WHERE ItemID = OLD.ItemID AND OLD.Status = 'onShelf';
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies + 1
+        WHERE ItemID = NEW.ItemID AND NEW.Status = 'onShelf';
+    END;
+
+    CREATE TRIGGER RegistrationCounterInsert AFTER INSERT ON EventRegistration BEGIN
+        UPDATE Events SET RegisteredCount = RegisteredCount + 1 WHERE EventID = NEW.EventID;
+    END;
+    CREATE TRIGGER RegistrationCounterDelete AFTER DELETE ON EventRegistration BEGIN
+        UPDATE Events SET RegisteredCount = RegisteredCount - 1 WHERE EventID = OLD.EventID;
+    END;
+    CREATE TRIGGER RegistrationCounterUpdate AFTER UPDATE OF EventID ON EventRegistration
+    WHEN OLD.EventID IS NOT NEW.EventID BEGIN
+        UPDATE Events SET RegisteredCount = RegisteredCount - 1 WHERE EventID = OLD.EventID;
+        UPDATE Events SET RegisteredCount = RegisteredCount + 1 WHERE EventID = NEW.EventID;
+    END;
+
+    UPDATE LibraryItem SET AvailableCopies =
+        (SELECT COUNT(*) FROM LibraryCopy lc WHERE lc.ItemID = LibraryItem.ItemID AND lc.Status = 'onShelf');
+    UPDATE Events SET RegisteredCount =
+        (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = Events.EventID);
+    """,
+    # 5: how far each bulk import got, committed with the rows it covers
+    """
+    CREATE TABLE ImportCheckpoint (
+        Source TEXT PRIMARY KEY,
+        Records INTEGER NOT NULL,
+        UpdatedAt TEXT DEFAULT (datetime('now'))
+    );
+    """,
+    # 6: archive for returned, paid loans, and one view over both tables for history
+    """
+    CREATE TABLE BorrowingTransactionsArchive (
+        TransactionID INTEGER PRIMARY KEY,
+        BorrowerID INTEGER NOT NULL,
+        CopyID INTEGER NOT NULL,
+        BorrowDate TEXT,
+        DueDate TEXT,
+        ReturnDate TEXT NOT NULL,
+        FineAmount REAL DEFAULT 0.0,
+        PaidStatus TEXT CHECK (PaidStatus IN ('Paid', 'Unpaid')),
+        ArchivedAt TEXT DEFAULT (DATE('now'))
+    );
+    CREATE INDEX idx_archive_borrower ON BorrowingTransactionsArchive(BorrowerID, BorrowDate);
+    CREATE INDEX idx_transactions_borrower_date ON BorrowingTransactions(BorrowerID, BorrowDate);
+    CREATE INDEX idx_transactions_archivable ON BorrowingTransactions(ReturnDate)
+        WHERE ReturnDate IS NOT NULL AND (PaidStatus = 'Paid' OR COALESCE(FineAmount, 0) = 0);
+
+    CREATE VIEW LoanHistory AS
+        SELECT TransactionID, BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus
+        FROM BorrowingTransactions
+        UNION ALL
+        SELECT TransactionID, BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus
+        FROM BorrowingTransactionsArchive;
+    """,
+    # 7: loans per copy for the circulation report, counted off the index in both stores
+    """
+    CREATE INDEX idx_transactions_copy ON BorrowingTransactions(CopyID);
+    CREATE INDEX idx_archive_copy ON BorrowingTransactionsArchive(CopyID);
+    """,
+    # 8: hold queue. A copy set aside for a hold needs its own status, and SQLite can't
+    # alter a CHECK constraint, so LibraryCopy is rebuilt along with its index and triggers.
+    """
+    CREATE TABLE LibraryCopyNew (
+        CopyID INTEGER PRIMARY KEY,  -- Unique ID for each physical copy
+        Status TEXT NOT NULL CHECK (Status IN ('Borrow', 'onShelf', 'onHold')),
+        ItemID INTEGER NOT NULL,
+        FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID)
+    );
+    INSERT INTO LibraryCopyNew (CopyID, Status, ItemID) SELECT CopyID, Status, ItemID FROM LibraryCopy;
+    DROP TABLE LibraryCopy;
+    ALTER TABLE LibraryCopyNew RENAME TO LibraryCopy;
+    CREATE INDEX idx_copy_item_status ON LibraryCopy(ItemID, Status);
+
+    CREATE TRIGGER CopyCounterInsert AFTER INSERT ON LibraryCopy
+    WHEN NEW.Status = 'onShelf' BEGIN
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies + 1 WHERE ItemID = NEW.ItemID;
+    END;
+    CREATE TRIGGER CopyCounterDelete AFTER DELETE ON LibraryCopy
+    WHEN OLD.Status = 'onShelf' BEGIN
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies - 1 WHERE ItemID = OLD.ItemID;
+    END;
+    CREATE TRIGGER CopyCounterUpdate AFTER UPDATE OF Status, ItemID ON LibraryCopy
+    WHEN OLD.Status IS NOT NEW.Status OR OLD.ItemID IS NOT NEW.ItemID BEGIN
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies - 1
+        WHERE ItemID = OLD.ItemID AND OLD.Status = 'onShelf';
+        UPDATE LibraryItem SET AvailableCopies = AvailableCopies + 1
+        WHERE ItemID = NEW.ItemID AND NEW.Status = 'onShelf';
+    END;
+
+    CREATE TABLE ItemHold (
+        HoldID INTEGER PRIMARY KEY,
+        ItemID INTEGER NOT NULL,
+        BorrowerID INTEGER NOT NULL,
+        Status TEXT NOT NULL DEFAULT 'Waiting'
+            CHECK (Status IN ('Waiting', 'Ready', 'Collected', 'Expired', 'Cancelled')),
+        CopyID INTEGER,              -- the copy set aside, once Ready
+        PlacedAt TEXT DEFAULT (datetime('now')),
+        ReadyAt TEXT,
+        ExpiresAt TEXT,              -- end of the pickup window
+        FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID),
+        FOREIGN KEY (BorrowerID) REFERENCES Borrowers(BorrowerID),
+        FOREIGN KEY (CopyID) REFERENCES LibraryCopy(CopyID)
+    );
+    CREATE INDEX idx_holds_queue ON ItemHold(ItemID, HoldID) WHERE Status = 'Waiting';
+    CREATE INDEX idx_holds_ready ON ItemHold(ExpiresAt) WHERE Status = 'Ready';
+    CREATE INDEX idx_holds_borrower ON ItemHold(BorrowerID, ItemID);
+    """,
+    # 9: waitlist for full events, promoted in order as registrations are cancelled
+    """
+    CREATE TABLE EventWaitlist (
+        WaitlistID INTEGER PRIMARY KEY,
+        EventID INTEGER NOT NULL,
+        BorrowerID INTEGER NOT NULL,
+        AddedAt TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (EventID) REFERENCES Events(EventID),
+        FOREIGN KEY (BorrowerID) REFERENCES Borrowers(BorrowerID),
+        UNIQUE(EventID, BorrowerID)
+    );
+    CREATE INDEX idx_waitlist_queue ON EventWaitlist(EventID, WaitlistID);
+    """,
+    # 10: recommendations precomputed by recommend.py, each list read by its primary key
+    """
+    CREATE TABLE ItemSimilarity (
+        ItemID INTEGER NOT NULL,
+        Rank INTEGER NOT NULL,
+        SimilarItemID INTEGER NOT NULL,
+        Score REAL NOT NULL,
+        CoBorrowers INTEGER NOT NULL,
+        PRIMARY KEY (ItemID, Rank)
+    ) WITHOUT ROWID;
+    CREATE TABLE TrendingItems (
+        Rank INTEGER PRIMARY KEY,
+        ItemID INTEGER NOT NULL,
+        Score REAL NOT NULL,
+        RecentLoans INTEGER NOT NULL
+    );
+    CREATE TABLE RequestedTitles (
+        Rank INTEGER PRIMARY KEY,
+        Title TEXT NOT NULL,
+        ItemType TEXT,
+        Requests INTEGER NOT NULL
+    );
+    """,
+    # 11: offline kiosk journals (journal.py): how far each has been replayed, and what it couldn't apply
+    """
+    CREATE TABLE JournalReplay (
+        JournalID TEXT PRIMARY KEY,
+        Kiosk TEXT NOT NULL,
+        Applied INTEGER NOT NULL,
+        UpdatedAt TEXT DEFAULT (datetime('now'))
+    );
+    CREATE TABLE JournalConflict (
+        JournalID TEXT NOT NULL,
+        Sequence INTEGER NOT NULL,
+        Kiosk TEXT NOT NULL,
+        Operation TEXT NOT NULL,
+        BorrowerID INTEGER,
+        CopyID INTEGER NOT NULL,
+        At INTEGER NOT NULL,
+        Reason TEXT NOT NULL,
+        RecordedAt TEXT DEFAULT (datetime('now')),
+        PRIMARY KEY (JournalID, Sequence)
+    );
+    """,
+    # 12: loan notices (notices.py): how far each kind's scan has got, and every loan a notice went out for
+    """
+    CREATE TABLE NoticeScan (
+        Kind TEXT PRIMARY KEY,
+        DueDate TEXT NOT NULL,
+        TransactionID INTEGER NOT NULL,
+        UpdatedAt TEXT DEFAULT (datetime('now'))
+    );
+    CREATE TABLE LoanNotice (
+        TransactionID INTEGER NOT NULL,
+        Kind TEXT NOT NULL,
+        SentAt TEXT DEFAULT (datetime('now')),
+        PRIMARY KEY (TransactionID, Kind)
+    ) WITHOUT ROWID;
+    """,
+    # 13: branches. Copies, loans, events and holds (as their pickup branch) get a BranchID,
+    # existing rows going to branch 1. BranchStock counts on-shelf copies per item and branch,
+    # kept current by triggers like AvailableCopies. ItemHold is rebuilt to allow 'InTransit',
+    # a hold whose copy is on its way from another branch (CopyTransfer).
+    """
+    CREATE TABLE Branch (
+        BranchID INTEGER PRIMARY KEY,
+        Name TEXT NOT NULL UNIQUE,
+        Latitude REAL NOT NULL DEFAULT 0,
+        Longitude REAL NOT NULL DEFAULT 0
+    );
+    INSERT INTO Branch (BranchID, Name) VALUES (1, 'Main Library');
+
+    ALTER TABLE LibraryCopy ADD COLUMN BranchID INTEGER NOT NULL DEFAULT 1 REFERENCES Branch(BranchID);
+    ALTER TABLE BorrowingTransactions ADD COLUMN BranchID INTEGER NOT NULL DEFAULT 1 REFERENCES Branch(BranchID);
+    ALTER TABLE BorrowingTransactionsArchive ADD COLUMN BranchID INTEGER NOT NULL DEFAULT 1;
+    ALTER TABLE Events ADD COLUMN BranchID INTEGER NOT NULL DEFAULT 1 REFERENCES Branch(BranchID);
+    CREATE INDEX idx_copy_item_branch_status ON LibraryCopy(ItemID, BranchID, Status);
+    CREATE INDEX idx_events_branch_datetime ON Events(BranchID, DateTime);
+
+    CREATE TABLE BranchStock (
+        ItemID INTEGER NOT NULL,
+        BranchID INTEGER NOT NULL,
+        AvailableCopies INTEGER NOT NULL,
+        PRIMARY KEY (ItemID, BranchID)
+    ) WITHOUT ROWID;
+    INSERT INTO BranchStock (ItemID, BranchID, AvailableCopies)
+        SELECT ItemID, BranchID, COUNT(*) FROM LibraryCopy WHERE Status = 'onShelf' GROUP BY ItemID, BranchID;
+
+    CREATE TRIGGER BranchStockInsert AFTER INSERT ON LibraryCopy
+    WHEN NEW.Status = 'onShelf' BEGIN
+        INSERT INTO BranchStock (ItemID, BranchID, AvailableCopies) VALUES (NEW.ItemID, NEW.BranchID, 1)
+        ON CONFLICT (ItemID, BranchID) DO UPDATE SET AvailableCopies = AvailableCopies + 1;
+    END;
+    CREATE TRIGGER BranchStockDelete AFTER DELETE ON LibraryCopy
+    WHEN OLD.Status = 'onShelf' BEGIN
+        UPDATE BranchStock SET AvailableCopies = AvailableCopies - 1
+        WHERE ItemID = OLD.ItemID AND BranchID = OLD.BranchID;
+    END;
+    CREATE TRIGGER BranchStockUpdate AFTER UPDATE OF Status, ItemID, BranchID ON LibraryCopy
+    WHEN OLD.Status IS NOT NEW.Status OR OLD.ItemID IS NOT NEW.ItemID OR OLD.BranchID IS NOT NEW.BranchID BEGIN
+        UPDATE BranchStock SET AvailableCopies = AvailableCopies - 1
+        WHERE ItemID = OLD.ItemID AND BranchID = OLD.BranchID AND OLD.Status = 'onShelf';
+        INSERT INTO BranchStock (ItemID, BranchID, AvailableCopies)
+            SELECT NEW.ItemID, NEW.BranchID, 1 WHERE NEW.Status = 'onShelf'
+        ON CONFLICT (ItemID, BranchID) DO UPDATE SET AvailableCopies = AvailableCopies + 1;
+    END;
+
+    CREATE TABLE ItemHoldNew (
+        HoldID INTEGER PRIMARY KEY,
+        ItemID INTEGER NOT NULL,
+        BorrowerID INTEGER NOT NULL,
+        Status TEXT NOT NULL DEFAULT 'Waiting'
+            CHECK (Status IN ('Waiting', 'InTransit', 'Ready', 'Collected', 'Expired', 'Cancelled')),
+        CopyID INTEGER,              -- the copy set aside, once InTransit or Ready
+        PlacedAt TEXT DEFAULT (datetime('now')),
+        ReadyAt TEXT,
+        ExpiresAt TEXT,              -- end of the pickup window
+        BranchID INTEGER NOT NULL DEFAULT 1,   -- where the borrower picks the copy up
+        FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID),
+        FOREIGN KEY (BorrowerID) REFERENCES Borrowers(BorrowerID),
+        FOREIGN KEY (CopyID) REFERENCES LibraryCopy(CopyID),
+        FOREIGN KEY (BranchID) REFERENCES Branch(BranchID)
+    );
+    INSERT INTO ItemHoldNew (HoldID, ItemID, BorrowerID, Status, CopyID, PlacedAt, ReadyAt, ExpiresAt)
+        SELECT HoldID, ItemID, BorrowerID, Status, CopyID, PlacedAt, ReadyAt, ExpiresAt FROM ItemHold;
+    DROP TABLE ItemHold;
+    ALTER TABLE ItemHoldNew RENAME TO ItemHold;
+    CREATE INDEX idx_holds_queue ON ItemHold(ItemID, HoldID) WHERE Status = 'Waiting';
+    CREATE INDEX idx_holds_ready ON ItemHold(ExpiresAt) WHERE Status = 'Ready';
+    CREATE INDEX idx_holds_borrower ON ItemHold(BorrowerID, ItemID);
+
+    CREATE TABLE CopyTransfer (
+        TransferID INTEGER PRIMARY KEY,
+        CopyID INTEGER NOT NULL,
+        HoldID INTEGER NOT NULL,
+        FromBranchID INTEGER NOT NULL,
+        ToBranchID INTEGER NOT NULL,
+        Status TEXT NOT NULL DEFAULT 'Requested' CHECK (Status IN ('Requested', 'Received', 'Cancelled')),
+        RequestedAt TEXT DEFAULT (datetime('now')),
+        ReceivedAt TEXT,
+        FOREIGN KEY (CopyID) REFERENCES LibraryCopy(CopyID),
+        FOREIGN KEY (HoldID) REFERENCES ItemHold(HoldID)
+    );
+    CREATE INDEX idx_transfers_requested ON CopyTransfer(FromBranchID, TransferID) WHERE Status = 'Requested';
+    CREATE INDEX idx_transfers_hold ON CopyTransfer(HoldID) WHERE Status = 'Requested';
+    """,
+]
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection is returned to the pool within ACQUIRE_TIMEOUT"""
+
+
+class ConnectionPool:
+    """A fixed-size set of connections to one database file, handed out one thread at a time"""
+
+    writer = None   # a GroupCommitWriter, when configured with group_commit=True
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, trace=None, query_log=None, durability=DEFAULT_DURABILITY):
+        if durability not in DURABILITY:
+            raise ValueError(f"durability must be one of {', '.join(DURABILITY)}")
+        self.path = path
+        self.size = size
+        self.trace = trace
+        self.query_log = query_log
+        self.durability = durability
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # isolation_level=None leaves transaction control to unit_of_work()
+        conn = sql.connect(self.path, isolation_level=None, check_same_thread=False,
+                           factory=querylog.ProfiledConnection if self.query_log else sql.Connection)
+        if self.query_log:
+            conn.query_log = self.query_log
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.execute(f"PRAGMA synchronous = {DURABILITY[self.durability]}")
+        if self.trace:
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+        """Takes an idle connection, opening a new one while the pool is below its size"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return self._connect()
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise PoolExhausted(f"no database connection free after {timeout}s") from None
+
+    def release(self, conn):
+        """Returns a connection to the pool, rolling back anything left open on it
+
+        Once the pool is closed the connection is closed instead.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            # Checked under the lock close() sets it with, so a connection is either
+            # queued before close() drains the queue or closed here
+            if not self._closed:
+                self._idle.put(conn)
+                return
+            self._opened -= 1
+        conn.close()
+
+    def close(self):
+        """Closes the idle connections; connections still lent out are closed by their release"""
+        if self.writer is not None:
+            self.writer.close()
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+
+
+class GroupCommitWriter:
+    """Runs the write transactions of any number of threads on one connection, many to a commit
+
+    submit() queues a work function and blocks until the transaction it ran in has
+    committed. The writer thread takes everything queued, keeps the batch open up to
+    max_wait for more, and runs it as one BEGIN IMMEDIATE ... COMMIT with each work
+    function under its own SAVEPOINT, so one that raises is rolled back alone and
+    only its caller sees the exception. At durability "full" a whole batch then
+    costs one sync instead of one per write.
+    """
+
+    def __init__(self, pool, max_wait=GROUP_COMMIT_WAIT, max_size=GROUP_COMMIT_SIZE):
+        self.pool = pool
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, work):
+        """Runs work(cursor) in the next group commit and returns its result once that has committed"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("a write run by the group-commit writer cannot queue another")
+        done = concurrent.futures.Future()
+        self._queue.put((work, done))
+        return done.result()
+
+    def close(self):
+        """Commits the writes already queued, then stops the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _take(self):
+        """The next batch of (work, future) pairs, or None once closed"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            try:
+                entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if entry is None:
+                self._queue.put(None)   # stop once this batch is done
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        conn = self.pool.acquire()
+        try:
+            while (batch := self._take()) is not None:
+                self._commit(conn, batch)
+        finally:
+            self.pool.release(conn)
+
+    def _commit(self, conn, batch):
+        for attempt in range(BUSY_RETRIES + 1):
+            outcomes = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for work, done in batch:
+                    cursor = conn.cursor()
+                    conn.execute("SAVEPOINT write")
+                    try:
+                        outcomes.append((done, work(cursor), None))
+                    except Exception as error:
+                        cursor.close()
+                        conn.execute("ROLLBACK TO write")
+                        outcomes.append((done, None, error))
+                    cursor.close()
+                    conn.execute("RELEASE write")
+                conn.commit()
+            except Exception as error:
+                if conn.in_transaction:
+                    conn.rollback()
+                # Another process holding the write lock: run the whole batch again later
+                if isinstance(error, sql.OperationalError) and is_busy(error) and attempt < BUSY_RETRIES:
+                    time.sleep(BUSY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+                    continue
+                for _, done in batch:
+                    done.set_exception(error)
+                return
+            self.commits += 1
+            self.writes += len(batch)
+            for done, result, error in outcomes:
+                if error is None:
+                    done.set_result(result)
+                else:
+                    done.set_exception(error)
+            return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(path=DB_PATH, size=POOL_SIZE, trace=None, query_log=None, durability=DEFAULT_DURABILITY,
+              group_commit=False):
+    """Points the module at a database file, migrating it and replacing any existing pool
+
+    trace, if given, is called with the text of every statement the pool's connections run.
+    query_log, a querylog.QueryLog, times and counts them by statement (see querylog.py).
+    durability is one of DURABILITY. group_commit=True sends run_transaction()'s writes
+    through a GroupCommitWriter, which keeps one of the pool's connections.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(path, size, trace, query_log, durability)
+    migrate()
+    if group_commit:
+        _pool.writer = GroupCommitWriter(_pool)
+    return _pool
+
+
+def get_pool():
+    """Returns the current pool, opening the default database on first use"""
+    if _pool is None:
+        configure()
+    return _pool
+
+
+def close():
+    """Closes the pool's connections; the next unit of work reopens the default database"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextlib.contextmanager
+def unit_of_work(immediate=False):
+    """Runs the enclosed statements as one transaction on a pooled connection
+
+    Commits when the block finishes and rolls back if it raises. immediate=True takes
+    the write lock up front (BEGIN IMMEDIATE) instead of on the first write.
+    """
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.close()
+            conn.rollback()
+            raise
+        # Closing first resets any half-read SELECT, which would otherwise keep its
+        # snapshot open after COMMIT and make this connection's next write fail as busy
+        cursor.close()
+        conn.commit()
+    finally:
+        pool.release(conn)
+
+
+def is_busy(error):
+    """Tells whether an OperationalError means another connection holds the lock"""
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sql.SQLITE_BUSY, sql.SQLITE_LOCKED)
+    return "locked" in str(error)
+
+
+def run_transaction(work, immediate=True, retries=BUSY_RETRIES):
+    """Calls work(cursor) inside one unit of work and returns its result
+
+    The transaction starts with BEGIN IMMEDIATE by default, so it holds the write lock
+    from its first read. If the database stays busy past busy_timeout the whole unit is
+    retried after an exponential, jittered backoff. When the pool has a group-commit
+    writer, work runs there instead, sharing a commit with the other writes queued.
+    """
+    writer = get_pool().writer
+    if immediate and writer is not None:
+        return writer.submit(work)
+    for attempt in range(retries + 1):
+        try:
+            with unit_of_work(immediate=immediate) as cursor:
+                return work(cursor)
+        except sql.OperationalError as error:
+            if attempt == retries or not is_busy(error):
+                raise
+            time.sleep(BUSY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def _statements(script):
+    """Splits a migration script into whole statements, trigger bodies included"""
+    statement = ""
+    for piece in script.split(";"):
+        statement += piece + ";"
+        if sql.complete_statement(statement):
+            if statement.strip(" \n;"):
+                yield statement
+            statement = ""
+
+
+def migrate():
+    """Brings the database schema up to date by applying any pending migrations
+
+    user_version is read under the write lock (BEGIN IMMEDIATE), so processes opening
+    the same file together apply each migration once: the others wait, then find it done.
+    """
+    conn = get_pool().acquire()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in _statements(script):
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        get_pool().release(conn)
@@ -0,0 +1,228 @@
+"""Seeded generator for library databases at realistic sizes.
+
+Usage: python datagen.py OUT.db [--loans 1000000] [--seed 0]
+
+Every other table is sized from the number of loans. Popularity follows a Zipf
+curve, so a few titles take most of the loans, a few patrons borrow most, and
+popular titles carry extra copies. A slice of the loans is still open and some of
+those are overdue. Returned late loans carry a fine, mostly paid. Events spread
+from half a year back to a year ahead, filled to anywhere between empty and full.
+Dates count back from the day it runs, so a seed and size give the same rows on
+any one day.
+"""
+import argparse
+import bisect
+import datetime
+import itertools
+import os
+import random
+import sqlite3 as sql
+import sys
+
+import database
+import services
+
+WORDS = ("the", "history", "of", "garden", "night", "river", "war", "peace", "shadow", "kingdom",
+         "secret", "python", "data", "ocean", "winter", "summer", "lost", "city", "star", "machine",
+         "learning", "cooking", "journey", "empire", "silent", "golden", "dragon", "mind", "code", "light")
+ITEM_TYPES = ("Book", "DVD", "Blu-ray", "CD", "Magazine", "eBook")
+EVENT_TYPES = ("Talk", "Reading", "Workshop", "Book Discussion", "Performance", "Social", "Storytelling")
+LOCATIONS = ("Main Library Hall", "Children's Room", "Computer Lab", "Meeting Room A", "Garden Patio")
+
+OPEN_FRACTION = 0.08      # of loans not yet returned
+OVERDUE_FRACTION = 0.15   # of open loans past their due date
+LATE_FRACTION = 0.10      # of returned loans brought back after the due date
+PAID_FRACTION = 0.80      # of late-return fines already paid
+LATE_FINE = 50.0          # the flat FineAmount the ApplyFineIfLate trigger writes on a late return
+BATCH = 50000
+
+
+# Rows a migration seeds that the schema relies on, kept when the tables are emptied
+SEED_ROWS = {"Branch": "BranchID = 1"}   # the main library (migration 13)
+
+
+def create_database(path):
+    """Creates an empty database at path with the same schema as library.db"""
+    source = sql.connect(database.DB_PATH)
+    target = sql.connect(path)
+    source.backup(target)
+    source.close()
+    tables = [row[0] for row in target.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    virtual = [row[0] for row in target.execute("SELECT name FROM sqlite_master WHERE sql LIKE 'CREATE VIRTUAL%'")]
+    for table in tables:
+        # Full-text tables and their shadow tables are emptied by LibraryItem's triggers
+        if not any(table == name or table.startswith(f"{name}_") for name in virtual):
+            keep = SEED_ROWS.get(table)
+            target.execute(f"DELETE FROM {table}" + (f" WHERE NOT ({keep})" if keep else ""))
+    target.commit()
+    return target
+
+
+def vocabulary(rng, size=5000):
+    """Returns WORDS followed by made-up words, with Zipf-like weights favouring the front"""
+    syllables = ("ka", "lo", "mi", "ra", "tes", "vin", "dor", "el", "sha", "qu", "bri", "on", "ex", "ul", "zan")
+    words = list(WORDS)
+    while len(words) < size:
+        words.append("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    return words, weights
+
+
+class Popularity:
+    """Draws ids 1..count with Zipf weights over a seeded shuffle, so popular ids are scattered"""
+
+    def __init__(self, rng, count, exponent=1.0):
+        self.rng = rng
+        self.ids = list(range(1, count + 1))
+        rng.shuffle(self.ids)
+        self.cumulative = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+    def rank_of(self):
+        """Maps each id to its popularity rank, 0 being the most popular"""
+        return {item_id: rank for rank, item_id in enumerate(self.ids)}
+
+    def draw(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.ids[min(bisect.bisect(self.cumulative, point), len(self.ids) - 1)]
+
+
+def batched(rows, size=BATCH):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def day(today, days_ago):
+    return (today - datetime.timedelta(days=days_ago)).isoformat()
+
+
+def generate(path, loans, seed=0, today=None):
+    """Builds a migrated database at path sized for the given number of loans; returns row counts"""
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    items = max(1000, loans // 20)
+    borrowers = max(100, loans // 10)
+    events = max(50, loans // 1000)
+
+    create_database(path).close()
+    database.configure(path)   # applies migrations, so counters and search index fill as rows go in
+    database.close()
+    db = sql.connect(path)
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA journal_mode = WAL")
+
+    words, weights = vocabulary(rng)
+
+    def item_rows():
+        for item_id in range(1, items + 1):
+            title = " ".join(rng.choices(words, weights, k=rng.randint(2, 5))).title()
+            yield (item_id, f"{title} {item_id}", rng.choice(ITEM_TYPES), f"Author {rng.randint(1, items // 20 + 1)}",
+                   rng.randint(1900, today.year))
+
+    for batch in batched(item_rows()):
+        db.executemany("INSERT INTO LibraryItem (ItemID, Title, ItemType, AuthorCreator, YearPublished) "
+                       "VALUES (?, ?, ?, ?, ?)", batch)
+
+    # Popular titles get extra copies: four for the top 2%, two for the next 18%
+    titles = Popularity(rng, items, exponent=0.8)
+    rank = titles.rank_of()
+    copies_of = {}
+    copy_id = 0
+    for item_id in range(1, items + 1):
+        count = 4 if rank[item_id] < items * 0.02 else 2 if rank[item_id] < items * 0.2 else 1
+        copies_of[item_id] = list(range(copy_id + 1, copy_id + count + 1))
+        copy_id += count
+    for batch in batched((copy, item_id) for item_id, copies in copies_of.items() for copy in copies):
+        db.executemany("INSERT INTO LibraryCopy (CopyID, Status, ItemID) VALUES (?, 'onShelf', ?)", batch)
+
+    db.executemany("INSERT INTO Borrowers (BorrowerID, Name, Email, PhoneNumber, Address) VALUES (?, ?, ?, ?, ?)",
+                   ((i, f"Borrower {i}", f"borrower{i}@example.com", f"555-{i % 10000:04d}", f"{i} Main St")
+                    for i in range(1, borrowers + 1)))
+    patrons = Popularity(rng, borrowers, exponent=0.6)
+
+    # Open loans each hold a distinct copy, taken from the shelf of a popular title or,
+    # once that shelf is empty, of the most popular title that still has one
+    open_loans = min(int(loans * OPEN_FRACTION), copy_id // 2)
+    shelf = {item_id: list(copies) for item_id, copies in copies_of.items()}
+    by_popularity = iter(titles.ids)
+    on_loan = []
+    while len(on_loan) < open_loans:
+        item_id = titles.draw()
+        while not shelf[item_id]:
+            item_id = next(by_popularity)
+        on_loan.append(shelf[item_id].pop())
+
+    def loan_rows():
+        for copy in on_loan:
+            if rng.random() < OVERDUE_FRACTION:
+                borrowed = rng.randint(services.LOAN_DAYS + 1, 90)
+            else:
+                borrowed = rng.randint(0, services.LOAN_DAYS)
+            yield (patrons.draw(), copy, day(today, borrowed), day(today, borrowed - services.LOAN_DAYS),
+                   None, 0, "Unpaid")
+        for _ in range(loans - open_loans):
+            copy = rng.choice(copies_of[titles.draw()])
+            borrowed = rng.randint(services.LOAN_DAYS, 3 * 365)
+            if rng.random() < LATE_FRACTION:
+                kept = services.LOAN_DAYS + rng.randint(1, 30)
+            else:
+                kept = rng.randint(1, services.LOAN_DAYS)
+            returned = max(0, borrowed - kept)   # days ago, so not after today
+            fine = LATE_FINE if borrowed - returned > services.LOAN_DAYS else 0
+            # As the desk writes them: a late return gets ApplyFineIfLate's flat fine, a
+            # fine-free return stays 'Unpaid' with nothing owed, and paying a fine marks
+            # the loan 'Paid' and clears its FineAmount
+            paid = "Paid" if fine and rng.random() < PAID_FRACTION else "Unpaid"
+            yield (patrons.draw(), copy, day(today, borrowed), day(today, borrowed - services.LOAN_DAYS),
+                   day(today, returned), 0 if paid == "Paid" else fine, paid)
+
+    for batch in batched(loan_rows()):
+        db.executemany("INSERT INTO BorrowingTransactions (BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, "
+                       "FineAmount, PaidStatus) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+    for batch in batched(on_loan):
+        db.executemany("UPDATE LibraryCopy SET Status='Borrow' WHERE CopyID=?", ((copy,) for copy in batch))
+
+    def event_rows():
+        for event_id in range(1, events + 1):
+            when = datetime.datetime.combine(today, datetime.time(rng.choice((10, 14, 18)), rng.choice((0, 30))))
+            when += datetime.timedelta(days=rng.randint(-180, 365))
+            event_type = rng.choice(EVENT_TYPES)
+            yield (event_id, f"{event_type} {event_id}", event_type, rng.choice(("All Ages", "Adults", "Children")),
+                   when.strftime("%Y-%m-%d %H:%M"), rng.choice(LOCATIONS), rng.choice((10, 25, 40, 100, 200)))
+
+    event_list = list(event_rows())
+    db.executemany("INSERT INTO Events (EventID, EventName, EventType, RecommendedAudience, DateTime, Location, "
+                   "Capacity) VALUES (?, ?, ?, ?, ?, ?, ?)", event_list)
+
+    def registration_rows():
+        for event_id, *_, capacity in event_list:
+            # About one event in six sells out; the rest fill to a bell curve around half
+            fill = 1.0 if rng.random() < 0.15 else rng.betavariate(2, 2)
+            for borrower in rng.sample(range(1, borrowers + 1), min(borrowers, int(capacity * fill))):
+                yield event_id, borrower
+
+    for batch in batched(registration_rows()):
+        db.executemany("INSERT INTO EventRegistration (EventID, BorrowerID) VALUES (?, ?)", batch)
+
+    roles = ("Reference Librarian", "Children's Librarian", "Cataloging Librarian", "Library Assistant", "Volunteer")
+    db.executemany("INSERT INTO Personnel (Name, Role, Email, PhoneNumber) VALUES (?, ?, ?, ?)",
+                   ((f"Staff {i}", roles[i % len(roles)], f"staff{i}@library.org", f"555-9{i:03d}")
+                    for i in range(1, max(10, loans // 20000) + 1)))
+    db.commit()
+    counts = {table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ("LibraryItem", "LibraryCopy", "Borrowers", "BorrowingTransactions", "Events",
+                            "EventRegistration", "Personnel")}
+    db.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a library database of a given size")
+    parser.add_argument("path", help="database file to create")
+    parser.add_argument("--loans", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        sys.exit(f"{args.path} already exists")
+    for table, count in generate(args.path, args.loans, args.seed).items():
+        print(f"{table:<22} {count:>10}")
@@ -0,0 +1,150 @@
+"""Bulk import of catalog records from CSV or JSONL files.
+
+Usage: python ingest.py FILE [--batch 10000] [--restart] [--branch 1]
+
+Each record is one donated copy, with the same fields donate_item() asks for:
+Title, ItemType, AuthorCreator and YearPublished, plus an optional Copies count.
+Records matching an existing item on (Title, AuthorCreator) add copies to it.
+The copies go on the shelf at --branch, the main library unless given.
+Progress is committed with every batch, so an interrupted import picks up after
+the last batch it finished when run again on the same file.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import database
+import services
+from database import unit_of_work
+
+BATCH_SIZE = 10000
+MAX_TEXT = 255     # length(Title) and length(AuthorCreator) CHECKs on LibraryItem
+
+ITEM_INDEX = "SELECT Title, AuthorCreator, ItemID FROM LibraryItem"
+NEXT_ITEM_ID = "SELECT COALESCE(MAX(ItemID), 0) + 1 FROM LibraryItem"
+HELD_ITEMS = "SELECT DISTINCT ItemID FROM ItemHold WHERE Status='Waiting'"
+INSERT_ITEM_WITH_ID = "INSERT INTO LibraryItem (ItemID, Title, ItemType, AuthorCreator, YearPublished) VALUES (?, ?, ?, ?, ?)"
+GET_CHECKPOINT = "SELECT Records FROM ImportCheckpoint WHERE Source=?"
+SAVE_CHECKPOINT = """
+    INSERT INTO ImportCheckpoint (Source, Records) VALUES (?, ?)
+    ON CONFLICT(Source) DO UPDATE SET Records=excluded.Records, UpdatedAt=datetime('now')
+"""
+
+
+def read_records(path):
+    """Yields each record in a .csv or .jsonl file as a dict, one line at a time"""
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_record(record):
+    """Returns (title, item type, author, year, copies), or None if the record is unusable"""
+    title = (record.get("Title") or "").strip()
+    author = (record.get("AuthorCreator") or "").strip()
+    copies = str(record.get("Copies") or 1)
+    item_type = record.get("ItemType") or None
+    year = record.get("YearPublished") or None
+    # AuthorCreator is NOT NULL, and with the title it is how a record finds its item;
+    # both are CHECKed to MAX_TEXT, and one failed insert would roll back the whole batch
+    if not 0 < len(title) <= MAX_TEXT or not 0 < len(author) <= MAX_TEXT or not copies.isdigit():
+        return None
+    return title, item_type, author, year, int(copies)
+
+
+def load_item_index(cursor):
+    """Maps (Title, AuthorCreator) to ItemID for every item already in the catalog"""
+    cursor.execute(ITEM_INDEX)
+    return {(title, author): item_id for title, author, item_id in cursor}
+
+
+def import_batch(cursor, records, index, branch_id=services.MAIN_BRANCH):
+    """Writes one batch of parsed records; returns ({(title, author): ItemID} of new items, copies)
+
+    index is only read: the caller adds the new items to it once the batch commits,
+    so a rolled-back attempt leaves no ItemIDs behind that were never written.
+    Copies of items with waiting holds go to those holds first, as donate() does.
+    """
+    next_id = cursor.execute(NEXT_ITEM_ID).fetchone()[0]
+    held = {item_id for item_id, in cursor.execute(HELD_ITEMS)}
+    added, items, copies, for_holds = {}, [], [], []
+    for title, item_type, author, year, count in records:
+        item_id = index.get((title, author)) or added.get((title, author))
+        if item_id is None:
+            # Ids are assigned here rather than read back from lastrowid so the batch
+            # can go through executemany; the write lock keeps them from colliding
+            item_id = added[(title, author)] = next_id
+            next_id += 1
+            items.append((item_id, title, item_type, author, year))
+        (for_holds if item_id in held else copies).extend([(item_id, branch_id)] * count)
+    cursor.executemany(INSERT_ITEM_WITH_ID, items)
+    cursor.executemany(services.INSERT_COPY, copies)
+    for item_id, branch_id in for_holds:
+        cursor.execute(services.INSERT_COPY, (item_id, branch_id))
+        copy_id = cursor.lastrowid
+        if services.assign_hold(cursor, copy_id, item_id):
+            cursor.execute(services.MOVE_COPY, ("onHold", copy_id, "onShelf"))
+    return added, len(copies) + len(for_holds)
+
+
+def ingest(path, batch_size=BATCH_SIZE, restart=False, branch_id=services.MAIN_BRANCH):
+    """Imports every record in path in batches, resuming from the last committed batch"""
+    source = os.path.abspath(path)
+    with unit_of_work() as cursor:
+        row = cursor.execute(GET_CHECKPOINT, (source,)).fetchone()
+        index = load_item_index(cursor)
+    done = 0 if restart or row is None else row[0]
+    if done:
+        print(f"Resuming after record {done}")
+
+    records = itertools.islice(read_records(path), done, None)
+    totals = {"items": 0, "copies": 0, "skipped": 0}
+    start = time.perf_counter()
+    while batch := list(itertools.islice(records, batch_size)):
+        parsed = [parse_record(record) for record in batch]
+        valid = [record for record in parsed if record]
+        done += len(batch)
+
+        def write(cursor):
+            result = import_batch(cursor, valid, index, branch_id)
+            cursor.execute(SAVE_CHECKPOINT, (source, done))
+            return result
+
+        added, copies = database.run_transaction(write)
+        index.update(added)
+        totals["items"] += len(added)
+        totals["copies"] += copies
+        totals["skipped"] += len(batch) - len(valid)
+        elapsed = time.perf_counter() - start
+        print(f"{done:>10} records | {totals['items']:>9} new items | {totals['copies']:>9} copies "
+              f"| {totals['copies'] / elapsed:>8.0f} rows/s")
+
+    elapsed = time.perf_counter() - start
+    print(f"\nImported {totals['copies']} copies of {totals['items']} new items in {elapsed:.1f}s"
+          f", skipped {totals['skipped']} records with a missing or over-long title or author, or a bad copy count.")
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import catalog records from CSV or JSONL")
+    parser.add_argument("path", help="a .csv file with a header row, or a .jsonl file")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="records per transaction")
+    parser.add_argument("--restart", action="store_true", help="ignore any saved checkpoint for this file")
+    parser.add_argument("--branch", type=int, default=services.MAIN_BRANCH, help="branch whose shelf the copies go on")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        sys.exit(f"No such file: {args.path}")
+    try:
+        ingest(args.path, args.batch, args.restart, args.branch)
+    except KeyboardInterrupt:
+        print("\nInterrupted; run the same command again to resume.")
+    finally:
+        database.close()
@@ -0,0 +1,320 @@
+"""Offline circulation journal for branch kiosks, replayed against the main database in bulk.
+
+Usage: python journal.py replay FILE [--db library.db] [--batch 10000]
+       python journal.py show FILE
+
+A kiosk that has lost its link to library.db keeps lending and taking back copies
+by appending each operation to a journal file (see Journal). A journal is a 64-byte
+header naming the kiosk and carrying a random journal id, then fixed 32-byte
+records, each with its sequence number (1, 2, 3 ... in file order), the time, the
+borrower and copy, and a CRC32 of the rest. Appends are single writes followed by
+an fsync, so a crash can at worst leave a torn last record, which readers ignore
+and the next Journal cuts off.
+
+replay() reads the file through mmap and applies it in batches, one transaction
+each. JournalReplay (migration 11) records the last sequence applied per journal
+id in the same transaction as the batch, so replaying a journal again, or after
+an interruption, applies each record exactly once. Records that can't be applied
+(an unknown borrower or copy, a copy already out on another loan, a return of a
+copy that isn't on loan) are skipped and written to JournalConflict for staff.
+Replayed loans and returns carry the dates they happened at the kiosk. Fines
+don't hold up a replayed loan: the copy has already gone home with the patron.
+A batch with loans moves the notice scans (see notices.py) back to the earliest
+due date among them, so the reminders and overdue notices still go out.
+"""
+import argparse
+import collections
+import contextlib
+import mmap
+import os
+import struct
+import sys
+import time
+import uuid
+import zlib
+
+import database
+import notices
+import services
+
+BATCH_SIZE = 10000
+MAGIC = b"LIBJ"
+VERSION = 1
+BORROW, RETURN = 1, 2
+OPERATIONS = {BORROW: "borrow", RETURN: "return"}
+
+# magic, version, journal id, kiosk name (UTF-8, NUL padded)
+HEADER = struct.Struct("<4sH2x16s40s")
+# sequence, unix time, BorrowerID (0 for returns), CopyID, operation, CRC32 of the bytes before it
+RECORD = struct.Struct("<QqIIB3xI")
+CHECKED = RECORD.size - 4
+MAX_ID = 2**32 - 1      # BorrowerID and CopyID are packed unsigned 32-bit
+
+Entry = collections.namedtuple("Entry", "sequence at borrower_id copy_id operation")
+
+APPLIED = "SELECT Applied FROM JournalReplay WHERE JournalID=?"
+SAVE_APPLIED = """
+    INSERT INTO JournalReplay (JournalID, Kiosk, Applied) VALUES (?, ?, ?)
+    ON CONFLICT(JournalID) DO UPDATE SET Applied=excluded.Applied, UpdatedAt=datetime('now')
+"""
+INSERT_CONFLICT = """
+    INSERT INTO JournalConflict (JournalID, Sequence, Kiosk, Operation, BorrowerID, CopyID, At, Reason)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+BORROWER_EXISTS = "SELECT 1 FROM Borrowers WHERE BorrowerID=?"
+# A copy's item and status, with its open loan if it has one
+COPY_STATE = """
+    SELECT lc.ItemID, lc.Status, bt.TransactionID, bt.BorrowerID
+    FROM LibraryCopy lc
+    LEFT JOIN BorrowingTransactions bt ON bt.CopyID = lc.CopyID AND bt.ReturnDate IS NULL
+    WHERE lc.CopyID=?
+"""
+COLLECT_HELD_COPY = """
+    UPDATE ItemHold SET Status='Collected'
+    WHERE BorrowerID=? AND ItemID=? AND CopyID=? AND Status='Ready'
+    RETURNING HoldID
+"""
+# services.INSERT_LOAN and CLOSE_LOAN, dated by the journal instead of today
+INSERT_DATED_LOAN = f"""
+    INSERT INTO BorrowingTransactions (BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus,
+                                       BranchID)
+    VALUES (?1, ?2, DATE(?3, 'unixepoch'), DATE(?3, 'unixepoch', '+{services.LOAN_DAYS} days'), NULL, 0, 'Unpaid',
+            (SELECT BranchID FROM LibraryCopy WHERE CopyID = ?2))
+"""
+CLOSE_DATED_LOAN = "UPDATE BorrowingTransactions SET ReturnDate=DATE(?, 'unixepoch') WHERE TransactionID=?"
+CONFLICTS = """
+    SELECT Sequence, Operation, BorrowerID, CopyID, datetime(At, 'unixepoch'), Reason
+    FROM JournalConflict WHERE JournalID=? ORDER BY Sequence
+"""
+
+# Statements a replay makes, with sample parameters, for project.py check-plans
+QUERY_PLAN_CHECKS = [
+    ("journal: applied", APPLIED, ("0" * 32,)),
+    ("journal: save applied", SAVE_APPLIED, ("0" * 32, "kiosk", 1)),
+    ("journal: insert conflict", INSERT_CONFLICT, ("0" * 32, 1, "kiosk", 1, 1, 1, 0, "reason")),
+    ("journal: borrower exists", BORROWER_EXISTS, (1,)),
+    ("journal: copy state", COPY_STATE, (1,)),
+    ("journal: collect held copy", COLLECT_HELD_COPY, (1, 1, 1)),
+    ("journal: insert dated loan", INSERT_DATED_LOAN, (1, 1, 0)),
+    ("journal: close dated loan", CLOSE_DATED_LOAN, (0, 1)),
+    ("journal: conflicts", CONFLICTS, ("0" * 32,)),
+]
+
+
+class JournalError(Exception):
+    """Raised for a file that is not a journal, or one damaged before its last record,
+    and for an ID too large for a record"""
+
+
+class Journal:
+    """Appends borrow and return records to a kiosk's journal file, creating it if needed
+
+        with Journal("kiosk.journal", "North branch") as journal:
+            journal.borrow(borrower_id, copy_id)
+            journal.give_back(copy_id)
+
+    Each append is on disk before it returns unless sync=False.
+    """
+
+    def __init__(self, path, kiosk="", sync=True):
+        self.path = path
+        self.sync = sync
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < HEADER.size:
+            self.journal_id = uuid.uuid4().bytes
+            self.kiosk = kiosk
+            os.ftruncate(self._fd, 0)
+            os.write(self._fd, HEADER.pack(MAGIC, VERSION, self.journal_id, kiosk.encode()))
+            size = HEADER.size
+        else:
+            self.journal_id, self.kiosk = read_header(os.pread(self._fd, HEADER.size, 0))
+        # Cut off a record torn by a crash mid-write before appending after it
+        self.count = (size - HEADER.size) // RECORD.size
+        os.ftruncate(self._fd, HEADER.size + self.count * RECORD.size)
+        os.lseek(self._fd, 0, os.SEEK_END)
+        if self.sync:
+            os.fsync(self._fd)
+
+    def borrow(self, borrower_id, copy_id, at=None):
+        """Records a copy lent to a borrower; returns the record's sequence number"""
+        return self._append(BORROW, borrower_id, copy_id, at)
+
+    def give_back(self, copy_id, at=None):
+        """Records a copy brought back; returns the record's sequence number"""
+        return self._append(RETURN, 0, copy_id, at)
+
+    def _append(self, operation, borrower_id, copy_id, at):
+        for name, value in (("Borrower ID", borrower_id), ("Copy ID", copy_id)):
+            if not 0 <= value <= MAX_ID:
+                raise JournalError(f"{name} {value} is out of range")
+        sequence = self.count + 1
+        fields = RECORD.pack(sequence, int(time.time() if at is None else at), borrower_id, copy_id, operation, 0)
+        os.write(self._fd, fields[:CHECKED] + struct.pack("<I", zlib.crc32(fields[:CHECKED])))
+        if self.sync:
+            os.fsync(self._fd)
+        self.count = sequence
+        return sequence
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_header(data):
+    """(journal id, kiosk name) from a journal's first HEADER.size bytes"""
+    if len(data) < HEADER.size:
+        raise JournalError("not a journal: too short for a header")
+    magic, version, journal_id, kiosk = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise JournalError("not a journal, or one written by another version")
+    return journal_id, kiosk.rstrip(b"\0").decode(errors="replace")
+
+
+def read_entries(view, after=0):
+    """Yields the Entry records in a journal's bytes following sequence after, checking each one"""
+    count = (len(view) - HEADER.size) // RECORD.size
+    start = HEADER.size + after * RECORD.size
+    records = memoryview(view)[start:HEADER.size + count * RECORD.size]
+    for index, record in enumerate(RECORD.iter_unpack(records), start=after + 1):
+        sequence, at, borrower_id, copy_id, operation, crc = record
+        offset = (index - after - 1) * RECORD.size
+        if sequence != index or operation not in OPERATIONS or crc != zlib.crc32(records[offset:offset + CHECKED]):
+            raise JournalError(f"record {index} is damaged")
+        yield Entry(sequence, at, borrower_id, copy_id, operation)
+
+
+def apply_entry(cursor, entry):
+    """Applies one journal record in the caller's transaction; returns why it couldn't be, or None"""
+    copy = cursor.execute(COPY_STATE, (entry.copy_id,)).fetchone()
+    if copy is None:
+        return "unknown copy"
+    item_id, status, transaction_id, lent_to = copy
+    if entry.operation == RETURN:
+        if transaction_id is None:
+            return "copy is not on loan"
+        cursor.execute(CLOSE_DATED_LOAN, (entry.at, transaction_id))
+        status = "onHold" if services.assign_hold(cursor, entry.copy_id, item_id) else "onShelf"
+        cursor.execute(services.MOVE_COPY, (status, entry.copy_id, "Borrow"))
+        return None
+    if cursor.execute(BORROWER_EXISTS, (entry.borrower_id,)).fetchone() is None:
+        return "unknown borrower"
+    if status == "Borrow":
+        return f"copy already on loan {transaction_id} to borrower {lent_to}" if transaction_id else "copy already on loan"
+    if status == "onHold" and not cursor.execute(COLLECT_HELD_COPY, (entry.borrower_id, item_id, entry.copy_id)).fetchall():
+        return "copy is held for another borrower"
+    if status not in ("onShelf", "onHold"):
+        return f"copy is {status}"
+    cursor.execute(services.MOVE_COPY, ("Borrow", entry.copy_id, status))
+    cursor.execute(INSERT_DATED_LOAN, (entry.borrower_id, entry.copy_id, entry.at))
+    return None
+
+
+def replay(path, batch_size=BATCH_SIZE, report=print):
+    """Applies every record of a journal not yet applied, in batches; returns a Counter of outcomes"""
+    if os.path.getsize(path) < HEADER.size:
+        raise JournalError("not a journal: too short for a header")
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        journal_id, kiosk = read_header(view)
+        key = journal_id.hex()
+        with database.unit_of_work() as cursor:
+            row = cursor.execute(APPLIED, (key,)).fetchone()
+        totals = collections.Counter(skipped=row[0] if row else 0)
+        # Closed before the map is, which it can't be while a view of it is still held
+        with contextlib.closing(read_entries(view, totals["skipped"])) as entries:
+            _replay_entries(entries, key, kiosk, batch_size, totals, report)
+    return totals
+
+
+def _replay_entries(entries, key, kiosk, batch_size, totals, report):
+    """Applies entries batch_size at a time, adding the outcomes to totals"""
+    start = time.perf_counter()
+    while True:
+        batch = [entry for _, entry in zip(range(batch_size), entries)]
+        if not batch:
+            break
+
+        def write(cursor):
+            # Another replay of the same journal may have got here first
+            row = cursor.execute(APPLIED, (key,)).fetchone()
+            done = row[0] if row else 0
+            outcomes, conflicts, lent_at = collections.Counter(), [], []
+            for entry in batch:
+                if entry.sequence <= done:
+                    outcomes["skipped"] += 1
+                    continue
+                reason = apply_entry(cursor, entry)
+                name = OPERATIONS[entry.operation]
+                if reason is None:
+                    outcomes[name] += 1
+                    if entry.operation == BORROW:
+                        lent_at.append(entry.at)
+                else:
+                    outcomes["conflicts"] += 1
+                    conflicts.append((key, entry.sequence, kiosk, name, entry.borrower_id or None,
+                                      entry.copy_id, entry.at, reason))
+            cursor.executemany(INSERT_CONFLICT, conflicts)
+            if lent_at:
+                # The DueDate INSERT_DATED_LOAN gives the earliest of them
+                due = time.strftime("%Y-%m-%d", time.gmtime(min(lent_at) + services.LOAN_DAYS * 86400))
+                cursor.execute(notices.REWIND_SCANS, (due,))
+            cursor.execute(SAVE_APPLIED, (key, kiosk, max(done, batch[-1].sequence)))
+            return outcomes
+
+        totals.update(database.run_transaction(write))
+        if report:
+            elapsed = time.perf_counter() - start
+            applied = totals["borrow"] + totals["return"] + totals["conflicts"]
+            report(f"{batch[-1].sequence:>10} records | {totals['borrow']:>9} loans | "
+                   f"{totals['return']:>9} returns | {totals['conflicts']:>7} conflicts | "
+                   f"{applied / elapsed:>8.0f} records/s")
+
+
+def show(path):
+    """Prints a journal's header and records"""
+    with open(path, "rb") as file:
+        view = file.read()
+    journal_id, kiosk = read_header(view)
+    print(f"Journal {journal_id.hex()} from kiosk {kiosk!r}")
+    for entry in read_entries(view):
+        at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry.at))
+        borrower = f"borrower {entry.borrower_id}" if entry.operation == BORROW else ""
+        print(f"{entry.sequence:>8}  {at}  {OPERATIONS[entry.operation]:<7} copy {entry.copy_id:<8} {borrower}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay or inspect an offline kiosk journal")
+    parser.add_argument("command", choices=["replay", "show"])
+    parser.add_argument("path", help="journal file written by a kiosk in offline mode")
+    parser.add_argument("--db", default=database.DB_PATH, help="database to replay into")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="records per transaction")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        sys.exit(f"No such file: {args.path}")
+    try:
+        if args.command == "show":
+            show(args.path)
+            sys.exit(0)
+        database.configure(args.db)
+        start = time.perf_counter()
+        totals = replay(args.path, args.batch)
+        print(f"\nApplied {totals['borrow']} loans and {totals['return']} returns in "
+              f"{time.perf_counter() - start:.1f}s; {totals['skipped']} records were already applied.")
+        with open(args.path, "rb") as file:
+            journal_id, _ = read_header(file.read(HEADER.size))
+        with database.unit_of_work() as cursor:
+            conflicts = cursor.execute(CONFLICTS, (journal_id.hex(),)).fetchall()
+        if conflicts:
+            print(f"\n{len(conflicts)} records could not be applied:")
+            for sequence, operation, borrower_id, copy_id, at, reason in conflicts:
+                borrower = f" by borrower {borrower_id}" if borrower_id else ""
+                print(f"{sequence:>8}  {at}  {operation} of copy {copy_id}{borrower}: {reason}")
+    except JournalError as error:
+        sys.exit(f"{args.path}: {error}")
+    finally:
+        database.close()
@@ -0,0 +1,170 @@
+"""Due-date reminders and overdue notices, generated in batches for a pluggable sender.
+
+Usage: python notices.py [--db library.db] [--days 3] [--outbox notices.jsonl] [--batch 5000] [--every HOURS]
+
+Each run sends two kinds of notice:
+
+    due       loans due within the next --days days (services.REMINDER_DAYS)
+    overdue   loans that have gone past their due date
+
+Open loans are read in keyset order of (DueDate, TransactionID) over the partial
+index on open loans' due dates, BATCH_SIZE at a time, so a run over a million open
+loans never holds more than one batch. NoticeScan (migration 12) keeps, per kind,
+the last (DueDate, TransactionID) a run reached, and the next run starts after it:
+loans already scanned are not read again. LoanNotice logs every loan a notice went
+out for, and the scan skips those too, so moving a scan position back can't resend
+anything. journal.replay does that with REWIND_SCANS for the back-dated loans it
+writes, which can fall due behind where the scans have got to.
+
+A batch's notices, one per borrower, go to send() before the batch is logged as
+sent, so a crash in between sends that batch again on the next run rather than
+losing it. Each notice carries an id built from its loans for a consumer to drop
+repeats. Outbox is the sender used here: it appends notices as JSON lines to a file
+that the mail gateway picks up.
+"""
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass
+
+import database
+import services
+from database import unit_of_work
+
+BATCH_SIZE = 5000
+KINDS = ("due", "overdue")
+OUTBOX_PATH = "notices.jsonl"
+NOTICE_ORDER = ("bt.DueDate", "bt.TransactionID")
+
+# Today, the last due date a reminder covers, and the last due date that is overdue
+DATES = "SELECT DATE('now'), DATE('now', ?), DATE('now', '-1 day')"
+SCAN_POSITION = "SELECT DueDate, TransactionID FROM NoticeScan WHERE Kind=?"
+SAVE_POSITION = """
+    INSERT INTO NoticeScan (Kind, DueDate, TransactionID) VALUES (?, ?, ?)
+    ON CONFLICT(Kind) DO UPDATE SET DueDate=excluded.DueDate, TransactionID=excluded.TransactionID,
+                                    UpdatedAt=datetime('now')
+"""
+LOG_NOTICE = "INSERT OR IGNORE INTO LoanNotice (TransactionID, Kind) VALUES (?, ?)"
+# Moves any scan position past a due date back to the start of that date
+REWIND_SCANS = "UPDATE NoticeScan SET DueDate=?1, TransactionID=0 WHERE DueDate >= ?1"
+# Filled in by services.keyset_query; the bound ? is the last due date this kind covers
+OPEN_LOANS_DUE = f"""
+    SELECT {{keys}}, bt.BorrowerID, b.Name, b.Email, li.Title, {services.FINE_AMOUNT}
+    FROM BorrowingTransactions bt
+    JOIN Borrowers b ON b.BorrowerID = bt.BorrowerID
+    JOIN LibraryCopy lc ON lc.CopyID = bt.CopyID
+    JOIN LibraryItem li ON li.ItemID = lc.ItemID
+    WHERE bt.ReturnDate IS NULL AND {{after}} AND bt.DueDate <= ?
+    AND NOT EXISTS (SELECT 1 FROM LoanNotice n WHERE n.TransactionID = bt.TransactionID AND n.Kind = ?)
+"""
+SCAN = services.keyset_query(OPEN_LOANS_DUE, NOTICE_ORDER, ">")
+
+# Statements a notice run makes, with sample parameters, for project.py check-plans
+QUERY_PLAN_CHECKS = [
+    ("notices: scan position", SCAN_POSITION, ("due",)),
+    ("notices: save position", SAVE_POSITION, ("due", "2025-01-01", 1)),
+    ("notices: log notice", LOG_NOTICE, (1, "due")),
+    ("notices: rewind scans", REWIND_SCANS, ("2025-01-01",)),
+    ("notices: open loans due", SCAN, ("2025-01-01", 1, "2025-01-04", "due", BATCH_SIZE, 0)),
+]
+FULL_SCAN_ALLOWED = {"notices: rewind scans"}   # NoticeScan has a row per kind
+
+
+@dataclass(frozen=True)
+class Notice:
+    notice_id: str
+    kind: str
+    borrower_id: int
+    name: str
+    email: str
+    loans: tuple   # (TransactionID, Title, DueDate, fine so far) per loan
+
+
+class Outbox:
+    """Sends notices by appending them to a JSON-lines file, synced before send() returns"""
+
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+        self.sent = 0
+
+    def send(self, notices):
+        with open(self.path, "a", encoding="utf-8") as file:
+            for notice in notices:
+                file.write(json.dumps(vars(notice)) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.sent += len(notices)
+
+
+def group_notices(kind, rows):
+    """One Notice per borrower from a batch of scanned loans, in the order borrowers first appear"""
+    loans = {}
+    for due_date, transaction_id, borrower_id, name, email, title, fine in rows:
+        entry = loans.setdefault(borrower_id, (name, email, []))
+        entry[2].append((transaction_id, title, due_date, round(fine or 0, 2)))
+    return [Notice(f"{kind}-{borrower_id}-{entries[0][0]}", kind, borrower_id, name, email, tuple(entries))
+            for borrower_id, (name, email, entries) in loans.items()]
+
+
+def send_notices(kind, send, days=services.REMINDER_DAYS, batch_size=BATCH_SIZE):
+    """Sends every notice of one kind that is due and not yet sent; returns (loans, notices)"""
+    with unit_of_work() as cursor:
+        today, horizon, yesterday = cursor.execute(DATES, (f"+{int(days)} days",)).fetchone()
+        position = cursor.execute(SCAN_POSITION, (kind,)).fetchone() or ("", 0)
+    if kind == "due":
+        # A reminder for a loan that is already overdue would come too late
+        position, last_due = max(tuple(position), (today, 0)), horizon
+    else:
+        last_due = yesterday
+    loans = notices = 0
+    while True:
+        with unit_of_work() as cursor:
+            rows = cursor.execute(SCAN, (*position, last_due, kind, batch_size, 0)).fetchall()
+        if not rows:
+            break
+        batch = group_notices(kind, rows)
+        send(batch)
+        position = tuple(rows[-1][:2])
+
+        def log(cursor):
+            cursor.executemany(LOG_NOTICE, ((row[1], kind) for row in rows))
+            cursor.execute(SAVE_POSITION, (kind, *position))
+
+        database.run_transaction(log)
+        loans += len(rows)
+        notices += len(batch)
+    return loans, notices
+
+
+def run(send, days=services.REMINDER_DAYS, batch_size=BATCH_SIZE):
+    """Sends both kinds of notice, printing what went out; returns {kind: (loans, notices)}"""
+    results = {}
+    for kind in KINDS:
+        start = time.perf_counter()
+        results[kind] = loans, notices = send_notices(kind, send, days, batch_size)
+        print(f"{kind:<8} {notices:>9} notices covering {loans:>9} loans in {time.perf_counter() - start:.1f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send due-date reminders and overdue notices")
+    parser.add_argument("--db", default=database.DB_PATH, help="database file to scan")
+    parser.add_argument("--days", type=int, default=services.REMINDER_DAYS, help="remind this many days ahead")
+    parser.add_argument("--outbox", default=OUTBOX_PATH, help="file the notices are appended to")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="loans per batch")
+    parser.add_argument("--every", type=float, metavar="HOURS", help="keep running, once every HOURS")
+    args = parser.parse_args()
+    database.configure(args.db)
+    outbox = Outbox(args.outbox)
+    try:
+        while True:
+            run(outbox.send, args.days, args.batch)
+            print(f"{outbox.sent} notices appended to {args.outbox}.")
+            if args.every is None:
+                break
+            time.sleep(args.every * 3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        database.close()
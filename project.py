@@ -1,13 +1,45 @@
-import sqlite3 as sql
-
-conn = sql.connect("library.db")
-cursor = conn.cursor()
-
-ITEMS_PER_PAGE = 5  
+import argparse
+import sys
+
+import archive
+import database
+import journal
+import notices
+import querylog
+import reports
+import services
+from services import ServiceError
+
+# Modules whose QUERY_PLAN_CHECKS check-plans runs
+PLAN_CHECKED = (services, archive, journal, notices, reports)
+
+session = None   # the borrower logged in at this desk, kept across menu actions
+desk_branch = None   # the branch this desk lends from (--branch); None lends from any branch
+
+def borrower_session():
+    """Returns the logged-in borrower's session, asking for a Borrower ID to log in if there is none"""
+    global session
+    if session is None:
+        borrower_id = input("\nEnter your Borrower ID: ")
+        try:
+            session = services.login(borrower_id)
+        except ServiceError as error:
+            print(error)
+            return None
+        print(f"Welcome, {session.borrower.name}.")
+        due, overdue = session.due_soon()
+        if overdue:
+            print(f"You have {len(overdue)} overdue item(s), the oldest due {overdue[0].due_date}.")
+        if due:
+            print(f"{len(due)} item(s) due by {due[-1].due_date}: {', '.join(loan.title for loan in due)}")
+    return session
+
+def log_out():
+    global session
+    session = None
 
 def main_menu():
     """Main menu interface for the library system with paginated options"""
-    calculate_fines()
     page = 0  
     menu_pages = [
         [
@@ -16,12 +48,15 @@ def main_menu():
             ("Return a borrowed item", return_item),
             ("Donate an item to the library", donate_item),
             ("View your borrowed books", view_borrowed_books),
+            ("View your loan history", view_loan_history),
+            ("View your holds", view_holds),
             ("Pay fines", pay_fines),
             ("Register for an account", register_account)
         ],
         [
             ("Find an event in the library", find_event),
             ("Register for an event", register_event),
+            ("Cancel an event registration", cancel_event_registration),
             ("Volunteer for the library", volunteer),
             ("Ask for help from a librarian", ask_help)
         ]
@@ -29,6 +64,8 @@ def main_menu():
     
     while True:
         print("\n===== Library System =====")
+        if session:
+            print(f"Logged in as {session.borrower.name} (Borrower ID {session.borrower_id})")
         print(f"=== Page {page+1} of {len(menu_pages)} ===")
         
         for i, (option_text, _) in enumerate(menu_pages[page], 1):
@@ -39,6 +76,8 @@ def main_menu():
             print("[N]ext Page")
         if page > 0:
             print("[P]revious Page")
+        if session:
+            print("[L]og out")
         print("[E]xit System")
         
         choice = input("\nSelect an option: ").strip().lower()
@@ -49,7 +88,12 @@ def main_menu():
         elif choice == 'p' and page > 0:
             page -= 1
             continue
+        elif choice == 'l' and session:
+            print(f"Goodbye, {session.borrower.name}.")
+            log_out()
+            continue
         elif choice == 'e':
+            log_out()
             print("Exiting system. Goodbye!")
             break
         
@@ -71,7 +115,8 @@ def find_item():
         print("\n--- Find Library Items ---")
         print("1. List all items")
         print("2. Search by title")
-        print("3. Return to main menu")
+        print("3. Popular now")
+        print("4. Return to main menu")
         
         choice = input("\nSelect an option: ").strip()
         
@@ -82,108 +127,174 @@ def find_item():
             if search_by_title() == 'main_menu':
                 return 'main_menu'
         elif choice == '3':
+            if popular_now() == 'main_menu':
+                return 'main_menu'
+        elif choice == '4':
             return
         else:
             print("Invalid choice. Please try again.")
 
 def list_all_items():
     """Displays all library items with pagination"""
-    cursor.execute("SELECT * FROM LibraryItem")
-    items = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
+    pager = services.list_items()
     
-    if not items:
+    if not pager.rows:
         print("\nNo items found in the library.")
         return
     
-    result = display_items_with_pagination(items, columns, "All Library Items")
+    result = display_items_with_pagination(pager, "All Library Items")
+    if result == 'main_menu':
+        return 'main_menu'
+
+def popular_now():
+    """Shows the titles patrons asked for, then lists the titles borrowed most lately"""
+    requested = services.requested_titles()
+    if requested:
+        print("\nTitles patrons most asked the library to get:")
+        for title, item_type, requests in requested:
+            print(f"  {title} ({item_type}): {requests} request{'s' if requests != 1 else ''}")
+
+    pager = services.popular_items()
+    if not pager.rows:
+        print("\nNo popular items yet; they are worked out nightly from loan history.")
+        return
+
+    result = display_items_with_pagination(pager, "Popular Now")
     if result == 'main_menu':
         return 'main_menu'
 
 def search_by_title():
-    """Searches for items by title with partial matching"""
-    title = input("\nEnter title of the item (leave blank to return): ").strip()
+    """Searches the catalog by title, author or type, ranked by relevance"""
+    title = input("\nEnter title, author or type of the item (leave blank to return): ").strip()
     if not title:
         return
-        
-    cursor.execute("SELECT * FROM LibraryItem WHERE Title LIKE ?", (f"%{title}%",))
-    items = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
 
-    if not items:
-        print("\nNo items found matching that title.")
+    try:
+        pager = services.search(title)
+    except ServiceError as error:
+        print(f"\n{error}")
         return
-    
-    result = display_items_with_pagination(items, columns, f"Search Results for '{title}'")
+
+    heading = f"Search Results for '{title}'"
+    if not pager.rows:
+        # Most misses are typos: offer the closest titles and authors instead of nothing
+        pager = services.fuzzy_search(title)
+        if not pager.rows:
+            print("\nNo items found matching that title.")
+            return
+        print(f"\nNo exact matches for '{title}'; showing the closest ones.")
+        heading = f"Close Matches for '{title}'"
+
+    result = display_items_with_pagination(pager, heading)
     if result == 'main_menu':
         return 'main_menu'
 
-def display_items_with_pagination(items, columns, title):
-    """Displays items with pagination controls and selection options"""
-    page = 0
-    while True:
-        start = page * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        current_items = items[start:end]
+def display_with_pagination(pager, title, on_select=None, header=None, format_row=None):
+    """Shows a pager's rows a page at a time with navigation and optional selection
+
+    on_select is called with the chosen row; a truthy result ends the listing and is returned.
+    """
+    if header is None:
+        header = f"{'No.':<4} " + " | ".join([f"{col:<15}" for col in pager.columns])
+    if format_row is None:
+        format_row = lambda i, row: f"{i:<4} " + " | ".join([str(val)[:15].ljust(15) for val in row])
 
-        print(f"\n---------    {title}    ---------------")
-        print(f"{'No.':<4} " + " | ".join([f"{col:<15}" for col in columns]))
-        print("-" * 40)
+    options = "[N]ext Page | [P]revious Page | [J]ump to Page | [M]ain Menu"
+    if on_select:
+        options += " | [Select Number]"
+
+    while True:
+        print(f"\n---------    {title} (Page {pager.page + 1})    ---------------")
+        print(header)
+        print("-" * len(header))
 
-        for i, item in enumerate(current_items, start=1 + start):
-            print(f"{i:<4} " + " | ".join([str(val)[:15].ljust(15) for val in item]))
+        for i, row in enumerate(pager.rows, start=1 + pager.start):
+            print(format_row(i, row))
 
-        print("\nOptions: [N]ext Page | [P]revious Page | [M]ain Menu | [Select Number]")
+        print(f"\nOptions: {options}")
         choice = input("\nChoose an option: ").strip().lower()
 
-        if choice == "n" and end < len(items):
-            page += 1
-        elif choice == "p" and page > 0:
-            page -= 1
+        if choice == "n":
+            if not pager.next_page():
+                print("Already on the last page.")
+        elif choice == "p":
+            if not pager.previous_page():
+                print("Already on the first page.")
+        elif choice == "j":
+            number = input("Go to page number: ").strip()
+            if not number.isdigit() or not pager.jump_to(int(number) - 1):
+                print("No such page.")
         elif choice == "m":
-            return 'main_menu' 
-        elif choice.isdigit():
-            index = int(choice) - 1
-            if 0 <= index < len(items):
-                view_book_details(items[index])
+            return 'main_menu'
+        elif choice.isdigit() and on_select:
+            index = int(choice) - 1 - pager.start
+            if 0 <= index < len(pager.rows):
+                result = on_select(pager.rows[index])
+                if result:
+                    return result
             else:
                 print("Invalid selection.")
         else:
             print("Invalid choice. Try again.")
 
-def view_book_details(item):
+def display_items_with_pagination(pager, title):
+    """Displays catalog items with pagination controls and selection options"""
+    def select(row):
+        item_id, *_ = row   # a search result tuple or a CatalogItem from the snapshot
+        return view_book_details(item_id)
+
+    return display_with_pagination(pager, title, on_select=select)
+
+def view_book_details(item_id):
     """Displays detailed information about a specific library item"""
-    columns = [desc[0] for desc in cursor.description]
+    try:
+        item = services.get_item(item_id)
+    except ServiceError as error:
+        print(error)
+        return
+
     print("\n" + "="*50)
     print("ITEM DETAILS".center(50))
     print("="*50)
     
-    for col, val in zip(columns, item):
-        print(f"{col:<20}: {val}")
+    for label, value in (("ItemID", item.item_id), ("Title", item.title), ("ItemType", item.item_type),
+                         ("AuthorCreator", item.author), ("YearPublished", item.year)):
+        print(f"{label:<20}: {value}")
     
-    item_id = item[0]
-    cursor.execute("SELECT COUNT(*) FROM LibraryCopy WHERE ItemID=? AND Status='onShelf'", (item_id,))
-    available_copies = cursor.fetchone()[0]
+    available_copies = item.available_copies
+    stock = services.branch_availability(item_id) if available_copies else []
+    if desk_branch is not None:
+        available_copies = services.available_copies(item_id, desk_branch)
     
     print("\n" + "-"*50)
-    print(f"Available copies: {available_copies}")
+    print(f"Available copies{' here' if desk_branch is not None else ''}: {available_copies}")
+    for branch_id, name, copies in stock:
+        if branch_id != desk_branch:
+            print(f"  {name}: {copies}")
     print("-"*50)
 
+    similar = services.also_borrowed(item_id)
+    if similar:
+        print("\nPatrons who borrowed this also borrowed:")
+        for similar_id, title, author, _ in similar:
+            print(f"  [{similar_id}] {title} by {author}")
+
     print("\nOptions:")
     print("[B]orrow this item")
+    if not available_copies:
+        print("[H]old the next free copy")
     print("[R]eturn to list")
     print("[M]ain menu")
     
     while True:
         choice = input("Choose an option: ").strip().lower()
         if choice == 'b':
-            cursor.execute("SELECT CopyID FROM LibraryCopy WHERE ItemID=? AND Status='onShelf' LIMIT 1", (item_id,))
-            copy = cursor.fetchone()
-            if copy:
-                borrow_item(item_id=item_id, copy_id=copy[0])
-            else:
-                print("\nNo available copies to borrow.\n")
+            # Even with none on the shelf, the borrower may have a Ready hold to collect
+            borrow_item(item_id=item_id)
             return  
+        elif choice == 'h' and not available_copies:
+            place_hold(item_id)
+            return
         elif choice == 'r':
             return
         elif choice == 'm':
@@ -192,46 +303,50 @@ def view_book_details(item):
         else:
             print("Invalid choice. Try again.")
 
-def borrow_item(item_id=None, copy_id=None):
+def borrow_item(item_id=None):
     """Handles the process of borrowing a library item"""
-    borrower_id = input("\nEnter your Borrower ID: ")
-    cursor.execute("SELECT * FROM Borrowers WHERE BorrowerID=?", (borrower_id,))
-    borrower = cursor.fetchone()
-    if not borrower:
-        print("Invalid Borrower ID.")
+    current = borrower_session()
+    if current is None:
         return
-
-        # Check for unpaid fines
-    calculate_fines()
-    cursor.execute("SELECT SUM(FineAmount) FROM BorrowingTransactions WHERE BorrowerID=? AND PaidStatus='Unpaid'", (borrower_id,))
-    unpaid_fines = cursor.fetchone()[0] or 0
-    
-    if unpaid_fines > 0:
-        print(f"\nCannot borrow items - you have ${unpaid_fines:.2f} in unpaid fines.")
+    try:
+        # Check for unpaid fines before asking which item
+        unpaid_fines = current.fines_due()
+        if unpaid_fines > 0:
+            raise services.FinesOutstanding(unpaid_fines)
+        if not item_id:
+            item_id = input("Enter the Item ID you want to borrow: ")
+        loan = current.borrow(item_id, desk_branch)
+    except services.FinesOutstanding as error:
+        print(f"\n{error}")
         print("Please pay your fines first.")
         return
-    
-    if not item_id:
-        item_id = input("Enter the Item ID you want to borrow: ")
-        cursor.execute("SELECT CopyID FROM LibraryCopy WHERE ItemID=? AND Status='onShelf'", (item_id,))
-        copy = cursor.fetchone()
-        if not copy:
-            print("No available copies.")
-            return
-        copy_id = copy[0]
-
-    cursor.execute(
-        "INSERT INTO BorrowingTransactions (BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus) "
-        "VALUES (?, ?, DATE('now'), DATE('now', '+14 days'), NULL, 0, 'Unpaid')",
-        (borrower_id, copy_id)
-    )
-    transaction_id = cursor.lastrowid
-    
-    cursor.execute("UPDATE LibraryCopy SET Status='Borrow' WHERE CopyID=?", (copy_id,))
-    conn.commit()
+    except services.Unavailable as error:
+        print(error)
+        if input("Place a hold for the next free copy? (y/n): ").strip().lower() == 'y':
+            place_hold(item_id)
+        return
+    except ServiceError as error:
+        print(error)
+        return
     
     print("\nItem borrowed successfully! Due in 14 days.")
-    print(f"Your Transaction ID is: {transaction_id}")
+    print(f"Your Transaction ID is: {loan.transaction_id}")
+
+def place_hold(item_id):
+    """Queues the logged-in borrower for the next copy of an item that comes free"""
+    current = borrower_session()
+    if current is None:
+        return
+    try:
+        hold = services.place_hold(current.borrower_id, item_id, desk_branch)
+    except ServiceError as error:
+        print(error)
+        return
+    if hold.transfer_from:
+        print(f"\nHold placed. A copy is on its way from {hold.transfer_from}.")
+    else:
+        print(f"\nHold placed. You are number {hold.position} in line.")
+    print(f"We will keep the copy for you for {services.HOLD_PICKUP_DAYS} days once it is ready.")
 
 def donate_item():
     """Handles donations of new items to the library"""
@@ -240,106 +355,51 @@ def donate_item():
     author = input("Enter author/creator: ")
     year = input("Enter year published: ")
 
-    cursor.execute("SELECT ItemID FROM LibraryItem WHERE Title=? AND AuthorCreator=?", (title, author))
-    item = cursor.fetchone()
+    donation = services.donate(title, item_type, author, year,
+                               services.MAIN_BRANCH if desk_branch is None else desk_branch)
 
-    if item:
-        item_id = item[0]
-        print("\nThis item already exists in the library catalog. Adding a new copy...")
-    else:
-        cursor.execute("INSERT INTO LibraryItem (Title, ItemType, AuthorCreator, YearPublished) VALUES (?, ?, ?, ?)",
-                       (title, item_type, author, year))
-        item_id = cursor.lastrowid
+    if donation.new_item:
         print("\nNew item added to the library catalog!")
-
-    cursor.execute("INSERT INTO LibraryCopy (ItemID, Status) VALUES (?, 'onShelf')", (item_id,))
-    conn.commit()
+    else:
+        print("\nThis item already exists in the library catalog. Adding a new copy...")
 
     print("A new copy has been added and is now available in the library!")
 
 def return_item():
     """Handles returning borrowed items to the library"""
-    borrower_id = input("Enter your Borrower ID: ")
-    cursor.execute("SELECT * FROM Borrowers WHERE BorrowerID=?", (borrower_id,))
-    borrower = cursor.fetchone()
-    
-    if not borrower:
-        print("Invalid Borrower ID.")
+    current = borrower_session()
+    if current is None:
         return
-
-    cursor.execute("""
-        SELECT bt.TransactionID, li.ItemID, li.Title, li.AuthorCreator, bt.BorrowDate, bt.DueDate
-        FROM BorrowingTransactions bt
-        JOIN LibraryCopy lc ON bt.CopyID = lc.CopyID
-        JOIN LibraryItem li ON lc.ItemID = li.ItemID
-        WHERE bt.BorrowerID = ? AND bt.ReturnDate IS NULL
-    """, (borrower_id,))
+    pager = current.open_loans()
     
-    borrowed_books = cursor.fetchall()
-    
-    if not borrowed_books:
+    if not pager.rows:
         print("You have no books currently borrowed.")
         return
     
     columns = ["No.", "Transaction ID", "Item ID", "Title", "Author", "Borrow Date", "Due Date"]
-    page = 0
-    
-    while True:
-        start = page * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        current_page = borrowed_books[start:end]
 
-        print("\n---------    Your Borrowed Items    ---------------")
-        print(" | ".join([f"{col:<15}" for col in columns]))
-        print("-" * (15 * len(columns) + 3 * (len(columns)-1)))
+    def format_row(i, book):
+        transaction_id, item_id, title, author, borrow_date, due_date = book
+        return (f"{i:<15} | {transaction_id:<15} | {item_id:<15} | {title[:15]:<15} | "
+                f"{author[:15]:<15} | {borrow_date:<15} | {due_date:<15}")
 
-        for i, book in enumerate(current_page, start=1 + start):
-            transaction_id, item_id, title, author, borrow_date, due_date = book
-            print(f"{i:<15} | {transaction_id:<15} | {item_id:<15} | {title[:15]:<15} | "
-                  f"{author[:15]:<15} | {borrow_date:<15} | {due_date:<15}")
-
-        print("\nOptions: [N]ext Page | [P]revious Page | [M]ain Menu | [Select Number]")
-        choice = input("\nChoose an option: ").strip().lower()
+    def return_book(book):
+        try:
+            current.return_loan(book[0])
+            print("\nItem returned successfully!")
+        except ServiceError as error:
+            print(f"\n{error}")
+        return 'returned'
 
-        if choice == "n" and end < len(borrowed_books):
-            page += 1
-        elif choice == "p" and page > 0:
-            page -= 1
-        elif choice == "m":
-            return
-        elif choice.isdigit():
-            index = int(choice) - 1
-            if 0 <= index < len(borrowed_books):
-                transaction_id = borrowed_books[index][0]
-                cursor.execute("UPDATE BorrowingTransactions SET ReturnDate=DATE('now') WHERE TransactionID=?", (transaction_id,))
-                calculate_fines()
-                cursor.execute("UPDATE LibraryCopy SET Status='onShelf' WHERE CopyID=(SELECT CopyID FROM BorrowingTransactions WHERE TransactionID=?)", (transaction_id,))
-                conn.commit()
-                print("\nItem returned successfully!")
-                return
-            else:
-                print("Invalid selection.")
-        else:
-            print("Invalid choice. Try again.")
+    display_with_pagination(pager, "Your Borrowed Items", on_select=return_book,
+                            header=" | ".join([f"{col:<15}" for col in columns]), format_row=format_row)
 
 def pay_fines():
     """Handles payment of fines for a borrower"""
-    borrower_id = input("Enter your Borrower ID: ")
-    cursor.execute("SELECT * FROM Borrowers WHERE BorrowerID=?", (borrower_id,))
-    if not cursor.fetchone():
-        print("Invalid Borrower ID.")
+    current = borrower_session()
+    if current is None:
         return
-
-    # Calculate current fines
-    calculate_fines()
-    
-    cursor.execute("""
-        SELECT SUM(FineAmount) 
-        FROM BorrowingTransactions 
-        WHERE BorrowerID=? AND PaidStatus='Unpaid'
-    """, (borrower_id,))
-    
-    total_fines = cursor.fetchone()[0] or 0
+    total_fines = current.fines_due()
     
     if total_fines <= 0:
         print("\nYou have no outstanding fines.")
@@ -349,66 +409,96 @@ def pay_fines():
     confirm = input("Would you like to pay all fines now? (Y/N): ").strip().lower()
     
     if confirm == 'y':
-        cursor.execute("""
-            UPDATE BorrowingTransactions 
-            SET PaidStatus='Paid', FineAmount=0 
-            WHERE BorrowerID=? AND PaidStatus='Unpaid'
-        """, (borrower_id,))
-        conn.commit()
+        current.pay_fines()
         print("\nPayment successful! All fines have been cleared.")
     else:
         print("\nPayment cancelled.")
 
 def view_borrowed_books():
     """Displays all books currently borrowed by a user"""
-    borrower_id = input("Enter your Borrower ID: ")
-    cursor.execute("SELECT * FROM Borrowers WHERE BorrowerID=?", (borrower_id,))
-    if not cursor.fetchone():
-        print("Invalid Borrower ID.")
+    current = borrower_session()
+    if current is None:
         return
-
-    cursor.execute("""
-        SELECT li.ItemID, li.Title, li.AuthorCreator, bt.BorrowDate, bt.DueDate, bt.FineAmount
-        FROM BorrowingTransactions bt
-        JOIN LibraryCopy lc ON bt.CopyID = lc.CopyID
-        JOIN LibraryItem li ON lc.ItemID = li.ItemID
-        WHERE bt.BorrowerID = ? AND bt.ReturnDate IS NULL
-    """, (borrower_id,))
-    
-    borrowed_books = cursor.fetchall()
+    pager = current.borrowed_books()
     
-    if not borrowed_books:
+    if not pager.rows:
         print("\nYou have no books currently borrowed.")
         return
     
     columns = ["Item ID", "Title", "Author", "Borrow Date", "Due Date", "Fine Amount"]
-    page = 0
-    
-    while True:
-        start = page * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        current_page = borrowed_books[start:end]
 
-        print("\n---------    Your Borrowed Books    ---------------")
-        print(" | ".join([f"{col:<15}" for col in columns]))
-        print("-" * (15 * len(columns) + 3 * (len(columns)-1)))
+    def format_row(i, book):
+        item_id, title, author, borrow_date, due_date, fine = book
+        return (f"{i:<4} | {item_id:<15} | {title[:15]:<15} | "
+                f"{author[:15]:<15} | {borrow_date:<15} | ${fine:.2f}")
 
-        for i, book in enumerate(current_page, start=1 + start):
-            item_id, title, author, borrow_date, due_date, fine = book
-            print(f"{i:<4} | {item_id:<15} | {title[:15]:<15} | "
-                  f"{author[:15]:<15} | {borrow_date:<15} | ${fine:.2f}")
+    display_with_pagination(pager, "Your Borrowed Books",
+                            header=" | ".join([f"{col:<15}" for col in columns]), format_row=format_row)
 
-        print("\nOptions: [N]ext Page | [P]revious Page | [M]ain Menu")
-        choice = input("\nChoose an option: ").strip().lower()
+def view_loan_history():
+    """Displays every loan a user has had, returned or not"""
+    current = borrower_session()
+    if current is None:
+        return
+    borrower_id = current.borrower_id
+    try:
+        pager = services.loan_history(borrower_id)
+    except ServiceError as error:
+        print(error)
+        return
 
-        if choice == "n" and end < len(borrowed_books):
-            page += 1
-        elif choice == "p" and page > 0:
-            page -= 1
-        elif choice == "m":
-            return
-        else:
-            print("Invalid choice. Try again.")
+    if not pager.rows:
+        print("\nYou have not borrowed anything yet.")
+        return
+
+    columns = ["Title", "Author", "Borrow Date", "Returned", "Fine", "Status"]
+
+    def format_row(i, loan):
+        _, title, author, borrow_date, return_date, fine, status = loan
+        return (f"{i:<4} | {title[:15]:<15} | {author[:15]:<15} | {borrow_date:<15} | "
+                f"{return_date or 'on loan':<15} | ${fine or 0:<14.2f} | {status}")
+
+    display_with_pagination(pager, "Your Loan History",
+                            header=f"{'No.':<4} | " + " | ".join([f"{col:<15}" for col in columns]),
+                            format_row=format_row)
+
+def view_holds():
+    """Displays a user's waiting and ready holds, and cancels the one they pick"""
+    current = borrower_session()
+    if current is None:
+        return
+    borrower_id = current.borrower_id
+    try:
+        pager = services.holds(borrower_id)
+    except ServiceError as error:
+        print(error)
+        return
+
+    if not pager.rows:
+        print("\nYou have no holds.")
+        return
+
+    columns = ["Hold ID", "Item ID", "Title", "Status", "Placed", "Pick up by", "Pick up at"]
+
+    def format_row(i, hold):
+        hold_id, item_id, title, status, placed, expires, position, branch = hold
+        status = {"Waiting": f"#{position} in line", "InTransit": "On its way"}.get(status, "Ready")
+        return (f"{i:<4} | {hold_id:<15} | {item_id:<15} | {title[:15]:<15} | {status:<15} | "
+                f"{placed[:10]:<15} | {(expires or '')[:10]:<15} | {branch}")
+
+    def cancel(hold):
+        if input(f"Cancel your hold on {hold[2]}? (y/n): ").strip().lower() != 'y':
+            return None
+        try:
+            services.cancel_hold(borrower_id, hold[0])
+            print("\nHold cancelled.")
+        except ServiceError as error:
+            print(f"\n{error}")
+        return 'cancelled'
+
+    display_with_pagination(pager, "Your Holds", on_select=cancel,
+                            header=f"{'No.':<4} | " + " | ".join([f"{col:<15}" for col in columns]),
+                            format_row=format_row)
 
 def register_account():
     """Creates a new borrower account in the library system"""
@@ -430,13 +520,10 @@ def register_account():
     address = input("Enter your Address: ").strip()
    
     try:
-        cursor.execute("INSERT INTO Borrowers (Name, Email, PhoneNumber, Address) VALUES (?, ?, ?, ?)",
-                       (name, email, phone, address))
-        conn.commit()
-        borrower_id = cursor.lastrowid
+        borrower_id = services.register_borrower(name, email, phone, address)
         print(f"\nAccount created successfully! Your Borrower ID is: {borrower_id}")
-    except sql.Error as e:
-        print("Error registering account:", e)
+    except ServiceError as error:
+        print(error)
 
 def find_event():
     """Searches for library events with pagination and view all option"""
@@ -450,23 +537,13 @@ def find_event():
         choice = input("\nSelect an option: ").strip()
         
         if choice == '1':
-            cursor.execute("""
-                SELECT EventID, EventName, EventType, 
-                       strftime('%Y-%m-%d %H:%M', DateTime) as FormattedDate,
-                       Location, Capacity - 
-                       (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID) as RemainingSpots
-                FROM Events e
-                WHERE DateTime >= datetime('now')
-                ORDER BY DateTime
-            """)
-            events = cursor.fetchall()
+            pager = services.upcoming_events()
             
-            if not events:
+            if not pager.rows:
                 print("\nNo upcoming events found.")
                 continue
                 
-            columns = ["ID", "Event Name", "Type", "Date/Time", "Location", "Spots Left"]
-            result = display_events_with_pagination(events, columns, "Upcoming Events")
+            result = display_events_with_pagination(pager, "Upcoming Events")
             if result == 'main_menu':
                 return 'main_menu'
                 
@@ -475,65 +552,40 @@ def find_event():
             if not event_name:
                 continue
                 
-            cursor.execute("""
-                SELECT EventID, EventName, EventType, 
-                       strftime('%Y-%m-%d %H:%M', DateTime) as FormattedDate,
-                       Location, Capacity - 
-                       (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID) as RemainingSpots
-                FROM Events e
-                WHERE EventName LIKE ? 
-                AND DateTime >= datetime('now')
-                ORDER BY DateTime
-            """, (f"%{event_name}%",))
+            pager = services.upcoming_events(name=event_name)
             
-            events = cursor.fetchall()
-            
-            if not events:
+            if not pager.rows:
                 print("\nNo upcoming events found matching that name.")
                 continue
                 
-            columns = ["ID", "Event Name", "Type", "Date/Time", "Location", "Spots Left"]
-            result = display_events_with_pagination(events, columns, f"Events matching '{event_name}'")
+            result = display_events_with_pagination(pager, f"Events matching '{event_name}'")
             if result == 'main_menu':
                 return 'main_menu'
                 
         elif choice == '3':
-            cursor.execute("SELECT DISTINCT EventType FROM Events WHERE EventType IS NOT NULL")
-            event_types = cursor.fetchall()
+            event_types = services.event_types()
             
             if not event_types:
                 print("\nNo event categories available.")
                 continue
                 
             print("\nAvailable Event Types:")
-            for i, (etype,) in enumerate(event_types, 1):
+            for i, etype in enumerate(event_types, 1):
                 print(f"{i}. {etype}")
                 
             type_choice = input("Select event type number (or 0 to cancel): ").strip()
             if not type_choice.isdigit() or int(type_choice) < 1 or int(type_choice) > len(event_types):
                 continue
                 
-            selected_type = event_types[int(type_choice)-1][0]
-            
-            cursor.execute("""
-                SELECT EventID, EventName, EventType, 
-                       strftime('%Y-%m-%d %H:%M', DateTime) as FormattedDate,
-                       Location, Capacity - 
-                       (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID) as RemainingSpots
-                FROM Events e
-                WHERE EventType = ? 
-                AND DateTime >= datetime('now')
-                ORDER BY DateTime
-            """, (selected_type,))
+            selected_type = event_types[int(type_choice)-1]
             
-            events = cursor.fetchall()
+            pager = services.upcoming_events(event_type=selected_type)
             
-            if not events:
+            if not pager.rows:
                 print(f"\nNo upcoming {selected_type} events found.")
                 continue
                 
-            columns = ["ID", "Event Name", "Type", "Date/Time", "Location", "Spots Left"]
-            result = display_events_with_pagination(events, columns, f"{selected_type} Events")
+            result = display_events_with_pagination(pager, f"{selected_type} Events")
             if result == 'main_menu':
                 return 'main_menu'
                 
@@ -542,74 +594,41 @@ def find_event():
         else:
             print("Invalid choice. Please try again.")
 
-def display_events_with_pagination(events, columns, title):
+def display_events_with_pagination(pager, title):
     """Displays events with pagination controls and selection options"""
-    page = 0
-    while True:
-        start = page * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        current_events = events[start:end]
-
-        print(f"\n---------    {title}    ---------------")
-        print(f"{'No.':<4} " + " | ".join([f"{col:<15}" for col in columns]))
-        print("-" * 60)
-
-        for i, event in enumerate(current_events, start=1 + start):
-            print(f"{i:<4} " + " | ".join([str(val)[:15].ljust(15) for val in event]))
-
-        print("\nOptions: [N]ext Page | [P]revious Page | [M]ain Menu | [Select Number]")
-        choice = input("\nChoose an option: ").strip().lower()
-
-        if choice == "n" and end < len(events):
-            page += 1
-        elif choice == "p" and page > 0:
-            page -= 1
-        elif choice == "m":
-            return 'main_menu'
-        elif choice.isdigit():
-            index = int(choice) - 1
-            if 0 <= index < len(events):
-                selected_event = events[index]
-                view_event_details(selected_event)
-            else:
-                print("Invalid selection.")
-        else:
-            print("Invalid choice. Try again.")
+    columns = ["ID", "Event Name", "Type", "Date/Time", "Location", "Spots Left"]
+    header = f"{'No.':<4} " + " | ".join([f"{col:<15}" for col in columns])
+    return display_with_pagination(pager, title, on_select=view_event_details, header=header)
 
 def view_event_details(event):
     """Displays detailed information about a specific event"""
     event_id = event[0]
-    cursor.execute("""
-        SELECT e.*, 
-               strftime('%Y-%m-%d %H:%M', e.DateTime) as FormattedDate,
-               (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID) as RegisteredCount
-        FROM Events e
-        WHERE e.EventID = ?
-    """, (event_id,))
-    
-    full_event = cursor.fetchone()
-    columns = [desc[0] for desc in cursor.description]
+    try:
+        details = services.get_event(event_id)
+    except ServiceError as error:
+        print(error)
+        return
     
     print("\n" + "="*60)
     print("EVENT DETAILS".center(60))
     print("="*60)
 
-    display_fields = {
-        'EventName': 'Event Name',
-        'EventType': 'Type',
-        'FormattedDate': 'Date/Time',
-        'Location': 'Location',
-        'RecommendedAudience': 'Recommended For',
-        'RegisteredCount': 'Registered',
-        'Capacity': 'Capacity'
-    }
+    display_fields = [
+        ('Event Name', details.name),
+        ('Type', details.event_type),
+        ('Date/Time', details.formatted_date),
+        ('Branch', details.branch),
+        ('Location', details.location),
+        ('Recommended For', details.audience),
+        ('Capacity', details.capacity),
+        ('Registered', details.registered),
+    ]
     
-    for col in columns:
-        if col in display_fields and full_event[columns.index(col)] is not None:
-            print(f"{display_fields[col]:<20}: {full_event[columns.index(col)]}")
+    for label, value in display_fields:
+        if value is not None:
+            print(f"{label:<20}: {value}")
     
-    remaining = full_event[columns.index('Capacity')] - full_event[columns.index('RegisteredCount')]
-    print(f"{'Spots Available':<20}: {remaining}")
+    print(f"{'Spots Available':<20}: {details.remaining}")
     print("="*60)
 
     print("\nOptions:")
@@ -631,47 +650,52 @@ def view_event_details(event):
             print("Invalid choice. Try again.")
 
 def register_event(event_id=None):
-    """Registers a borrower for a library event with capacity checking"""
+    """Registers a borrower for a library event, offering the waitlist when it is full"""
     if event_id is None:
         event_id = input("Enter the Event ID you want to register for: ")
-    cursor.execute("""
-        SELECT e.Capacity, 
-               (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID) as RegisteredCount
-        FROM Events e
-        WHERE e.EventID = ?
-    """, (event_id,))
-    
-    event_data = cursor.fetchone()
-    if not event_data:
-        print("No event found with that ID.")
+    try:
+        # Checked up front so a full event offers the waitlist before asking for a Borrower ID
+        if services.get_event(event_id).remaining <= 0:
+            print("This event is already at full capacity.")
+            if input("Join the waitlist? (y/n): ").strip().lower() == 'y':
+                join_waitlist(event_id)
+            return
+        current = borrower_session()
+        if current is None:
+            return
+        remaining = services.register_for_event(event_id, current.borrower_id)
+    except ServiceError as error:
+        print(error)
         return
     
-    capacity, registered = event_data
-    if registered >= capacity:
-        print("This event is already at full capacity.")
+    print("\nRegistration successful!")
+    print(f"Remaining spots: {remaining}")
+
+def join_waitlist(event_id):
+    """Puts a borrower on a full event's waitlist"""
+    current = borrower_session()
+    if current is None:
         return
-    
-    borrower_id = input("Enter your Borrower ID: ")
-    cursor.execute("""
-        SELECT 1 FROM EventRegistration 
-        WHERE EventID = ? AND BorrowerID = ?
-    """, (event_id, borrower_id))
-    
-    if cursor.fetchone():
-        print("You are already registered for this event.")
+    try:
+        position = services.join_waitlist(event_id, current.borrower_id)
+    except ServiceError as error:
+        print(error)
+        return
+    print(f"\nYou are number {position} on the waitlist.")
+    print("You will be registered automatically if a spot opens up.")
+
+def cancel_event_registration():
+    """Withdraws a borrower from an event or its waitlist"""
+    event_id = input("Enter the Event ID: ")
+    current = borrower_session()
+    if current is None:
         return
-    
     try:
-        cursor.execute("""
-            INSERT INTO EventRegistration (EventID, BorrowerID, RegistrationDate)
-            VALUES (?, ?, datetime('now'))
-        """, (event_id, borrower_id))
-        conn.commit()
-        
-        print("\nRegistration successful!")
-        print(f"Remaining spots: {capacity - registered - 1}")
-    except sql.Error as e:
-        print("Error registering for event:", e)
+        services.cancel_registration(event_id, current.borrower_id)
+    except ServiceError as error:
+        print(error)
+        return
+    print("\nYou are no longer signed up for this event.")
 
 def volunteer():
     """Registers a new volunteer for the library"""
@@ -680,88 +704,180 @@ def volunteer():
     email = input("Enter your Email: ")
     phone = input("Enter your Phone Number: ")
 
-    cursor.execute("SELECT * FROM Personnel WHERE Name=? AND Email=? AND Role='Volunteer'", (name, email))
-    existing = cursor.fetchone()
-    if existing:
-        print("You are already a registered volunteer.")
+    try:
+        staff_id = services.volunteer(name, email, phone)
+    except ServiceError as error:
+        print(error)
         return
 
-    try:
-        cursor.execute("INSERT INTO Personnel (Name, Role, Email, PhoneNumber) VALUES (?,'Volunteer',?,?)",
-                       (name, email, phone))
-        conn.commit()
-        staff_id = cursor.lastrowid
-        print("Successfully registered as a volunteer!")
-        print(f"Your Volunteer ID is: {staff_id}")
-    except sql.IntegrityError as e:
-        print("Error registering as a volunteer (duplicate or constraint issue).")
+    print("Successfully registered as a volunteer!")
+    print(f"Your Volunteer ID is: {staff_id}")
 
 def ask_help():
     """Displays available librarians and their contact information"""
     print("\n--- Ask a Librarian for Help ---")
-    cursor.execute("SELECT * FROM Personnel WHERE Role LIKE '%Librarian%'")
-    librarians = cursor.fetchall()
+    pager = services.librarians()
 
-    if not librarians:
+    if not pager.rows:
         print("No librarians found.")
         return
 
-    columns = [desc[0] for desc in cursor.description]
-    page = 0
-
-    while True:
-        start = page * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        current = librarians[start:end]
-
-        print("\n--------- Available Librarians ---------")
-        print(f"{'No.':<4} " + " | ".join([f"{col:<15}" for col in columns]))
-        print("-" * 60)
+    def show_contact(librarian):
+        print("\n--- Librarian Contact Info ---")
+        print(f"Name:         {librarian[1]}")
+        print(f"Email:        {librarian[3]}")
+        print(f"Phone Number: {librarian[4]}\n")
+        input("Press Enter to return to the librarian list...")
 
-        for i, librarian in enumerate(current, start=start + 1):
-            print(f"{i:<4} " + " | ".join([str(val)[:15].ljust(15) for val in librarian]))
+    display_with_pagination(pager, "Available Librarians", on_select=show_contact)
 
-        print("\nOptions: [N]ext Page | [P]revious Page | [M]ain Menu | [Select Number]")
-        choice = input("Choose an option: ").strip().lower()
 
-        if choice == "n":
-            if end < len(librarians):
-                page += 1
-            else:
-                print("Already on the last page.")
-        elif choice == "p":
-            if page > 0:
-                page -= 1
-            else:
-                print("Already on the first page.")
-        elif choice == "m":
-            return
-        elif choice.isdigit():
-            index = int(choice) - 1
-            if 0 <= index < len(librarians):
-                librarian = librarians[index]
-                print("\n--- Librarian Contact Info ---")
-                print(f"Name:         {librarian[1]}")
-                print(f"Email:        {librarian[3]}")
-                print(f"Phone Number: {librarian[4]}\n")
-                input("Press Enter to return to the librarian list...")
+def offline_menu(kiosk_journal):
+    """Self-checkout while the kiosk can't reach the database: loans and returns go to the journal"""
+    while True:
+        print(f"\n===== Library System (offline, kiosk {kiosk_journal.kiosk or 'unnamed'}) =====")
+        print("1. Borrow a copy")
+        print("2. Return a copy")
+        print("[E]xit System")
+        choice = input("\nSelect an option: ").strip().lower()
+        if choice == 'e':
+            print(f"{kiosk_journal.count} operations recorded. Goodbye!")
+            break
+        if choice not in ('1', '2'):
+            print("Invalid choice. Please try again.")
+            continue
+        borrower_id = input("\nEnter your Borrower ID: ").strip() if choice == '1' else "0"
+        copy_id = input("Enter the Copy ID on the item's label: ").strip()
+        if not borrower_id.isdigit() or not copy_id.isdigit():
+            print("IDs are numbers; nothing was recorded.")
+            continue
+        try:
+            if choice == '1':
+                kiosk_journal.borrow(int(borrower_id), int(copy_id))
             else:
-                print("Invalid selection.")
+                kiosk_journal.give_back(int(copy_id))
+        except journal.JournalError as error:
+            print(f"{error}; nothing was recorded.")
+            continue
+        if choice == '1':
+            print(f"\nBorrowed. Due in {services.LOAN_DAYS} days.")
         else:
-            print("Invalid choice. Try again.")
+            print("\nReturned. Thank you!")
+        print("This kiosk is offline; your account will be updated once it reconnects.")
+
+def check_counters(repair=False):
+    """Compares the trigger-maintained counters with fresh counts, rebuilding them if asked
+
+    Returns the number of rows that were out of step.
+    """
+    drift = services.counter_drift(repair)
+    for name, stale in drift.items():
+        action = "rebuilt" if stale and repair else "out of step" if stale else "consistent"
+        print(f"{name:<30} {stale} rows {action}")
+    return sum(drift.values())
+
+def list_transfers(branch_id):
+    """Prints the copies a branch has to send to other branches for holds"""
+    pager = services.transfers(branch_id)
+    if not pager.rows:
+        print("No copies to send.")
+    while pager.rows:
+        for transfer_id, copy_id, title, destination, requested in pager.rows:
+            print(f"{transfer_id:<10} copy {copy_id:<10} {title[:30]:<30} to {destination:<20} since {requested}")
+        if not pager.next_page():
+            break
+
+def plan_scans(plan):
+    """Steps of a query plan that read a table or index from end to end
+
+    A full-text MATCH and json_each over a bound list show up as virtual table scans
+    but only read what they are asked for, and a constant row reads nothing.
+    """
+    return [step for step in plan if step.startswith("SCAN") and step != "SCAN CONSTANT ROW"
+            and not ("VIRTUAL TABLE INDEX" in step and (":M" in step or step.startswith("SCAN json_each")))]
+
+def check_query_plans():
+    """Runs EXPLAIN QUERY PLAN on each checked statement and reports scans and temp B-tree sorts
+
+    Only SEARCH steps pass unless the statement is allow-listed: a scan of a table or
+    of an index, covering or not, must be in FULL_SCAN_ALLOWED, and a sort in a temp
+    B-tree in TEMP_SORT_ALLOWED.
+    """
+    failures = []
+    plans = []
+    full_scans, temp_sorts = set(), set()
+    for module in PLAN_CHECKED:
+        plans += services.query_plans(module.QUERY_PLAN_CHECKS)
+        full_scans |= getattr(module, "FULL_SCAN_ALLOWED", set())
+        temp_sorts |= getattr(module, "TEMP_SORT_ALLOWED", set())
+    for name, plan in plans:
+        scans = plan_scans(plan)
+        sorts = [step for step in plan if step.startswith("USE TEMP B-TREE")]
+        if (scans and name not in full_scans) or (sorts and name not in temp_sorts):
+            failures.append(name)
+            status = "FAIL"
+        else:
+            status = "scan" if scans else "sort" if sorts else "ok"
+        print(f"{status:<5} {name:<36} {'; '.join(plan)}")
 
-def calculate_fines():
-    """Calculates and updates fines for overdue items."""
-    cursor.execute("""
-    UPDATE BorrowingTransactions 
-    SET FineAmount = (JULIANDAY('now') - JULIANDAY(DueDate)) * 0.50
-    WHERE ReturnDate IS NULL 
-    AND DueDate < DATE('now')
-    AND PaidStatus = 'Unpaid'
-    """)
-    conn.commit()
+    print(f"\nChecked {len(plans)} statements, {len(failures)} with unexpected scans or sorts.")
+    return not failures
 
 if __name__ == "__main__":
-    main_menu()
+    parser = argparse.ArgumentParser(description="Library management system")
+    parser.add_argument("command", nargs="?",
+                        choices=["check-plans", "check-counters", "expire-holds", "transfers", "receive-transfer"],
+                        help="run a maintenance command instead of the menu")
+    parser.add_argument("--branch", type=int,
+                        help="the branch this desk is at; with transfers, the branch sending copies")
+    parser.add_argument("--transfer", type=int, help="with receive-transfer, the Transfer ID that arrived")
+    parser.add_argument("--repair", action="store_true", help="with check-counters, rebuild stale counters")
+    parser.add_argument("--query-log", type=float, metavar="SLOW_MS",
+                        help="time every statement, explaining those slower than SLOW_MS, and print the totals on exit")
+    parser.add_argument("--offline", metavar="JOURNAL",
+                        help="run as a self-checkout kiosk without the database, recording to JOURNAL for journal.py replay")
+    parser.add_argument("--kiosk", default="", help="with --offline, the name a new journal records")
+    args = parser.parse_args()
+
+    desk_branch = args.branch
+    if args.offline:
+        with journal.Journal(args.offline, args.kiosk) as kiosk_journal:
+            offline_menu(kiosk_journal)
+        sys.exit(0)
+
+    if args.query_log is not None:
+        query_log = querylog.QueryLog(slow_ms=args.query_log)
+        database.configure(database.DB_PATH, query_log=query_log)
+        query_log.dump_at_exit()
+
+    if args.command == "check-plans":
+        ok = check_query_plans()
+        database.close()
+        sys.exit(0 if ok else 1)
+    if args.command == "check-counters":
+        drifted = check_counters(repair=args.repair)
+        database.close()
+        sys.exit(0 if not drifted or args.repair else 1)
+    if args.command == "expire-holds":
+        print(f"Expired {services.expire_holds()} holds past their pickup window.")
+        database.close()
+        sys.exit(0)
+    if args.command == "transfers":
+        list_transfers(services.MAIN_BRANCH if args.branch is None else args.branch)
+        database.close()
+        sys.exit(0)
+    if args.command == "receive-transfer":
+        if args.transfer is None:
+            parser.error("receive-transfer needs --transfer")
+        try:
+            hold_id = services.receive_transfer(args.transfer)
+            print(f"Received. Hold {hold_id} is ready for pickup.")
+        except ServiceError as error:
+            print(error)
+            sys.exit(1)
+        finally:
+            database.close()
+        sys.exit(0)
 
-conn.close()
\ No newline at end of file
+    main_menu()
+    database.close()
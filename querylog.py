@@ -0,0 +1,285 @@
+"""Per-statement timing for everything run through the connection pool.
+
+    log = QueryLog(slow_ms=50)
+    database.configure(path, query_log=log)
+    ...
+    log.dump()
+
+A pool configured with a QueryLog opens its connections with ProfiledConnection,
+whose cursors time each statement from execute() through its last fetch and count
+the rows it returned or changed. Statements are grouped by fingerprint (the text
+with whitespace collapsed and literals and IN lists folded to ?), each group
+keeping a latency histogram. The first time a fingerprint runs longer than slow_ms
+its EXPLAIN QUERY PLAN is recorded next to it. A pool configured without one uses
+plain sqlite3 connections, so the layer costs nothing while it is off.
+"""
+import atexit
+import bisect
+import itertools
+import operator
+import re
+import sqlite3 as sql
+import sys
+import threading
+import time
+from sqlite3 import Cursor
+from time import perf_counter
+
+SLOW_MS = 50.0
+# Upper bounds of the histogram buckets in milliseconds; the last bucket is open-ended
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+MAX_FINGERPRINTS = 10000  # cached statement texts, bounding SQL built with literals in it
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+SPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """The statement with whitespace collapsed and literals and IN lists folded to ?"""
+    text = LITERALS.sub("?", SPACE.sub(" ", statement).strip())
+    return IN_LIST.sub("IN (?+)", text)
+
+
+class StatementStats:
+    """Totals and a latency histogram for one fingerprint"""
+
+    __slots__ = ("calls", "seconds", "max_seconds", "rows", "buckets", "plan")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.plan = None
+
+    def percentile(self, fraction):
+        """Upper bound in ms of the bucket holding that fraction of calls (None if open-ended)"""
+        wanted = fraction * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+
+class QueryLog:
+    """Collects StatementStats by fingerprint from any number of pooled connections
+
+    record() only appends the sample to a list kept per statement text; the lists
+    are folded into the histograms every FOLD_EVERY runs of a statement and
+    whenever the stats are read, keeping the cost per statement to an append.
+    """
+
+    FOLD_EVERY = 1024
+
+    def __init__(self, slow_ms=SLOW_MS):
+        self.slow_ms = slow_ms
+        self.started = time.time()
+        self._slow_seconds = slow_ms / 1000
+        self._stats = {}
+        self._plans = {}
+        self._pending = {}   # statement text: [(seconds, rows)] not yet folded into _stats
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, statement):
+        key = self._fingerprints.get(statement)
+        if key is None:
+            if len(self._fingerprints) >= MAX_FINGERPRINTS:
+                self._fingerprints.clear()
+            key = self._fingerprints[statement] = fingerprint(statement)
+        return key
+
+    def record(self, conn, statement, parameters, seconds, rows):
+        """Adds one execution; explains it on conn if it is the first slow run of its fingerprint"""
+        pending = self._pending.get(statement)
+        if pending is None:
+            pending = self._pending.setdefault(statement, [])
+        pending.append((seconds, rows))
+        if seconds >= self._slow_seconds:
+            key = self._fingerprint(statement)
+            if key not in self._plans:
+                self._plans[key] = []   # claimed, so other threads don't explain it as well
+                self._plans[key] = explain_plan(conn, statement, parameters)
+        if len(pending) >= self.FOLD_EVERY:
+            self._fold()
+
+    def _fold(self):
+        with self._lock:
+            for statement, pending in list(self._pending.items()):
+                count = len(pending)
+                if not count:
+                    continue
+                # Other threads only ever append, so the first count entries are ours to take
+                seconds, rows = zip(*pending[:count])
+                del pending[:count]
+                key = self._fingerprint(statement)
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = StatementStats()
+                stats.calls += count
+                stats.seconds += sum(seconds)
+                stats.rows += sum(rows)
+                stats.max_seconds = max(stats.max_seconds, *seconds)
+                milliseconds = map(operator.mul, seconds, itertools.repeat(1000))
+                for bucket in map(bisect.bisect_left, itertools.repeat(BUCKETS_MS), milliseconds):
+                    stats.buckets[bucket] += 1
+            if len(self._pending) >= MAX_FINGERPRINTS:
+                self._pending = {}
+
+    def reset(self):
+        with self._lock:
+            self._pending = {}
+            self._stats = {}
+            self._plans = {}
+            self.started = time.time()
+
+    def summary(self, top=None):
+        """[(fingerprint, StatementStats)] by total time, most expensive first"""
+        self._fold()
+        with self._lock:
+            for key, stats in self._stats.items():
+                stats.plan = self._plans.get(key)
+            ranked = sorted(self._stats.items(), key=lambda entry: entry[1].seconds, reverse=True)
+        return ranked[:top] if top else ranked
+
+    def as_json(self, top=None):
+        return {
+            "since": self.started,
+            "slow_ms": self.slow_ms,
+            "buckets_ms": list(BUCKETS_MS),
+            "statements": [{"statement": key, "calls": stats.calls, "total_ms": round(stats.seconds * 1000, 3),
+                            "max_ms": round(stats.max_seconds * 1000, 3), "rows": stats.rows,
+                            "histogram": stats.buckets, "plan": stats.plan}
+                           for key, stats in self.summary(top)],
+        }
+
+    def dump(self, file=None, top=20):
+        """Prints the top statements by total time with their histograms and slow plans"""
+        file = file or sys.stderr
+        ranked = self.summary(top)
+        total = sum(stats.seconds for _, stats in ranked) or 1.0
+        print(f"\nQuery log: {len(self._stats)} distinct statements since {time.ctime(self.started)}", file=file)
+        print(f"{'Calls':>8} | {'Total ms':>10} | {'%':>5} | {'Mean ms':>8} | {'p95 ms':>7} | "
+              f"{'Max ms':>8} | {'Rows':>9} | Statement", file=file)
+        for key, stats in ranked:
+            p95 = stats.percentile(0.95)
+            print(f"{stats.calls:>8} | {stats.seconds * 1000:>10.1f} | {stats.seconds / total:>5.0%} | "
+                  f"{stats.seconds * 1000 / stats.calls:>8.2f} | {p95 if p95 else '>' + str(BUCKETS_MS[-1]):>7} | "
+                  f"{stats.max_seconds * 1000:>8.1f} | {stats.rows:>9} | {key[:100]}", file=file)
+        slow = [(key, stats) for key, stats in ranked if stats.plan]
+        for key, stats in slow:
+            print(f"\nSlow ({stats.max_seconds * 1000:.1f} ms): {key}", file=file)
+            for line in stats.plan:
+                print(f"    {line}", file=file)
+        file.flush()
+
+    def dump_at_exit(self, file=None, top=20):
+        atexit.register(self.dump, file, top)
+
+
+def explain_plan(conn, statement, parameters):
+    """EXPLAIN QUERY PLAN lines for a statement, or an empty list for one that has no plan"""
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return []
+    try:
+        # A plain cursor, so explaining is not itself recorded. Opening it fails too when
+        # the cursor being reported is collected after its connection was closed
+        cursor = sql.Cursor(conn)
+        try:
+            return [detail for _, _, _, detail in cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+        finally:
+            cursor.close()
+    except sql.Error as error:
+        return [f"(not explained: {error})"]
+
+
+class ProfiledCursor(sql.Cursor):
+    """A cursor that reports each statement to its connection's QueryLog once it is done with it
+
+    A statement is done when the cursor runs the next one, is closed or is dropped;
+    time spent fetching its rows counts towards it.
+    """
+
+    _statement = None   # the statement in progress, with its parameters, seconds and rows so far
+    _parameters = ()
+    _seconds = 0.0
+    _rows = 0
+
+    def _finish(self):
+        if self._statement is not None:
+            statement, self._statement = self._statement, None
+            self.connection.query_log.record(self.connection, statement, self._parameters, self._seconds, self._rows)
+
+    def execute(self, statement, parameters=()):
+        self._finish()
+        start = perf_counter()
+        try:
+            Cursor.execute(self, statement, parameters)
+        finally:
+            self._seconds = perf_counter() - start
+            self._statement, self._parameters, self._rows = statement, parameters, max(self.rowcount, 0)
+        return self
+
+    def executemany(self, statement, seq_of_parameters):
+        self._finish()
+        # Keep the first parameter set for EXPLAIN without materialising a streamed batch
+        rows = iter(seq_of_parameters)
+        first = next(rows, None)
+        start = perf_counter()
+        try:
+            Cursor.executemany(self, statement, () if first is None else itertools.chain((first,), rows))
+        finally:
+            self._seconds = perf_counter() - start
+            self._statement, self._parameters, self._rows = statement, first or (), max(self.rowcount, 0)
+        return self
+
+    def fetchone(self):
+        start = perf_counter()
+        row = Cursor.fetchone(self)
+        self._seconds += perf_counter() - start
+        self._rows += row is not None
+        return row
+
+    def fetchmany(self, size=None):
+        start = perf_counter()
+        rows = Cursor.fetchmany(self, self.arraysize if size is None else size)
+        self._seconds += perf_counter() - start
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start = perf_counter()
+        rows = Cursor.fetchall(self)
+        self._seconds += perf_counter() - start
+        self._rows += len(rows)
+        return rows
+
+    def __next__(self):
+        start = perf_counter()
+        try:
+            row = Cursor.__next__(self)
+        finally:
+            self._seconds += perf_counter() - start
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        Cursor.close(self)
+
+    def __del__(self):
+        self._finish()
+
+
+class ProfiledConnection(sql.Connection):
+    """A connection whose cursors, including those made by execute(), are ProfiledCursors"""
+
+    query_log = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
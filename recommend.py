@@ -0,0 +1,205 @@
+"""Precomputes "also borrowed" lists and the popular-now rankings from circulation history.
+
+Usage: python recommend.py [--db library.db] [--chunk 500000]
+
+Meant to run nightly, like reports.py. Three tables (migration 10) are rebuilt in
+one transaction, so the desk keeps reading the previous lists until the new ones
+commit, and each list is then served by one primary-key lookup:
+
+    ItemSimilarity   per item, the NEIGHBOURS titles most often borrowed by the same
+                     patrons, scored by the cosine similarity of their borrower sets
+    TrendingItems    the TRENDING_SIZE titles borrowed most lately, each loan's weight
+                     halving every HALF_LIFE_DAYS
+    RequestedTitles  FutureItems purchase suggestions counted by title
+
+Loans, archived ones included, are read in chunks into NumPy arrays. The co-borrowing
+counts are the item-by-item product A'A of the sparse borrower-by-item matrix A,
+worked out without SciPy by generating every borrower's item pairs and counting
+equal pairs after a sort. A borrower with n titles makes n(n-1)/2 pairs, so only
+each borrower's MAX_HISTORY most recent titles take part. Needs NumPy.
+"""
+import argparse
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import database
+from database import unit_of_work
+from reports import COPIES, CHUNK_SIZE, chunks
+
+MAX_HISTORY = 100        # most recent distinct titles per borrower that count towards similarity
+NEIGHBOURS = 10          # similar titles kept per item
+MIN_CO_BORROWERS = 2     # pairs borrowed together by fewer patrons are noise
+TRENDING_SIZE = 100
+TRENDING_DAYS = 90       # older loans don't count towards trending at all
+HALF_LIFE_DAYS = 14
+REQUESTED_SIZE = 50
+PAIR_BATCH = 1000000     # item pairs generated at a time
+
+TODAY = "SELECT JULIANDAY(DATE('now'))"
+LOANS = "SELECT BorrowerID, CopyID, JULIANDAY(BorrowDate) FROM LoanHistory"
+REQUESTED = """
+    SELECT MIN(Title), MIN(ItemType), COUNT(*) FROM FutureItems
+    GROUP BY LOWER(TRIM(Title))
+    ORDER BY COUNT(*) DESC, MIN(FutureItemID)
+    LIMIT ?
+"""
+CLEAR = ("DELETE FROM ItemSimilarity", "DELETE FROM TrendingItems", "DELETE FROM RequestedTitles")
+INSERT_SIMILAR = """
+    INSERT INTO ItemSimilarity (ItemID, Rank, SimilarItemID, Score, CoBorrowers) VALUES (?, ?, ?, ?, ?)
+"""
+INSERT_TRENDING = "INSERT INTO TrendingItems (Rank, ItemID, Score, RecentLoans) VALUES (?, ?, ?, ?)"
+INSERT_REQUESTED = "INSERT INTO RequestedTitles (Rank, Title, ItemType, Requests) VALUES (?, ?, ?, ?)"
+
+
+def load_loans(cursor, chunk_size):
+    """Returns (BorrowerID, ItemID, borrow day as a Julian day number) arrays for loans of existing copies"""
+    copies = np.array(cursor.execute(COPIES).fetchall(), np.int64).reshape(-1, 2)
+    copy_item = np.zeros((copies[:, 0].max() + 1) if len(copies) else 1, np.int64)
+    copy_item[copies[:, 0]] = copies[:, 1]
+    parts = []
+    for chunk in chunks(cursor, LOANS, chunk_size):
+        chunk = chunk[~np.isnan(chunk).any(axis=1)]
+        copy_ids = chunk[:, 1].astype(np.int64)
+        known = copy_ids < len(copy_item)
+        items = np.where(known, copy_item[np.where(known, copy_ids, 0)], 0)
+        listed = items > 0
+        parts.append((chunk[listed, 0].astype(np.int64), items[listed], chunk[listed, 2]))
+    if not parts:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float64)
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def group_starts(keys):
+    """Start of each run of equal values in a sorted array, and each run's length"""
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, np.int64)
+    return starts, np.diff(np.r_[starts, len(keys)])
+
+
+def histories(borrower, item, day):
+    """Each borrower's distinct titles, newest first and at most MAX_HISTORY, grouped by borrower"""
+    order = np.lexsort((-day, item, borrower))
+    borrower, item, day = borrower[order], item[order], day[order]
+    first = np.r_[True, (borrower[1:] != borrower[:-1]) | (item[1:] != item[:-1])]
+    borrower, item, day = borrower[first], item[first], day[first]
+    order = np.lexsort((-day, borrower))
+    borrower, item = borrower[order], item[order]
+    starts, sizes = group_starts(borrower)
+    position = np.arange(len(borrower)) - np.repeat(starts, sizes)
+    keep = position < MAX_HISTORY
+    return borrower[keep], item[keep]
+
+
+def co_borrowed(borrower, item, width):
+    """(pair keys low * width + high, borrowers in common) for every pair of titles borrowed together
+
+    borrower and item are histories grouped by borrower, as histories() returns them.
+    """
+    starts, sizes = group_starts(borrower)
+    # Each title pairs with the titles after it in its borrower's history
+    later = np.repeat(starts + sizes, sizes) - np.arange(len(item)) - 1
+    made = np.cumsum(later)
+    keys = np.empty(int(made[-1]) if len(made) else 0, np.int64)
+    begin = 0
+    while begin < len(item):
+        before = int(made[begin - 1]) if begin else 0
+        stop = max(begin + 1, int(np.searchsorted(made, before + PAIR_BATCH, side="right")))
+        partners = later[begin:stop]
+        left = np.repeat(np.arange(begin, stop), partners)
+        right = left + 1 + np.arange(len(left)) - np.repeat(np.cumsum(partners) - partners, partners)
+        a, b = item[left], item[right]
+        keys[before:before + len(left)] = np.minimum(a, b) * width + np.maximum(a, b)
+        begin = stop
+    keys.sort()
+    starts, counts = group_starts(keys)
+    return keys[starts], counts
+
+
+def similar_items(borrower, item, width):
+    """ItemSimilarity rows (ItemID, Rank, SimilarItemID, Score, CoBorrowers) from loan histories"""
+    keys, shared = co_borrowed(borrower, item, width)
+    strong = shared >= MIN_CO_BORROWERS
+    keys, shared = keys[strong], shared[strong]
+    low, high = keys // width, keys % width
+    borrowers_of = np.bincount(item, minlength=width).astype(np.float64)
+    score = shared / np.sqrt(borrowers_of[low] * borrowers_of[high])
+    # Similarity is symmetric: each pair lists both titles against each other
+    source, target = np.r_[low, high], np.r_[high, low]
+    score, shared = np.r_[score, score], np.r_[shared, shared]
+    order = np.lexsort((target, -score, source))
+    source, target, score, shared = source[order], target[order], score[order], shared[order]
+    starts, sizes = group_starts(source)
+    rank = np.arange(len(source)) - np.repeat(starts, sizes) + 1
+    keep = rank <= NEIGHBOURS
+    return list(zip(source[keep].tolist(), rank[keep].tolist(), target[keep].tolist(),
+                    np.round(score[keep], 6).tolist(), shared[keep].tolist()))
+
+
+def trending_items(item, day, today, width):
+    """TrendingItems rows (Rank, ItemID, Score, RecentLoans), loans weighted by how recent they are"""
+    recent = day >= today - TRENDING_DAYS
+    age = today - day[recent]
+    score = np.bincount(item[recent], 0.5 ** (np.maximum(age, 0) / HALF_LIFE_DAYS), minlength=width)
+    loans = np.bincount(item[recent], minlength=width)
+    top = np.flatnonzero(score)
+    top = top[np.lexsort((top, -score[top]))][:TRENDING_SIZE]
+    return [(rank, int(item_id), round(float(score[item_id]), 6), int(loans[item_id]))
+            for rank, item_id in enumerate(top, start=1)]
+
+
+def build_recommendations(chunk_size=CHUNK_SIZE):
+    """Reads the loan history once and returns ({table: rows}, {figure: value}) for store_recommendations"""
+    with unit_of_work() as cursor:
+        today = cursor.execute(TODAY).fetchone()[0]
+        borrower, item, day = load_loans(cursor, chunk_size)
+        requested = [(rank, *row) for rank, row in
+                     enumerate(cursor.execute(REQUESTED, (REQUESTED_SIZE,)).fetchall(), start=1)]
+    width = int(item.max()) + 1 if len(item) else 1
+    history_borrowers, history_items = histories(borrower, item, day)
+    tables = {
+        "ItemSimilarity": similar_items(history_borrowers, history_items, width),
+        "TrendingItems": trending_items(item, day, today, width),
+        "RequestedTitles": requested,
+    }
+    _, sizes = group_starts(history_borrowers)
+    figures = {"loans": len(item), "history entries": len(history_items),
+               "item pairs counted": int((sizes * (sizes - 1) // 2).sum()),
+               "titles with neighbours": len({row[0] for row in tables["ItemSimilarity"]})}
+    return tables, figures
+
+
+def store_recommendations(tables):
+    """Replaces the three recommendation tables in one write transaction"""
+    with unit_of_work(immediate=True) as cursor:
+        for statement in CLEAR:
+            cursor.execute(statement)
+        cursor.executemany(INSERT_SIMILAR, tables["ItemSimilarity"])
+        cursor.executemany(INSERT_TRENDING, tables["TrendingItems"])
+        cursor.executemany(INSERT_REQUESTED, tables["RequestedTitles"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the recommendation tables from loan history")
+    parser.add_argument("--db", default=database.DB_PATH, help="database file to read and update")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE, help="loans read per chunk")
+    args = parser.parse_args()
+    if np is None:
+        sys.exit("recommend.py needs NumPy: pip install numpy")
+    database.configure(args.db)
+    try:
+        start = time.perf_counter()
+        tables, figures = build_recommendations(args.chunk)
+        built = time.perf_counter() - start
+        store_recommendations(tables)
+        stored = time.perf_counter() - start - built
+        for name, value in figures.items():
+            print(f"{name:<24} {value:>10}")
+        for name, rows in tables.items():
+            print(f"{name:<24} {len(rows):>10} rows")
+        print(f"\nBuilt in {built:.2f}s, stored in {stored:.2f}s.")
+    finally:
+        database.close()
@@ -0,0 +1,271 @@
+"""Nightly circulation reports, aggregated with NumPy over loans streamed in chunks.
+
+Usage: python reports.py OUTDIR [--format csv|parquet] [--chunk 500000] [--check]
+
+Writes three tables to OUTDIR:
+
+    overdue_by_type     open loans, overdue loans and fines accrued on them, per item type
+    fines_by_bucket     borrowers and their outstanding fines, bucketed by each borrower's total
+    circulation         loans per title, archived loans included, busiest first
+
+Rows come out of SQLite a chunk at a time as plain numbers and are joined to the
+catalog through arrays indexed by CopyID and ItemID, so memory grows with the catalog
+and the number of borrowers but not with the loan history. Building a Python tuple
+per loan costs more than all the arithmetic, so SQLite counts loans per copy over
+its CopyID index (migration 7) and only open or unpaid loans are read one by one.
+Fines follow services.FINE_AMOUNT, with "now" fixed once at the start so every
+table agrees. --check recomputes each table
+with SQL and fails on any difference. Needs NumPy; Parquet output also needs pyarrow.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import database
+import services
+from database import unit_of_work
+
+CHUNK_SIZE = 500000
+FINE_BUCKETS = (5, 10, 25, 50, 100)   # upper bounds in dollars; one more bucket holds the rest
+
+CLOCK = "SELECT JULIANDAY('now'), JULIANDAY(DATE('now')), DATE('now')"
+CATALOG = "SELECT ItemID, Title, ItemType FROM LibraryItem"
+COPIES = "SELECT CopyID, ItemID FROM LibraryCopy"
+BORROWER_COUNT = "SELECT COALESCE(MAX(BorrowerID), 0) FROM Borrowers"
+OUTSTANDING_LOANS = """
+    SELECT CopyID, BorrowerID, JULIANDAY(DueDate), ReturnDate IS NULL, PaidStatus = 'Unpaid',
+           COALESCE(FineAmount, 0)
+    FROM BorrowingTransactions
+    WHERE ReturnDate IS NULL OR PaidStatus = 'Unpaid'
+"""
+LOANS_PER_COPY = "SELECT CopyID, COUNT(*) FROM BorrowingTransactions GROUP BY CopyID"
+ARCHIVED_LOANS_PER_COPY = "SELECT CopyID, COUNT(*) FROM BorrowingTransactionsArchive GROUP BY CopyID"
+
+# The same fine as services.FINE_AMOUNT, with JULIANDAY('now'), DATE('now') and the daily
+# rate as parameters
+FINE = """
+    CASE WHEN bt.ReturnDate IS NULL AND bt.DueDate < :today AND bt.PaidStatus = 'Unpaid'
+         THEN (:now - JULIANDAY(bt.DueDate)) * :rate
+         ELSE bt.FineAmount END"""
+OVERDUE = "bt.DueDate < :today AND bt.PaidStatus = 'Unpaid'"
+CHECK_OVERDUE_BY_TYPE = f"""
+    SELECT li.ItemType, COUNT(*), SUM({OVERDUE}), TOTAL(CASE WHEN {OVERDUE} THEN {FINE} ELSE 0 END)
+    FROM BorrowingTransactions bt
+    JOIN LibraryCopy lc ON bt.CopyID = lc.CopyID
+    JOIN LibraryItem li ON lc.ItemID = li.ItemID
+    WHERE bt.ReturnDate IS NULL
+    GROUP BY li.ItemType
+"""
+CHECK_FINES_BY_BUCKET = f"""
+    WITH owed AS (
+        SELECT BorrowerID, TOTAL({FINE}) AS amount
+        FROM BorrowingTransactions bt
+        WHERE bt.PaidStatus = 'Unpaid'
+        GROUP BY BorrowerID
+        HAVING amount > 0
+    )
+    SELECT CASE {{buckets}} END, COUNT(*), TOTAL(amount) FROM owed GROUP BY 1
+"""
+CHECK_CIRCULATION = """
+    SELECT lc.ItemID, COUNT(*)
+    FROM LoanHistory h
+    JOIN LibraryCopy lc ON h.CopyID = lc.CopyID
+    GROUP BY lc.ItemID
+"""
+# What build_reports loads, for project.py check-plans. Reports read whole tables by design.
+QUERY_PLAN_CHECKS = [
+    ("reports: catalog", CATALOG, ()),
+    ("reports: copies", COPIES, ()),
+    ("reports: borrower count", BORROWER_COUNT, ()),
+    ("reports: outstanding loans", OUTSTANDING_LOANS, ()),
+    ("reports: loans per copy", LOANS_PER_COPY, ()),
+    ("reports: archived loans per copy", ARCHIVED_LOANS_PER_COPY, ()),
+]
+FULL_SCAN_ALLOWED = {name for name, _, _ in QUERY_PLAN_CHECKS}
+
+REPORT_COLUMNS = {
+    "overdue_by_type": ("ItemType", "OpenLoans", "Overdue", "AccruedFines"),
+    "fines_by_bucket": ("Bucket", "Borrowers", "Fines"),
+    "circulation": ("ItemID", "Title", "ItemType", "Loans"),
+}
+
+
+def bucket_labels():
+    bounds = (0,) + FINE_BUCKETS
+    labels = [f"${low}-{high}" for low, high in zip(bounds, bounds[1:])]
+    return labels + [f"over ${FINE_BUCKETS[-1]}"]
+
+
+def add_counts(total, index, weights=None):
+    """Adds a bincount of index into total, growing total if index runs past its end"""
+    counts = np.bincount(index, weights, minlength=len(total))
+    if len(counts) > len(total):
+        total = np.concatenate([total, np.zeros(len(counts) - len(total), total.dtype)])
+    total += counts.astype(total.dtype, copy=False)
+    return total
+
+
+def load_catalog(cursor):
+    """Returns (titles by ItemID, type code by ItemID, type names by code, ItemID by CopyID)"""
+    items = cursor.execute(CATALOG).fetchall()
+    size = max((item_id for item_id, _, _ in items), default=0) + 1
+    titles = [None] * size
+    item_type = np.zeros(size, np.int32)
+    types = {}
+    for item_id, title, kind in items:
+        titles[item_id] = title
+        item_type[item_id] = types.setdefault(kind, len(types))
+    copies = np.array(cursor.execute(COPIES).fetchall(), np.int64).reshape(-1, 2)
+    copy_item = np.zeros((copies[:, 0].max() + 1) if len(copies) else 1, np.int64)
+    copy_item[copies[:, 0]] = copies[:, 1]
+    return titles, item_type, list(types), copy_item
+
+
+def chunks(cursor, query, size):
+    """Yields the rows of query as 2-D float64 arrays of up to size rows, NULLs as NaN"""
+    cursor.execute(query)
+    while rows := cursor.fetchmany(size):
+        yield np.array(rows, np.float64)
+
+
+def build_reports(chunk_size=CHUNK_SIZE):
+    """Streams the loan tables once and returns ({report name: rows}, clock) for write_reports"""
+    with unit_of_work() as cursor:
+        now, today, today_text = cursor.execute(CLOCK).fetchone()
+        titles, item_type, type_names, copy_item = load_catalog(cursor)
+        open_loans = np.zeros(len(type_names), np.int64)
+        overdue = np.zeros(len(type_names), np.int64)
+        accrued = np.zeros(len(type_names), np.float64)
+        owed = np.zeros(cursor.execute(BORROWER_COUNT).fetchone()[0] + 1, np.float64)
+        loans = np.zeros(len(titles), np.int64)
+
+        def items_of(copy_ids):
+            # Copies that no longer exist map to item 0, which is never a real ItemID
+            copy_ids = copy_ids.astype(np.int64)
+            known = copy_ids < len(copy_item)
+            return np.where(known, copy_item[np.where(known, copy_ids, 0)], 0)
+
+        for chunk in chunks(cursor, OUTSTANDING_LOANS, chunk_size):
+            copy_id, borrower, due, is_open, unpaid, stored = chunk.T
+            is_open, unpaid = is_open.astype(bool), unpaid.astype(bool)
+            items = items_of(copy_id)
+            listed = items > 0
+            late = is_open & unpaid & (due < today)
+            fine = np.where(late, (now - due) * services.FINE_PER_DAY, stored)
+
+            late_types = item_type[items[listed & late]]
+            open_loans += np.bincount(item_type[items[listed & is_open]], minlength=len(type_names))
+            overdue += np.bincount(late_types, minlength=len(type_names))
+            accrued += np.bincount(late_types, fine[listed & late], minlength=len(type_names))
+            owed = add_counts(owed, borrower[unpaid].astype(np.int64), fine[unpaid])
+
+        for query in (LOANS_PER_COPY, ARCHIVED_LOANS_PER_COPY):
+            for chunk in chunks(cursor, query, chunk_size):
+                items = items_of(chunk[:, 0])
+                loans = add_counts(loans, items[items > 0], chunk[items > 0, 1])
+
+    labels = bucket_labels()
+    owing = owed[owed > 0]
+    bucket = np.searchsorted(np.array(FINE_BUCKETS, np.float64), owing, side="left")
+    borrowers = np.bincount(bucket, minlength=len(labels))
+    fines = np.bincount(bucket, owing, minlength=len(labels))
+
+    busiest = np.flatnonzero(loans)
+    busiest = busiest[np.lexsort((busiest, -loans[busiest]))]
+    reports = {
+        "overdue_by_type": [(type_names[code], int(open_loans[code]), int(overdue[code]), round(float(accrued[code]), 2))
+                            for code in range(len(type_names)) if open_loans[code]],
+        "fines_by_bucket": [(labels[i], int(borrowers[i]), round(float(fines[i]), 2))
+                            for i in range(len(labels)) if borrowers[i]],
+        "circulation": [(int(item_id), titles[item_id], type_names[item_type[item_id]], int(loans[item_id]))
+                        for item_id in busiest],
+    }
+    return reports, {"now": now, "today": today_text, "rate": services.FINE_PER_DAY}
+
+
+def write_reports(reports, directory, fmt="csv"):
+    """Writes each report to directory as NAME.csv or NAME.parquet; returns the paths"""
+    if fmt == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow") from None
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, rows in reports.items():
+        columns = REPORT_COLUMNS[name]
+        path = os.path.join(directory, f"{name}.{fmt}")
+        if fmt == "parquet":
+            table = pyarrow.table({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+            pyarrow.parquet.write_table(table, path)
+        else:
+            with open(path, "w", newline="", encoding="utf-8") as file:
+                writer = csv.writer(file)
+                writer.writerow(columns)
+                writer.writerows(rows)
+        paths.append(path)
+    return paths
+
+
+def check_reports(reports, clock):
+    """Recomputes every report in SQL at the same clock; returns a list of differences"""
+    labels = bucket_labels()
+    buckets = " ".join(f"WHEN amount <= {high} THEN '{label}'" for high, label in zip(FINE_BUCKETS, labels))
+    buckets += f" ELSE '{labels[-1]}'"
+    with unit_of_work() as cursor:
+        expected = {
+            "overdue_by_type": cursor.execute(CHECK_OVERDUE_BY_TYPE, clock).fetchall(),
+            "fines_by_bucket": cursor.execute(CHECK_FINES_BY_BUCKET.format(buckets=buckets), clock).fetchall(),
+            "circulation": cursor.execute(CHECK_CIRCULATION).fetchall(),
+        }
+    got = {
+        "overdue_by_type": reports["overdue_by_type"],
+        "fines_by_bucket": reports["fines_by_bucket"],
+        "circulation": [(item_id, loans) for item_id, _, _, loans in reports["circulation"]],
+    }
+    differences = []
+    for name, rows in expected.items():
+        want = {row[0]: row[1:] for row in rows}
+        have = {row[0]: row[1:] for row in got[name]}
+        for key in want.keys() | have.keys():
+            a, b = want.get(key), have.get(key)
+            if a is None or b is None or not np.allclose(np.array(a, np.float64), np.array(b, np.float64), atol=0.01):
+                differences.append(f"{name} {key!r}: SQL {a}, NumPy {b}")
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write overdue, fine and circulation reports")
+    parser.add_argument("directory", help="where to write the report files")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE, help="loans read per chunk")
+    parser.add_argument("--db", default=database.DB_PATH, help="database file to report on")
+    parser.add_argument("--check", action="store_true", help="cross-check every report against SQL")
+    args = parser.parse_args()
+    if np is None:
+        sys.exit("reports.py needs NumPy: pip install numpy")
+    database.configure(args.db)
+    try:
+        start = time.perf_counter()
+        reports, clock = build_reports(args.chunk)
+        elapsed = time.perf_counter() - start
+        for path in write_reports(reports, args.directory, args.format):
+            print(path)
+        print(f"\nBuilt reports as of {clock['today']} in {elapsed:.2f}s.")
+        if args.check:
+            differences = check_reports(reports, clock)
+            for difference in differences:
+                print(difference)
+            print(f"Cross-check against SQL: {'FAILED' if differences else 'all reports match'}.")
+            if differences:
+                sys.exit(1)
+    finally:
+        database.close()
@@ -0,0 +1,364 @@
+"""HTTP/JSON front end for the circulation desk, over the same services as the menus.
+
+Usage: python server.py [--host 127.0.0.1] [--port 8080] [--db library.db]
+                        [--durability normal] [--group-commit]
+
+    GET  /items?page=0                      catalog, a page at a time
+    GET  /search?q=words&page=0&fuzzy=0     full-text catalog search; closest matches if none
+    GET  /items/<id>                        one item with its available copies
+    GET  /items/<id>/branches               copies on the shelf at each branch
+    POST /loans {"borrower_id", "item_id", "branch_id"?}  borrow a copy, at one branch if given
+    POST /loans/<id>/return                 return a loan
+    POST /items/<id>/holds {"borrower_id", "branch_id"?}  hold for pickup at a branch
+    POST /holds/<id>/cancel {"borrower_id"} withdraw a hold
+    GET  /borrowers/<id>/holds?page=0       waiting, in transit and ready holds
+    GET  /branches                          every branch
+    GET  /branches/<id>/transfers?page=0    copies a branch has to send for holds
+    POST /transfers/<id>/receive            a transferred copy arrived at its pickup branch
+    GET  /borrowers/<id>/fines              outstanding fines
+    GET  /borrowers/<id>/history?page=0     every loan, archived or not
+    GET  /events?name=&type=&branch=&page=0 upcoming events
+    POST /events/<id>/registrations {"borrower_id"}
+    POST /events/<id>/waitlist {"borrower_id"}
+    DELETE /events/<id>/registrations/<borrower id>   leave an event or its waitlist
+    GET  /debug/queries?top=20              statement timings, when run with --query-log
+
+Services block on SQLite, so they run on a thread pool the size of the connection
+pool; requests beyond MAX_PENDING wait on the event loop instead of piling into the
+executor queue. GET responses for the catalog and event lists are cached for
+CACHE_SECONDS, and any successful write empties that cache. With --group-commit the
+workers' writes are queued to one writer thread and committed together (see
+database.GroupCommitWriter), which matters most at --durability full.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import dataclasses
+import json
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import database
+import querylog
+import services
+from cache import ReadCache
+
+MAX_PENDING = 64       # service calls queued or running at once
+CACHE_SECONDS = 2.0
+CACHE_ENTRIES = 1024
+MAX_BODY = 64 * 1024
+
+STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 402: "Payment Required", 404: "Not Found",
+               405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+
+# Most specific first: FinesOutstanding must be matched before its ServiceError base
+ERROR_STATUS = [
+    (services.NotFound, 404),
+    (services.FinesOutstanding, 402),
+    (services.Unavailable, 409),
+    (services.Conflict, 409),
+    (services.ServiceError, 400),
+    (database.PoolExhausted, 503),
+]
+
+
+query_log = None   # set by run() when started with --query-log
+
+
+class BadRequest(Exception):
+    """Raised for a malformed request line, header, body or parameter"""
+
+
+def page_json(pager):
+    """The JSON form of a KeysetPager's current page"""
+    return {"page": pager.page, "columns": pager.columns, "rows": [list(row) for row in pager.rows],
+            "has_next": pager.has_next}
+
+
+def param(values, name, convert=str, default=None):
+    """Reads one query-string or body parameter, converting it or raising BadRequest"""
+    value = values.get(name, default)
+    if isinstance(value, list):
+        value = value[0]
+    if value is None:
+        raise BadRequest(f"missing parameter: {name}")
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"invalid parameter: {name}") from None
+
+
+def optional_param(values, name, convert=int):
+    """Like param(), but None when the parameter is absent"""
+    return None if values.get(name) is None else param(values, name, convert)
+
+
+def list_items(match, query, body):
+    return 200, page_json(services.list_items(param(query, "page", int, 0)))
+
+
+def search(match, query, body):
+    text, page = param(query, "q"), param(query, "page", int, 0)
+    if not param(query, "fuzzy", int, 0):
+        pager = services.search(text, page)
+        if pager.rows or page:
+            return 200, page_json(pager)
+    # Nothing matched exactly: the closest titles and authors, paged on with fuzzy=1
+    return 200, dict(page_json(services.fuzzy_search(text, page)), fuzzy=True)
+
+
+def get_item(match, query, body):
+    return 200, dataclasses.asdict(services.get_item(int(match["id"])))
+
+
+def item_branches(match, query, body):
+    services.get_item(int(match["id"]))
+    return 200, {"item_id": int(match["id"]),
+                 "branches": [{"branch_id": branch_id, "name": name, "available_copies": copies}
+                              for branch_id, name, copies in services.branch_availability(int(match["id"]))]}
+
+
+def borrow(match, query, body):
+    loan = services.borrow(param(body, "borrower_id", int), param(body, "item_id", int),
+                           optional_param(body, "branch_id"))
+    return 201, dataclasses.asdict(loan)
+
+
+def return_loan(match, query, body):
+    services.return_loan(int(match["id"]))
+    return 200, {"returned": int(match["id"])}
+
+
+def place_hold(match, query, body):
+    hold = services.place_hold(param(body, "borrower_id", int), int(match["id"]), optional_param(body, "branch_id"))
+    return 201, dataclasses.asdict(hold)
+
+
+def cancel_hold(match, query, body):
+    services.cancel_hold(param(body, "borrower_id", int), int(match["id"]))
+    return 200, {"cancelled": int(match["id"])}
+
+
+def holds(match, query, body):
+    return 200, page_json(services.holds(int(match["id"]), param(query, "page", int, 0)))
+
+
+def fines(match, query, body):
+    return 200, {"borrower_id": int(match["id"]), "fines": round(services.fines_due(int(match["id"])), 2)}
+
+
+def loan_history(match, query, body):
+    return 200, page_json(services.loan_history(int(match["id"]), param(query, "page", int, 0)))
+
+
+def list_events(match, query, body):
+    pager = services.upcoming_events(query.get("name", [None])[0], query.get("type", [None])[0],
+                                     param(query, "page", int, 0), optional_param(query, "branch"))
+    return 200, page_json(pager)
+
+
+def list_branches(match, query, body):
+    return 200, {"branches": [dataclasses.asdict(branch) for branch in services.branches()]}
+
+
+def transfers(match, query, body):
+    return 200, page_json(services.transfers(int(match["id"]), param(query, "page", int, 0)))
+
+
+def receive_transfer(match, query, body):
+    return 200, {"transfer_id": int(match["id"]), "hold_id": services.receive_transfer(int(match["id"]))}
+
+
+def register_for_event(match, query, body):
+    remaining = services.register_for_event(int(match["id"]), param(body, "borrower_id", int))
+    return 201, {"event_id": int(match["id"]), "remaining": remaining}
+
+
+def join_waitlist(match, query, body):
+    position = services.join_waitlist(int(match["id"]), param(body, "borrower_id", int))
+    return 201, {"event_id": int(match["id"]), "position": position}
+
+
+def cancel_registration(match, query, body):
+    services.cancel_registration(int(match["id"]), int(match["borrower"]))
+    return 200, {"event_id": int(match["id"]), "cancelled": int(match["borrower"])}
+
+
+def query_stats(match, query, body):
+    if query_log is None:
+        raise services.NotFound("query log is off; start the server with --query-log")
+    return 200, query_log.as_json(param(query, "top", int, 20))
+
+
+# (method, path pattern, handler, cacheable)
+ROUTES = [
+    ("GET", r"/items", list_items, True),
+    ("GET", r"/search", search, True),
+    ("GET", r"/items/(?P<id>\d+)", get_item, True),
+    ("GET", r"/items/(?P<id>\d+)/branches", item_branches, True),
+    ("POST", r"/loans", borrow, False),
+    ("POST", r"/loans/(?P<id>\d+)/return", return_loan, False),
+    ("POST", r"/items/(?P<id>\d+)/holds", place_hold, False),
+    ("POST", r"/holds/(?P<id>\d+)/cancel", cancel_hold, False),
+    ("GET", r"/borrowers/(?P<id>\d+)/holds", holds, False),
+    ("GET", r"/borrowers/(?P<id>\d+)/fines", fines, False),
+    ("GET", r"/borrowers/(?P<id>\d+)/history", loan_history, False),
+    ("GET", r"/events", list_events, True),
+    ("GET", r"/branches", list_branches, True),
+    ("GET", r"/branches/(?P<id>\d+)/transfers", transfers, False),
+    ("POST", r"/transfers/(?P<id>\d+)/receive", receive_transfer, False),
+    ("POST", r"/events/(?P<id>\d+)/registrations", register_for_event, False),
+    ("POST", r"/events/(?P<id>\d+)/waitlist", join_waitlist, False),
+    ("DELETE", r"/events/(?P<id>\d+)/registrations/(?P<borrower>\d+)", cancel_registration, False),
+    ("GET", r"/debug/queries", query_stats, False),
+]
+ROUTES = [(method, re.compile(pattern + "$"), handler, cacheable) for method, pattern, handler, cacheable in ROUTES]
+
+
+def encode_response(status, body, keep_alive=True):
+    head = (f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode() + body
+
+
+class DeskServer:
+    """Serves ROUTES over HTTP/1.1 with keep-alive, running services on a bounded thread pool"""
+
+    def __init__(self, workers=database.POOL_SIZE, max_pending=MAX_PENDING):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.cache = ReadCache(ttl=CACHE_SECONDS, size=CACHE_ENTRIES)
+
+    async def call(self, handler, *args):
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, handler, *args)
+
+    async def dispatch(self, method, target, body):
+        """Returns (status, JSON result) for one request"""
+        url = urlsplit(target)
+        routes = [(route_method, match, handler) for route_method, pattern, handler, _ in ROUTES
+                  if (match := pattern.match(url.path))]
+        if not routes:
+            return 404, {"error": f"no route for {url.path}"}
+        for route_method, match, handler in routes:
+            if method == route_method:
+                break
+        else:
+            return 405, {"error": f"{method} not allowed on {url.path}"}
+
+        try:
+            payload = json.loads(body) if body else {}
+            if not isinstance(payload, dict):
+                raise BadRequest("body must be a JSON object")
+            return await self.call(handler, match, parse_qs(url.query), payload)
+        except (BadRequest, json.JSONDecodeError) as error:
+            return 400, {"error": str(error)}
+        except Exception as error:
+            for error_type, status in ERROR_STATUS:
+                if isinstance(error, error_type):
+                    return status, {"error": str(error)}
+            raise
+
+    async def respond(self, method, target, body):
+        """Returns (status, encoded body), from the cache for cacheable GETs"""
+        cacheable = method == "GET" and any(cacheable and pattern.match(urlsplit(target).path)
+                                            for _, pattern, _, cacheable in ROUTES)
+        if cacheable and (cached := self.cache.get(target)):
+            return cached
+        status, result = await self.dispatch(method, target, body)
+        response = status, json.dumps(result).encode()
+        if cacheable and status == 200:
+            self.cache.put(target, response)
+        elif method != "GET" and status < 300:
+            self.cache.clear()
+        return response
+
+    async def handle(self, reader, writer):
+        """Serves requests on one connection until the client closes it or asks to"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    writer.write(encode_response(400, b'{"error": "malformed request line"}', keep_alive=False))
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    writer.write(encode_response(400, b'{"error": "malformed content-length"}', keep_alive=False))
+                    break
+                if length > MAX_BODY:
+                    writer.write(encode_response(413, b'{"error": "request body too large"}', keep_alive=False))
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                try:
+                    status, payload = await self.respond(method, target, body)
+                except Exception as error:
+                    status, payload = 500, json.dumps({"error": f"{type(error).__name__}: {error}"}).encode()
+                writer.write(encode_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        print(f"Serving on http://{host}:{port}", flush=True)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+
+def run(host="127.0.0.1", port=8080, path=database.DB_PATH, pool_size=database.POOL_SIZE, ready=None,
+        slow_ms=None, durability=database.DEFAULT_DURABILITY, group_commit=False):
+    """Opens the database at path and serves until interrupted
+
+    slow_ms turns on the query log, explaining statements slower than that; its
+    totals are served at /debug/queries and printed on shutdown. The group-commit
+    writer gets a connection of its own on top of the workers'.
+    """
+    global query_log
+    query_log = querylog.QueryLog(slow_ms) if slow_ms is not None else None
+    database.configure(path, pool_size + group_commit, query_log=query_log, durability=durability,
+                       group_commit=group_commit)
+    try:
+        asyncio.run(DeskServer(workers=pool_size).serve(host, port, ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        database.close()
+        if query_log is not None:
+            query_log.dump()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP/JSON front end for the library")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", default=database.DB_PATH, help="database file to serve")
+    parser.add_argument("--pool", type=int, default=database.POOL_SIZE, help="connections and worker threads")
+    parser.add_argument("--query-log", type=float, metavar="SLOW_MS",
+                        help="time every statement, explaining those slower than SLOW_MS")
+    parser.add_argument("--durability", choices=list(database.DURABILITY), default=database.DEFAULT_DURABILITY,
+                        help="full syncs every commit; normal only at checkpoints")
+    parser.add_argument("--group-commit", action="store_true", help="commit concurrent writes together")
+    args = parser.parse_args()
+    run(args.host, args.port, args.db, args.pool, slow_ms=args.query_log, durability=args.durability,
+        group_commit=args.group_commit)
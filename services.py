@@ -0,0 +1,1430 @@
+"""Library operations as plain functions, free of terminal input and output.
+
+Each service runs its own unit of work and either returns a result or raises a
+ServiceError subclass whose message is fit to show to the patron. List services
+return a KeysetPager positioned on the requested page; the full catalog list pages
+from an in-memory CatalogSnapshot instead, and typo-tolerant search results from
+a list reranked in memory. project.py is the terminal front end over these.
+
+Catalog and event reads go through a shared ReadCache. Reads are filed under tags
+(an item, an event, the catalog lists, the event lists) and each write service
+invalidates the tags it changes.
+"""
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+import math
+import re
+import sqlite3 as sql
+import time
+
+import database
+from cache import ReadCache
+from catalog import CatalogSnapshot, SnapshotPager, TermIndex, indexable, trigrams
+from database import unit_of_work
+
+ITEMS_PER_PAGE = 5
+LOAN_DAYS = 14
+REMINDER_DAYS = 3   # loans due this soon are flagged at login and get a reminder notice (notices.py)
+FINE_PER_DAY = 0.50
+
+# Fine owed on a transaction row (aliased bt). Open, overdue, unpaid loans accrue
+# $0.50 a day up to now; every other row keeps its stored FineAmount.
+# OpenLoan.fine() is the same rule for a BorrowerSession's loans held in memory.
+FINE_AMOUNT = f"""
+    CASE WHEN bt.ReturnDate IS NULL AND bt.DueDate < DATE('now') AND bt.PaidStatus = 'Unpaid'
+         THEN (JULIANDAY('now') - JULIANDAY(bt.DueDate)) * {FINE_PER_DAY}
+         ELSE bt.FineAmount END"""
+
+SELECT_BORROWER = "SELECT * FROM Borrowers WHERE BorrowerID=?"
+ITEM_COLUMNS = "li.ItemID, li.Title, li.ItemType, li.AuthorCreator, li.YearPublished"
+ALL_ITEMS = f"SELECT {{keys}}, {ITEM_COLUMNS} FROM LibraryItem li WHERE {{after}}"
+ITEM_ORDER = ("li.ItemID",)
+FIND_ITEM = "SELECT ItemID FROM LibraryItem WHERE Title=? AND AuthorCreator=?"
+INSERT_ITEM = "INSERT INTO LibraryItem (Title, ItemType, AuthorCreator, YearPublished) VALUES (?, ?, ?, ?)"
+INSERT_COPY = "INSERT INTO LibraryCopy (ItemID, Status, BranchID) VALUES (?, 'onShelf', ?)"
+# Maintained by triggers on LibraryCopy (migration 4)
+AVAILABLE_COPIES = "SELECT AvailableCopies FROM LibraryItem WHERE ItemID=?"
+
+# Branches (migration 13). BranchStock holds each item's on-shelf count per branch, so
+# availability at one branch is a primary-key lookup whatever the size of the catalog.
+MAIN_BRANCH = 1     # where copies, loans, events and holds belong unless told otherwise
+BRANCHES = "SELECT BranchID, Name, Latitude, Longitude FROM Branch ORDER BY BranchID"
+INSERT_BRANCH = "INSERT INTO Branch (Name, Latitude, Longitude) VALUES (?, ?, ?)"
+BRANCH_LOCATION = "SELECT Latitude, Longitude FROM Branch WHERE BranchID=?"
+# (the item's copies on the shelf anywhere, at the branch)
+BRANCH_AVAILABLE = """
+    SELECT li.AvailableCopies, COALESCE(s.AvailableCopies, 0)
+    FROM LibraryItem li
+    LEFT JOIN BranchStock s ON s.ItemID = li.ItemID AND s.BranchID = ?
+    WHERE li.ItemID = ?
+"""
+BRANCH_AVAILABILITY = """
+    SELECT b.BranchID, b.Name, s.AvailableCopies
+    FROM BranchStock s
+    JOIN Branch b ON b.BranchID = s.BranchID
+    WHERE s.ItemID = ? AND s.AvailableCopies > 0
+    ORDER BY b.Name
+"""
+STOCKED_BRANCHES = """
+    SELECT b.BranchID, b.Name, b.Latitude, b.Longitude
+    FROM BranchStock s
+    JOIN Branch b ON b.BranchID = s.BranchID
+    WHERE s.ItemID = ? AND s.AvailableCopies > 0
+"""
+COPY_BRANCH = "SELECT BranchID FROM LibraryCopy WHERE CopyID=?"
+ITEM_DETAILS = "SELECT ItemID, Title, ItemType, AuthorCreator, YearPublished, AvailableCopies FROM LibraryItem WHERE ItemID=?"
+
+# Borrowing and returning. Each guard re-checks the state it changes, so a copy or loan
+# that another session already took yields no row instead of a double loan or return.
+CLAIM_COPY = """
+    UPDATE LibraryCopy SET Status='Borrow'
+    WHERE CopyID = (SELECT CopyID FROM LibraryCopy WHERE ItemID=? AND Status='onShelf' LIMIT 1)
+    AND Status='onShelf'
+    RETURNING CopyID
+"""
+# (new status, ItemID, BranchID): an on-shelf copy of the item at one branch
+CLAIM_BRANCH_COPY = """
+    UPDATE LibraryCopy SET Status=?
+    WHERE CopyID = (SELECT CopyID FROM LibraryCopy WHERE ItemID=? AND BranchID=? AND Status='onShelf' LIMIT 1)
+    AND Status='onShelf'
+    RETURNING CopyID
+"""
+# The loan is recorded at the branch the copy is lent from
+INSERT_LOAN = f"""
+    INSERT INTO BorrowingTransactions (BorrowerID, CopyID, BorrowDate, DueDate, ReturnDate, FineAmount, PaidStatus,
+                                       BranchID)
+    VALUES (?1, ?2, DATE('now'), DATE('now', '+{LOAN_DAYS} days'), NULL, 0, 'Unpaid',
+            (SELECT BranchID FROM LibraryCopy WHERE CopyID = ?2))
+"""
+CLOSE_LOAN = """
+    UPDATE BorrowingTransactions SET ReturnDate=DATE('now') WHERE TransactionID=? AND ReturnDate IS NULL
+    RETURNING CopyID, (SELECT ItemID FROM LibraryCopy lc WHERE lc.CopyID = BorrowingTransactions.CopyID)
+"""
+# Read back after CLOSE_LOAN: the ApplyFineIfLate trigger may have fined a late return,
+# and RETURNING does not see what AFTER triggers write
+LOAN_FINE = "SELECT FineAmount, PaidStatus FROM BorrowingTransactions WHERE TransactionID=?"
+# (new status, CopyID, status it must still have)
+MOVE_COPY = "UPDATE LibraryCopy SET Status=? WHERE CopyID=? AND Status=?"
+
+# Holds (migration 8). A copy that comes free goes to the oldest waiting hold on its item
+# and stays 'onHold' until that borrower collects it or the pickup window closes. A copy
+# at another branch than the hold's pickup branch is 'InTransit' until the pickup branch
+# receives its CopyTransfer (migration 13).
+HOLD_PICKUP_DAYS = 7
+INSERT_HOLD = "INSERT INTO ItemHold (ItemID, BorrowerID, BranchID) VALUES (?, ?, ?)"
+ACTIVE_HOLD = """
+    SELECT HoldID FROM ItemHold WHERE BorrowerID=? AND ItemID=? AND Status IN ('Waiting', 'InTransit', 'Ready')
+"""
+HOLD_POSITION = "SELECT COUNT(*) FROM ItemHold WHERE ItemID=? AND Status='Waiting' AND HoldID <= ?"
+# (CopyID, the copy's BranchID, ItemID)
+ASSIGN_HOLD = f"""
+    UPDATE ItemHold
+    SET CopyID=?1,
+        Status = CASE BranchID WHEN ?2 THEN 'Ready' ELSE 'InTransit' END,
+        ReadyAt = CASE BranchID WHEN ?2 THEN datetime('now') END,
+        ExpiresAt = CASE BranchID WHEN ?2 THEN datetime('now', '+{HOLD_PICKUP_DAYS} days') END
+    WHERE HoldID = (SELECT HoldID FROM ItemHold WHERE ItemID=?3 AND Status='Waiting' ORDER BY HoldID LIMIT 1)
+    RETURNING HoldID, BorrowerID, Status, BranchID
+"""
+# (BorrowerID, ItemID, BranchID or NULL for any branch)
+COLLECT_HOLD = """
+    UPDATE ItemHold SET Status='Collected'
+    WHERE HoldID = (SELECT HoldID FROM ItemHold WHERE BorrowerID=? AND ItemID=? AND Status='Ready'
+                    AND BranchID = COALESCE(?, BranchID))
+    RETURNING CopyID
+"""
+CANCEL_HOLD = """
+    UPDATE ItemHold SET Status='Cancelled'
+    WHERE HoldID=? AND BorrowerID=? AND Status IN ('Waiting', 'InTransit', 'Ready')
+    RETURNING CopyID, ItemID
+"""
+HOLD_IN_TRANSIT = "UPDATE ItemHold SET Status='InTransit', CopyID=? WHERE HoldID=? AND Status='Waiting'"
+HOLD_ARRIVED = f"""
+    UPDATE ItemHold
+    SET Status='Ready', ReadyAt=datetime('now'), ExpiresAt=datetime('now', '+{HOLD_PICKUP_DAYS} days')
+    WHERE HoldID=? AND Status='InTransit'
+    RETURNING ItemID
+"""
+
+# Transfers between branches for holds (migration 13), listed per sending branch
+INSERT_TRANSFER = "INSERT INTO CopyTransfer (CopyID, HoldID, FromBranchID, ToBranchID) VALUES (?, ?, ?, ?)"
+RECEIVE_TRANSFER = """
+    UPDATE CopyTransfer SET Status='Received', ReceivedAt=datetime('now')
+    WHERE TransferID=? AND Status='Requested'
+    RETURNING CopyID, HoldID, ToBranchID
+"""
+CANCEL_TRANSFER = "UPDATE CopyTransfer SET Status='Cancelled' WHERE HoldID=? AND Status='Requested'"
+MOVE_COPY_BRANCH = "UPDATE LibraryCopy SET BranchID=? WHERE CopyID=?"
+OPEN_TRANSFERS = """
+    SELECT {keys}, t.TransferID, t.CopyID, li.Title, b.Name, t.RequestedAt
+    FROM CopyTransfer t
+    JOIN LibraryCopy lc ON lc.CopyID = t.CopyID
+    JOIN LibraryItem li ON li.ItemID = lc.ItemID
+    JOIN Branch b ON b.BranchID = t.ToBranchID
+    WHERE t.FromBranchID = ? AND t.Status = 'Requested' AND {after}
+"""
+TRANSFER_ORDER = ("t.TransferID",)
+EXPIRE_HOLDS = """
+    UPDATE ItemHold SET Status='Expired'
+    WHERE Status='Ready' AND ExpiresAt < datetime('now')
+    RETURNING CopyID, ItemID
+"""
+BORROWER_HOLDS = """
+    SELECT {keys}, h.HoldID, li.ItemID, li.Title, h.Status, h.PlacedAt, h.ExpiresAt,
+           CASE WHEN h.Status = 'Waiting' THEN
+               (SELECT COUNT(*) FROM ItemHold q WHERE q.ItemID = h.ItemID AND q.Status = 'Waiting' AND q.HoldID <= h.HoldID)
+           END,
+           b.Name
+    FROM ItemHold h
+    JOIN LibraryItem li ON h.ItemID = li.ItemID
+    LEFT JOIN Branch b ON b.BranchID = h.BranchID
+    WHERE h.BorrowerID = ? AND h.Status IN ('Waiting', 'InTransit', 'Ready') AND {after}
+"""
+HOLD_ORDER = ("h.HoldID",)
+
+# Full-text catalog search, best matches first. Title hits weigh most, then author, then type.
+SEARCH_ITEMS = f"""
+    SELECT {{keys}}, {ITEM_COLUMNS}
+    FROM LibraryItemSearch
+    JOIN LibraryItem li ON li.ItemID = LibraryItemSearch.rowid
+    WHERE LibraryItemSearch MATCH ? AND {{after}}
+"""
+SEARCH_ORDER = ("bm25(LibraryItemSearch, 10.0, 5.0, 1.0)", "li.ItemID")
+
+# Typo-tolerant search: the best full-text matches for the corrected words, reranked by similarity
+FUZZY_MATCHES = f"""
+    SELECT {ITEM_COLUMNS}
+    FROM LibraryItemSearch
+    JOIN LibraryItem li ON li.ItemID = LibraryItemSearch.rowid
+    WHERE LibraryItemSearch MATCH ?
+    ORDER BY bm25(LibraryItemSearch, 10.0, 5.0, 1.0)
+    LIMIT ?
+"""
+FUZZY_CANDIDATES = 500      # full-text matches reranked per fuzzy search
+CORRECTIONS_PER_WORD = 3    # catalog words tried in place of each word typed
+COMMON_WORD_SHARE = 0.02    # words in more of the catalog than this narrow a fuzzy search too little to query
+
+OPEN_LOANS = """
+    SELECT {keys}, bt.TransactionID, li.ItemID, li.Title, li.AuthorCreator, bt.BorrowDate, bt.DueDate
+    FROM BorrowingTransactions bt
+    JOIN LibraryCopy lc ON bt.CopyID = lc.CopyID
+    JOIN LibraryItem li ON lc.ItemID = li.ItemID
+    WHERE bt.BorrowerID = ? AND bt.ReturnDate IS NULL AND {after}
+"""
+
+BORROWED_BOOKS = f"""
+    SELECT {{keys}}, li.ItemID, li.Title, li.AuthorCreator, bt.BorrowDate, bt.DueDate, {FINE_AMOUNT}
+    FROM BorrowingTransactions bt
+    JOIN LibraryCopy lc ON bt.CopyID = lc.CopyID
+    JOIN LibraryItem li ON lc.ItemID = li.ItemID
+    WHERE bt.BorrowerID = ? AND bt.ReturnDate IS NULL AND {{after}}
+"""
+LOAN_ORDER = ("bt.DueDate", "bt.TransactionID")
+
+# Every loan a borrower ever had, from the hot table and the archive (migration 6)
+LOAN_HISTORY = """
+    SELECT {keys}, h.TransactionID, li.Title, li.AuthorCreator, h.BorrowDate, h.ReturnDate, h.FineAmount, h.PaidStatus
+    FROM LoanHistory h
+    JOIN LibraryCopy lc ON h.CopyID = lc.CopyID
+    JOIN LibraryItem li ON lc.ItemID = li.ItemID
+    WHERE h.BorrowerID = ? AND {after}
+"""
+HISTORY_ORDER = ("h.BorrowDate", "h.TransactionID")
+
+# Lists precomputed nightly by recommend.py (migration 10), each read by primary key
+ALSO_BORROWED = """
+    SELECT li.ItemID, li.Title, li.AuthorCreator, s.CoBorrowers
+    FROM ItemSimilarity s
+    JOIN LibraryItem li ON li.ItemID = s.SimilarItemID
+    WHERE s.ItemID = ?
+    ORDER BY s.Rank
+    LIMIT ?
+"""
+POPULAR_ITEMS = f"""
+    SELECT {{keys}}, {ITEM_COLUMNS}, t.RecentLoans
+    FROM TrendingItems t
+    JOIN LibraryItem li ON li.ItemID = t.ItemID
+    WHERE {{after}}
+"""
+POPULAR_ORDER = ("t.Rank",)
+REQUESTED_TITLES = "SELECT Title, ItemType, Requests FROM RequestedTitles ORDER BY Rank LIMIT ?"
+
+UNPAID_FINES = f"""
+    SELECT SUM({FINE_AMOUNT})
+    FROM BorrowingTransactions bt
+    WHERE bt.BorrowerID=? AND bt.PaidStatus='Unpaid'
+"""
+
+PAY_FINES = """
+    UPDATE BorrowingTransactions 
+    SET PaidStatus='Paid', FineAmount=0 
+    WHERE BorrowerID=? AND PaidStatus='Unpaid'
+"""
+
+# What a BorrowerSession loads at login: the open loans and the unpaid fines on returned ones
+SESSION_LOANS = """
+    SELECT bt.TransactionID, li.ItemID, li.Title, li.AuthorCreator, bt.BorrowDate, bt.DueDate,
+           bt.FineAmount, bt.PaidStatus = 'Paid'
+    FROM BorrowingTransactions bt
+    JOIN LibraryCopy lc ON bt.CopyID = lc.CopyID
+    JOIN LibraryItem li ON lc.ItemID = li.ItemID
+    WHERE bt.BorrowerID = ? AND bt.ReturnDate IS NULL
+"""
+SETTLED_FINES = """
+    SELECT SUM(FineAmount) FROM BorrowingTransactions
+    WHERE BorrowerID = ? AND PaidStatus = 'Unpaid' AND ReturnDate IS NOT NULL
+"""
+SESSION_TTL = 300  # seconds a BorrowerSession trusts what it loaded before reading it again
+
+ACCRUE_FINES = f"""
+    UPDATE BorrowingTransactions 
+    SET FineAmount = (JULIANDAY('now') - JULIANDAY(DueDate)) * {FINE_PER_DAY}
+    WHERE ReturnDate IS NULL 
+    AND DueDate < DATE('now')
+    AND PaidStatus = 'Unpaid'
+"""
+
+EVENT_LIST = """
+    SELECT {{keys}}, EventID, EventName, EventType, 
+           strftime('%Y-%m-%d %H:%M', DateTime) as FormattedDate,
+           Location, Capacity - RegisteredCount as RemainingSpots
+    FROM Events e
+    WHERE DateTime >= datetime('now') {condition} AND {{after}}
+"""
+UPCOMING_EVENTS = EVENT_LIST.format(condition="")
+EVENTS_BY_NAME = EVENT_LIST.format(condition="AND EventName LIKE ?")
+EVENTS_BY_TYPE = EVENT_LIST.format(condition="AND EventType = ?")
+EVENTS_AT_BRANCH = EVENT_LIST.format(condition="AND BranchID = ?")
+EVENT_ORDER = ("e.DateTime", "e.EventID")
+
+EVENT_TYPES = "SELECT DISTINCT EventType FROM Events WHERE EventType IS NOT NULL"
+
+EVENT_DETAILS = """
+    SELECT EventID, EventName, EventType, RecommendedAudience, DateTime, Location, Capacity,
+           strftime('%Y-%m-%d %H:%M', DateTime) as FormattedDate,
+           RegisteredCount, b.Name
+    FROM Events e
+    LEFT JOIN Branch b ON b.BranchID = e.BranchID
+    WHERE EventID = ?
+"""
+
+EVENT_CAPACITY = "SELECT Capacity, RegisteredCount FROM Events WHERE EventID = ?"
+EXISTING_REGISTRATION = "SELECT 1 FROM EventRegistration WHERE EventID = ? AND BorrowerID = ?"
+# Takes a seat only while the trigger-maintained count is under capacity. Run under the
+# write lock (BEGIN IMMEDIATE), no other session can take the last seat in between.
+REGISTER_IF_ROOM = """
+    INSERT INTO EventRegistration (EventID, BorrowerID, RegistrationDate)
+    SELECT EventID, ?, datetime('now') FROM Events WHERE EventID = ? AND RegisteredCount < Capacity
+"""
+CANCEL_REGISTRATION = "DELETE FROM EventRegistration WHERE EventID = ? AND BorrowerID = ?"
+
+# Waitlist (migration 9), first come first served
+INSERT_WAITLIST = "INSERT INTO EventWaitlist (EventID, BorrowerID) VALUES (?, ?)"
+WAITLIST_POSITION = "SELECT COUNT(*) FROM EventWaitlist WHERE EventID = ? AND WaitlistID <= ?"
+LEAVE_WAITLIST = "DELETE FROM EventWaitlist WHERE EventID = ? AND BorrowerID = ?"
+NEXT_ON_WAITLIST = """
+    DELETE FROM EventWaitlist
+    WHERE WaitlistID = (SELECT WaitlistID FROM EventWaitlist WHERE EventID = ? ORDER BY WaitlistID LIMIT 1)
+    RETURNING BorrowerID
+"""
+
+FIND_VOLUNTEER = "SELECT * FROM Personnel WHERE Name=? AND Email=? AND Role='Volunteer'"
+LIBRARIANS = "SELECT {keys}, * FROM Personnel WHERE Role LIKE '%Librarian%' AND {after}"
+LIBRARIAN_ORDER = ("StaffID",)
+
+# List queries above are keyset templates: {keys} opens the select list with the sort
+# columns and {after} is the last WHERE condition, filled in by keyset_query().
+
+def keyset_query(query, order, op=None, descending=False):
+    """Fills in a keyset template for one page: rows whose sort key compares op to the bound key"""
+    keys = ", ".join(order)
+    after = f"({keys}) {op} ({', '.join('?' * len(order))})" if op else "1"
+    direction = " DESC" if descending else ""
+    return (query.format(keys=keys, after=after)
+            + " ORDER BY " + ", ".join(f"{key}{direction}" for key in order)
+            + " LIMIT ? OFFSET ?")
+
+# Every statement the menus run, with sample parameters, for check_query_plans()
+QUERY_PLAN_CHECKS = [
+    ("borrower lookup", SELECT_BORROWER, (1,)),
+    ("list all items", keyset_query(ALL_ITEMS, ITEM_ORDER, ">"), (1, 5, 0)),
+    ("search catalog", keyset_query(SEARCH_ITEMS, SEARCH_ORDER, ">"), ('"a"*', -1.0, 1, 5, 0)),
+    ("fuzzy search", FUZZY_MATCHES, ('("history" OR "mystery") AND "garden"', FUZZY_CANDIDATES)),
+    ("find item for donation", FIND_ITEM, ("Title", "Author")),
+    ("available copies", AVAILABLE_COPIES, (1,)),
+    ("branches", BRANCHES, ()),
+    ("branch location", BRANCH_LOCATION, (1,)),
+    ("available at branch", BRANCH_AVAILABLE, (1, 1)),
+    ("availability by branch", BRANCH_AVAILABILITY, (1,)),
+    ("stocked branches", STOCKED_BRANCHES, (1,)),
+    ("copy branch", COPY_BRANCH, (1,)),
+    ("item details", ITEM_DETAILS, (1,)),
+    ("claim copy", CLAIM_COPY, (1,)),
+    ("claim copy at branch", CLAIM_BRANCH_COPY, ("Borrow", 1, 1)),
+    ("insert loan", INSERT_LOAN, (1, 1)),
+    ("close loan", CLOSE_LOAN, (1,)),
+    ("loan fine", LOAN_FINE, (1,)),
+    ("move copy", MOVE_COPY, ("onShelf", 1, "Borrow")),
+    ("active hold", ACTIVE_HOLD, (1, 1)),
+    ("hold position", HOLD_POSITION, (1, 1)),
+    ("assign hold", ASSIGN_HOLD, (1, 1, 1)),
+    ("collect hold", COLLECT_HOLD, (1, 1, None)),
+    ("cancel hold", CANCEL_HOLD, (1, 1)),
+    ("hold in transit", HOLD_IN_TRANSIT, (1, 1)),
+    ("hold arrived", HOLD_ARRIVED, (1,)),
+    ("receive transfer", RECEIVE_TRANSFER, (1,)),
+    ("cancel transfer", CANCEL_TRANSFER, (1,)),
+    ("move copy to branch", MOVE_COPY_BRANCH, (2, 1)),
+    ("open transfers", keyset_query(OPEN_TRANSFERS, TRANSFER_ORDER, ">"), (1, 1, 5, 0)),
+    ("expire holds", EXPIRE_HOLDS, ()),
+    ("borrower holds", keyset_query(BORROWER_HOLDS, HOLD_ORDER, ">"), (1, 1, 5, 0)),
+    ("open loans for return", keyset_query(OPEN_LOANS, LOAN_ORDER, ">"), (1, "2025-01-01", 1, 5, 0)),
+    ("borrowed books", keyset_query(BORROWED_BOOKS, LOAN_ORDER, ">"), (1, "2025-01-01", 1, 5, 0)),
+    ("borrowed books, previous page", keyset_query(BORROWED_BOOKS, LOAN_ORDER, "<", descending=True),
+     (1, "2025-01-01", 1, 5, 0)),
+    ("loan history", keyset_query(LOAN_HISTORY, HISTORY_ORDER, ">"), (1, "2025-01-01", 1, 5, 0)),
+    ("also borrowed", ALSO_BORROWED, (1, 5)),
+    ("popular now", keyset_query(POPULAR_ITEMS, POPULAR_ORDER, ">"), (1, 5, 0)),
+    ("requested titles", REQUESTED_TITLES, (10,)),
+    ("unpaid fines", UNPAID_FINES, (1,)),
+    ("session loans", SESSION_LOANS, (1,)),
+    ("settled fines", SETTLED_FINES, (1,)),
+    ("pay fines", PAY_FINES, (1,)),
+    ("accrue fines", ACCRUE_FINES, ()),
+    ("accrue fines for borrower", ACCRUE_FINES + "AND BorrowerID = ?", (1,)),
+    ("upcoming events", keyset_query(UPCOMING_EVENTS, EVENT_ORDER), (5, 0)),
+    ("upcoming events, next page", keyset_query(UPCOMING_EVENTS, EVENT_ORDER, ">"), ("2025-01-01", 1, 5, 0)),
+    ("events by name", keyset_query(EVENTS_BY_NAME, EVENT_ORDER, ">"), ("%a%", "2025-01-01", 1, 5, 0)),
+    ("events by type", keyset_query(EVENTS_BY_TYPE, EVENT_ORDER, ">"), ("Talk", "2025-01-01", 1, 5, 0)),
+    ("events at branch", keyset_query(EVENTS_AT_BRANCH, EVENT_ORDER, ">"), (1, "2025-01-01", 1, 5, 0)),
+    ("event types", EVENT_TYPES, ()),
+    ("event details", EVENT_DETAILS, (1,)),
+    ("event capacity", EVENT_CAPACITY, (1,)),
+    ("existing registration", EXISTING_REGISTRATION, (1, 1)),
+    ("register if room", REGISTER_IF_ROOM, (1, 1)),
+    ("cancel registration", CANCEL_REGISTRATION, (1, 1)),
+    ("waitlist position", WAITLIST_POSITION, (1, 1)),
+    ("leave waitlist", LEAVE_WAITLIST, (1, 1)),
+    ("next on waitlist", NEXT_ON_WAITLIST, (1,)),
+    ("find volunteer", FIND_VOLUNTEER, ("Name", "Email")),
+    ("librarians", keyset_query(LIBRARIANS, LIBRARIAN_ORDER, ">"), (1, 5, 0)),
+]
+
+# Statements that read a whole table by design
+FULL_SCAN_ALLOWED = {
+    "librarians",           # LIKE '%Librarian%' over the small staff table
+    "requested titles",     # RequestedTitles holds a few dozen rows, already in Rank order
+    "branches",             # one row per branch, a few dozen at most
+}
+# Statements that sort their rows in a temp B-tree by design
+TEMP_SORT_ALLOWED = {
+    "search catalog",           # by bm25 rank, which no index holds
+    "fuzzy search",             # the same, over at most FUZZY_CANDIDATES + 1 matches
+    "availability by branch",   # one row per branch stocking the item, by branch name
+    "borrower holds",           # a borrower's open holds, a handful at most
+}
+
+
+
+class KeysetPager:
+    """Holds one page of a keyset query and seeks to others by the sort keys on screen
+
+    Only the current page is kept in memory; its first and last sort keys bound the
+    queries for the neighbouring pages.
+    """
+
+    def __init__(self, query, order, params=(), page_size=ITEMS_PER_PAGE, tags=None):
+        self.query = query
+        self.order = order
+        self.params = tuple(params)
+        self.page_size = page_size
+        self.tags = tags
+        self.page = 0
+        self.rows = []
+        self.columns = []
+        self.has_next = False
+        self._keys = []
+        self._load(None, None)
+
+    def _fetch(self, key, op, limit, offset=0, descending=False):
+        """Returns (sort key, row) pairs from the rows on the op side of key, cached if the pager has tags"""
+        query = keyset_query(self.query, self.order, op if key else None, descending)
+        params = (*self.params, *(key or ()), limit, offset)
+
+        def load():
+            with unit_of_work() as cursor:
+                cursor.execute(query, params)
+                width = len(self.order)
+                columns = [desc[0] for desc in cursor.description][width:]
+                return columns, [(row[:width], row[width:]) for row in cursor.fetchall()]
+
+        if self.tags is None:
+            self.columns, fetched = load()
+        else:
+            self.columns, fetched = read_cache.get_or_load(("page", query, params), self.tags, load)
+        return fetched
+
+    def _load(self, key, op, page=0):
+        """Shows the page that starts at the row after (or at) key; False if it would be empty"""
+        fetched = self._fetch(key, op, self.page_size + 1)
+        if not fetched and key:
+            return False
+        self.page = page
+        self.has_next = len(fetched) > self.page_size
+        self._keys = [k for k, _ in fetched[:self.page_size]]
+        self.rows = [row for _, row in fetched[:self.page_size]]
+        return True
+
+    @property
+    def start(self):
+        """Position of the first row on this page within the whole result"""
+        return self.page * self.page_size
+
+    def next_page(self):
+        if not self.has_next:
+            return False
+        return self._load(self._keys[-1], ">", self.page + 1)
+
+    def previous_page(self):
+        if self.page == 0:
+            return False
+        return self.jump_to(self.page - 1)
+
+    def jump_to(self, page):
+        """Moves to page (counting from 0) by seeking from the nearest edge of the current one"""
+        if page < 0:
+            return False
+        if page == 0:
+            return self._load(None, None)
+        if page > self.page:
+            if not self._keys:
+                return False
+            skipped = (page - self.page - 1) * self.page_size
+            bound = self._keys[-1]
+            if skipped:
+                last_of_previous = self._fetch(bound, ">", 1, offset=skipped - 1)
+                if not last_of_previous:
+                    return False
+                bound = last_of_previous[0][0]
+            return self._load(bound, ">", page)
+        first_of_page = self._fetch(self._keys[0], "<", 1, offset=(self.page - page) * self.page_size - 1,
+                                    descending=True)
+        if not first_of_page:
+            return self._load(None, None)
+        return self._load(first_of_page[0][0], ">=", page)
+
+class _Rows(list):
+    """Rows already in memory, paged by SnapshotPager like the catalog snapshot"""
+
+    def page(self, number, size):
+        return self[number * size:(number + 1) * size]
+
+
+read_cache = ReadCache()
+catalog = CatalogSnapshot()
+terms = TermIndex()
+
+# Cache tags. Item and event tags are paired with an id, e.g. (ITEM, 42).
+ITEM = "item"
+EVENT = "event"
+CATALOG_LISTS = "catalog lists"
+EVENT_LISTS = "event lists"
+EVENT_TYPE_LIST = "event types"
+RECOMMENDATIONS = "recommendations"   # rewritten only by recommend.py, so entries just age out
+BRANCH_LIST = "branches"
+
+INSERT_BORROWER = "INSERT INTO Borrowers (Name, Email, PhoneNumber, Address) VALUES (?, ?, ?, ?)"
+INSERT_VOLUNTEER = "INSERT INTO Personnel (Name, Role, Email, PhoneNumber) VALUES (?, 'Volunteer', ?, ?)"
+
+
+class ServiceError(Exception):
+    """Base for failures a patron can act on; the message says what went wrong"""
+
+
+class NotFound(ServiceError):
+    """Raised when a borrower, item, loan or event does not exist"""
+
+
+class Unavailable(ServiceError):
+    """Raised when no copy is on the shelf or an event has no spots left"""
+
+
+class Conflict(ServiceError):
+    """Raised when the request was already carried out, e.g. a loan already returned"""
+
+
+class FinesOutstanding(ServiceError):
+    """Raised when a borrower with unpaid fines tries to borrow"""
+
+    def __init__(self, amount):
+        super().__init__(f"Cannot borrow items - you have ${amount:.2f} in unpaid fines.")
+        self.amount = amount
+
+
+@dataclass(frozen=True)
+class Borrower:
+    borrower_id: int
+    name: str
+    email: str
+    phone: Optional[str]
+    address: Optional[str]
+
+
+@dataclass(frozen=True)
+class Loan:
+    transaction_id: int
+    copy_id: int
+    borrower_id: int
+    item_id: int
+
+
+@dataclass(frozen=True)
+class OpenLoan:
+    transaction_id: int
+    item_id: int
+    title: str
+    author: Optional[str]
+    borrow_date: str
+    due_date: str
+    fine_amount: float
+    paid: bool
+
+    def fine(self, now: datetime) -> float:
+        """The loan's fine at now (UTC), as FINE_AMOUNT works it out"""
+        if not self.paid and self.due_date < now.date().isoformat():
+            due = datetime.fromisoformat(self.due_date).replace(tzinfo=timezone.utc)
+            return (now - due).total_seconds() / 86400 * FINE_PER_DAY
+        return self.fine_amount or 0
+
+
+@dataclass(frozen=True)
+class Item:
+    item_id: int
+    title: str
+    item_type: Optional[str]
+    author: Optional[str]
+    year: Optional[int]
+    available_copies: int
+
+
+@dataclass(frozen=True)
+class Donation:
+    item_id: int
+    new_item: bool
+
+
+@dataclass(frozen=True)
+class Hold:
+    hold_id: int
+    item_id: int
+    borrower_id: int
+    position: int                         # place in line; 0 once a copy is on its way
+    transfer_from: Optional[str] = None   # branch sending a copy to the pickup branch
+
+
+@dataclass(frozen=True)
+class Branch:
+    branch_id: int
+    name: str
+    latitude: float
+    longitude: float
+
+
+@dataclass(frozen=True)
+class Event:
+    event_id: int
+    name: str
+    event_type: Optional[str]
+    audience: Optional[str]
+    date_time: str
+    location: Optional[str]
+    capacity: int
+    formatted_date: str
+    registered: int
+    branch: Optional[str] = None
+
+    @property
+    def remaining(self) -> int:
+        return self.capacity - self.registered
+
+
+def _paged(query, order, params=(), page=0, tags=None) -> KeysetPager:
+    """Opens a pager on query and moves it to page, staying on the first page if that is past the end"""
+    pager = KeysetPager(query, order, params, tags=tags)
+    if page:
+        pager.jump_to(page)
+    return pager
+
+
+def _require_borrower(cursor, borrower_id) -> Borrower:
+    cursor.execute(SELECT_BORROWER, (borrower_id,))
+    row = cursor.fetchone()
+    if not row:
+        raise NotFound("Invalid Borrower ID.")
+    return Borrower(*row)
+
+
+def get_borrower(borrower_id: int) -> Borrower:
+    with unit_of_work() as cursor:
+        return _require_borrower(cursor, borrower_id)
+
+
+def list_items(page: int = 0) -> SnapshotPager:
+    """The whole catalog in ItemID order, paged from the in-memory snapshot"""
+    catalog.refresh()
+    return SnapshotPager(catalog, ITEMS_PER_PAGE, page)
+
+
+def search_query(text: str) -> str:
+    """Turns user input into an FTS5 query where every word must match as a prefix"""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search(text: str, page: int = 0) -> KeysetPager:
+    """Catalog items matching every word of text by title, author or type, best matches first"""
+    query = search_query(text)
+    if not query:
+        raise NotFound("No items found matching that title.")
+    return _paged(SEARCH_ITEMS, SEARCH_ORDER, (query,), page, tags=(CATALOG_LISTS,))
+
+
+def fuzzy_terms(text: str) -> List[Tuple[float, str]]:
+    """(share of the catalog using it, FTS5 query term) for each word of text, swapped for the closest catalog words
+
+    Numbers and words shorter than three letters are kept as typed; words with nothing close are left out.
+    """
+    found = []
+    for word in re.findall(r"\w+", text.lower()):
+        if word.isdigit():
+            found.append((0.0, f'"{word}"'))
+        elif indexable(word):
+            corrections = [term for term, _ in terms.similar(word, CORRECTIONS_PER_WORD)]
+            if corrections:
+                found.append((max(map(terms.share, corrections)),
+                               "(" + " OR ".join(f'"{term}"' for term in corrections) + ")"))
+        else:
+            found.append((1.0, f'"{word}"'))
+    return found
+
+
+def _similarity(text, grams):
+    """(share of grams found in text, Jaccard index of the two) for ranking fuzzy matches"""
+    found = trigrams(" ".join(re.findall(r"\w+", text.lower()))) if text else set()
+    shared = len(grams & found)
+    return shared / len(grams), shared / len(grams | found)
+
+
+def fuzzy_search(text: str, page: int = 0) -> SnapshotPager:
+    """Catalog items whose title or author is close to text despite typos, closest first"""
+    def load():
+        terms.refresh()
+        grams = trigrams(" ".join(re.findall(r"\w+", text.lower())))
+        found = fuzzy_terms(text)
+        telling = [term for share, term in found if share <= COMMON_WORD_SHARE]
+        every = [term for _, term in found]
+        with unit_of_work() as cursor:
+            def matches(query):
+                return cursor.execute(FUZZY_MATCHES, (query, FUZZY_CANDIDATES + 1)).fetchall() if query else []
+
+            # Uncommon words narrow the search cheaply; common ones join in only when those
+            # match too much, and when the words never all match together any one will do
+            rows = matches(" AND ".join(telling))
+            if (not telling or len(rows) > FUZZY_CANDIDATES) and every != telling:
+                rows = matches(" AND ".join(every)) or rows
+            if not rows:
+                rows = matches(" OR ".join(telling or every))
+        rows = rows[:FUZZY_CANDIDATES]
+        rows.sort(key=lambda row: max(_similarity(row[1], grams), _similarity(row[3], grams)), reverse=True)
+        return rows
+
+    if not re.search(r"\w", text):
+        raise NotFound("No items found matching that title.")
+    rows = read_cache.get_or_load(("fuzzy", text.lower()), (CATALOG_LISTS,), load)
+    return SnapshotPager(_Rows(rows), ITEMS_PER_PAGE, page)
+
+
+def _id(value):
+    """Ids typed at the menus arrive as strings; cache tags always carry the int"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _fetch_one(query, params, tags):
+    """First row of a cached single-row read; misses (None) are cached too"""
+    def load():
+        with unit_of_work() as cursor:
+            return cursor.execute(query, params).fetchone()
+
+    return read_cache.get_or_load((query, params), tags, load)
+
+
+def get_item(item_id: int) -> Item:
+    row = _fetch_one(ITEM_DETAILS, (item_id,), ((ITEM, _id(item_id)),))
+    if not row:
+        raise NotFound("No item found with that ID.")
+    return Item(*row)
+
+
+def also_borrowed(item_id: int, limit: int = 5) -> List[Tuple]:
+    """(ItemID, Title, AuthorCreator, CoBorrowers) of titles the item's borrowers also took out"""
+    def load():
+        with unit_of_work() as cursor:
+            return cursor.execute(ALSO_BORROWED, (item_id, limit)).fetchall()
+
+    return list(read_cache.get_or_load((ALSO_BORROWED, item_id, limit), (RECOMMENDATIONS,), load))
+
+
+def popular_items(page: int = 0) -> KeysetPager:
+    """Titles borrowed most in recent weeks, as ranked by the last recommend.py run"""
+    return _paged(POPULAR_ITEMS, POPULAR_ORDER, page=page, tags=(RECOMMENDATIONS, CATALOG_LISTS))
+
+
+def requested_titles(limit: int = 10) -> List[Tuple]:
+    """(Title, ItemType, Requests) of the titles patrons suggested most, for purchasing"""
+    def load():
+        with unit_of_work() as cursor:
+            return cursor.execute(REQUESTED_TITLES, (limit,)).fetchall()
+
+    return list(read_cache.get_or_load((REQUESTED_TITLES, limit), (RECOMMENDATIONS,), load))
+
+
+def available_copies(item_id: int, branch_id: Optional[int] = None) -> int:
+    """Copies of an item on the shelf, at every branch or at one"""
+    if branch_id is None:
+        row = _fetch_one(AVAILABLE_COPIES, (item_id,), ((ITEM, _id(item_id)),))
+    else:
+        row = _fetch_one(BRANCH_AVAILABLE, (branch_id, item_id), ((ITEM, _id(item_id)),))
+    if not row:
+        raise NotFound("No item found with that ID.")
+    return row[-1]
+
+
+def branch_availability(item_id: int) -> List[Tuple]:
+    """(BranchID, Name, copies on the shelf) for each branch with a copy of the item on its shelf"""
+    def load():
+        with unit_of_work() as cursor:
+            return cursor.execute(BRANCH_AVAILABILITY, (item_id,)).fetchall()
+
+    return list(read_cache.get_or_load((BRANCH_AVAILABILITY, item_id), ((ITEM, _id(item_id)),), load))
+
+
+def branches() -> List[Branch]:
+    def load():
+        with unit_of_work() as cursor:
+            return [Branch(*row) for row in cursor.execute(BRANCHES)]
+
+    return list(read_cache.get_or_load(BRANCHES, (BRANCH_LIST,), load))
+
+
+def add_branch(name: str, latitude: float, longitude: float) -> int:
+    """Opens a branch at the given coordinates and returns its Branch ID"""
+    def work(cursor):
+        cursor.execute(INSERT_BRANCH, (name, latitude, longitude))
+        return cursor.lastrowid
+
+    try:
+        branch_id = database.run_transaction(work)
+    except sql.IntegrityError as error:
+        raise Conflict("There is already a branch with that name.") from error
+    read_cache.invalidate(BRANCH_LIST)
+    return branch_id
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points, by the haversine formula"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+def nearest_stock(cursor, item_id, branch_id):
+    """Branches with a copy of the item on the shelf as (BranchID, Name), nearest to branch_id first"""
+    location = cursor.execute(BRANCH_LOCATION, (branch_id,)).fetchone()
+    if not location:
+        raise NotFound("No branch found with that ID.")
+    stocked = cursor.execute(STOCKED_BRANCHES, (item_id,)).fetchall()
+    stocked.sort(key=lambda row: (distance_km(*location, row[2], row[3]), row[0]))
+    return [(row[0], row[1]) for row in stocked]
+
+
+def fines_due(borrower_id: int) -> float:
+    with unit_of_work() as cursor:
+        _require_borrower(cursor, borrower_id)
+        return outstanding_fines(cursor, borrower_id)
+
+
+def borrow(borrower_id: int, item_id: int, branch_id: Optional[int] = None) -> Loan:
+    """Lends a copy of an item for 14 days, refused while the borrower owes fines
+
+    A copy held for the borrower is lent ahead of any copy on the shelf. Given a
+    branch, only copies at that branch are lent.
+    """
+    return _lend(borrower_id, item_id, check_borrower=True, branch_id=branch_id)
+
+
+def _lend(borrower_id, item_id, check_borrower, branch_id=None):
+    def work(cursor):
+        if check_borrower:
+            _require_borrower(cursor, borrower_id)
+        fines = outstanding_fines(cursor, borrower_id)
+        if fines > 0:
+            raise FinesOutstanding(fines)
+        return checkout_item(cursor, borrower_id, item_id, branch_id)
+
+    loan = database.run_transaction(work)
+    if not loan:
+        raise Unavailable("No available copies.")
+    read_cache.invalidate((ITEM, _id(item_id)))
+    transaction_id, copy_id = loan
+    return Loan(transaction_id, copy_id, borrower_id, item_id)
+
+
+def return_loan(transaction_id: int) -> None:
+    _close_loan(transaction_id)
+
+
+def _close_loan(transaction_id):
+    """Returns a loan; gives back its (FineAmount, PaidStatus) as stored once the return is recorded"""
+    def work(cursor):
+        item_id = checkin_loan(cursor, transaction_id)
+        return item_id and (item_id, cursor.execute(LOAN_FINE, (transaction_id,)).fetchone())
+
+    closed = database.run_transaction(work)
+    if not closed:
+        raise Conflict("This item has already been returned.")
+    item_id, fine = closed
+    read_cache.invalidate((ITEM, item_id))
+    return fine
+
+
+def place_hold(borrower_id: int, item_id: int, branch_id: Optional[int] = None) -> Hold:
+    """Holds an item with no copy on the shelf at the pickup branch (MAIN_BRANCH unless given)
+
+    A copy on the shelf at another branch is set aside at once, taken from the nearest
+    such branch, and a transfer to the pickup branch requested. With none anywhere the
+    borrower queues for the next copy returned.
+    """
+    pickup = MAIN_BRANCH if branch_id is None else branch_id
+
+    def work(cursor):
+        _require_borrower(cursor, borrower_id)
+        item = cursor.execute(BRANCH_AVAILABLE, (pickup, item_id)).fetchone()
+        if not item:
+            raise NotFound("No item found with that ID.")
+        if item[1]:
+            raise Conflict("A copy is on the shelf now; borrow it instead.")
+        if cursor.execute(ACTIVE_HOLD, (borrower_id, item_id)).fetchone():
+            raise Conflict("You already have a hold on this item.")
+        sources = nearest_stock(cursor, item_id, pickup) if item[0] else []
+        cursor.execute(INSERT_HOLD, (item_id, borrower_id, pickup))
+        hold_id = cursor.lastrowid
+        for source, name in sources:
+            set_aside = cursor.execute(CLAIM_BRANCH_COPY, ("onHold", item_id, source)).fetchall()
+            if set_aside:
+                copy_id = set_aside[0][0]
+                cursor.execute(HOLD_IN_TRANSIT, (copy_id, hold_id))
+                cursor.execute(INSERT_TRANSFER, (copy_id, hold_id, source, pickup))
+                return Hold(hold_id, _id(item_id), _id(borrower_id), 0, name)
+        return Hold(hold_id, _id(item_id), _id(borrower_id),
+                    cursor.execute(HOLD_POSITION, (item_id, hold_id)).fetchone()[0])
+
+    hold = database.run_transaction(work)
+    if hold.transfer_from:
+        read_cache.invalidate((ITEM, _id(item_id)))
+    return hold
+
+
+def holds(borrower_id: int, page: int = 0) -> KeysetPager:
+    """Open holds as (HoldID, ItemID, Title, Status, PlacedAt, ExpiresAt, place in queue, pickup branch)"""
+    get_borrower(borrower_id)
+    return _paged(BORROWER_HOLDS, HOLD_ORDER, (borrower_id,), page)
+
+
+def cancel_hold(borrower_id: int, hold_id: int) -> None:
+    """Withdraws a hold, passing any copy set aside for it to the next in line"""
+    def work(cursor):
+        cancelled = cursor.execute(CANCEL_HOLD, (hold_id, borrower_id)).fetchall()
+        if not cancelled:
+            raise NotFound("No open hold with that ID.")
+        copy_id, item_id = cancelled[0]
+        if copy_id is not None:
+            # A copy still on its way stays at the branch that sent it out
+            cursor.execute(CANCEL_TRANSFER, (hold_id,))
+            pass_on_copy(cursor, copy_id, item_id)
+        return item_id
+
+    item_id = database.run_transaction(work)
+    read_cache.invalidate((ITEM, item_id))
+
+
+def receive_transfer(transfer_id: int) -> int:
+    """Books a transferred copy in at its pickup branch and opens the hold's pickup window; returns the HoldID"""
+    def work(cursor):
+        received = cursor.execute(RECEIVE_TRANSFER, (transfer_id,)).fetchall()
+        if not received:
+            raise NotFound("No transfer on its way with that ID.")
+        copy_id, hold_id, branch_id = received[0]
+        cursor.execute(MOVE_COPY_BRANCH, (branch_id, copy_id))
+        if not cursor.execute(HOLD_ARRIVED, (hold_id,)).fetchall():
+            raise Conflict("The hold this copy was sent for is no longer open.")
+        return hold_id
+
+    return database.run_transaction(work)
+
+
+def transfers(branch_id: int, page: int = 0) -> KeysetPager:
+    """Copies a branch has to send out, as (TransferID, CopyID, Title, destination branch, RequestedAt)"""
+    return _paged(OPEN_TRANSFERS, TRANSFER_ORDER, (branch_id,), page)
+
+
+def expire_holds() -> int:
+    """Closes ready holds past their pickup window and passes their copies on; returns how many"""
+    def work(cursor):
+        expired = cursor.execute(EXPIRE_HOLDS).fetchall()
+        for copy_id, item_id in expired:
+            pass_on_copy(cursor, copy_id, item_id)
+        return expired
+
+    expired = database.run_transaction(work)
+    read_cache.invalidate(*{(ITEM, item_id) for _, item_id in expired})
+    return len(expired)
+
+
+def open_loans(borrower_id: int, page: int = 0) -> KeysetPager:
+    """Unreturned loans as (TransactionID, ItemID, Title, AuthorCreator, BorrowDate, DueDate)"""
+    get_borrower(borrower_id)
+    return _paged(OPEN_LOANS, LOAN_ORDER, (borrower_id,), page)
+
+
+def borrowed_books(borrower_id: int, page: int = 0) -> KeysetPager:
+    """Unreturned loans as (ItemID, Title, AuthorCreator, BorrowDate, DueDate, fine so far)"""
+    get_borrower(borrower_id)
+    return _paged(BORROWED_BOOKS, LOAN_ORDER, (borrower_id,), page)
+
+
+def loan_history(borrower_id: int, page: int = 0) -> KeysetPager:
+    """All loans, archived or not, oldest first, as (TransactionID, Title, AuthorCreator,
+    BorrowDate, ReturnDate, FineAmount, PaidStatus)"""
+    get_borrower(borrower_id)
+    return _paged(LOAN_HISTORY, HISTORY_ORDER, (borrower_id,), page)
+
+
+def pay_fines(borrower_id: int) -> float:
+    """Marks all of a borrower's fines paid and returns the amount cleared"""
+    return _settle(borrower_id, check_borrower=True)
+
+
+def _settle(borrower_id, check_borrower):
+    def work(cursor):
+        if check_borrower:
+            _require_borrower(cursor, borrower_id)
+        amount = outstanding_fines(cursor, borrower_id)
+        cursor.execute(PAY_FINES, (borrower_id,))
+        return amount
+
+    return database.run_transaction(work)
+
+
+class BorrowerSession:
+    """A borrower logged in at the desk, with their open loans and fines read once at login
+
+    The session's own borrows, returns and payments update what it holds, so the menus
+    can list loans and show fines without going back to the database. Changes made
+    elsewhere (another desk, the HTTP front end) are picked up by reload(), which also
+    runs once the session is SESSION_TTL seconds old and whenever a write finds the
+    database disagreeing with it. Borrowing still checks fines inside its transaction.
+    """
+
+    def __init__(self, borrower_id):
+        self.borrower = None
+        self._load(borrower_id)
+
+    @property
+    def borrower_id(self) -> int:
+        return self.borrower.borrower_id
+
+    def _load(self, borrower_id):
+        with unit_of_work() as cursor:
+            self.borrower = _require_borrower(cursor, borrower_id)
+            cursor.execute(SESSION_LOANS, (borrower_id,))
+            self.loans = {row[0]: OpenLoan(*row) for row in cursor.fetchall()}
+            self.settled_fines = cursor.execute(SETTLED_FINES, (borrower_id,)).fetchone()[0] or 0
+        self.loaded_at = time.monotonic()
+
+    def reload(self):
+        self._load(self.borrower_id)
+
+    def _current(self):
+        if time.monotonic() - self.loaded_at > SESSION_TTL:
+            self.reload()
+
+    def fines_due(self) -> float:
+        self._current()
+        now = datetime.now(timezone.utc)
+        return self.settled_fines + sum(loan.fine(now) for loan in self.loans.values() if not loan.paid)
+
+    def due_soon(self, days: int = REMINDER_DAYS) -> Tuple[List[OpenLoan], List[OpenLoan]]:
+        """(loans due within days, overdue loans), each soonest due first"""
+        today = datetime.now(timezone.utc).date()
+        horizon = (today + timedelta(days=days)).isoformat()
+        loans = self._sorted_loans()
+        return ([loan for loan in loans if today.isoformat() <= loan.due_date <= horizon],
+                [loan for loan in loans if loan.due_date < today.isoformat()])
+
+    def _sorted_loans(self):
+        self._current()
+        return sorted(self.loans.values(), key=lambda loan: (loan.due_date, loan.transaction_id))
+
+    def open_loans(self, page: int = 0) -> SnapshotPager:
+        """Unreturned loans as (TransactionID, ItemID, Title, AuthorCreator, BorrowDate, DueDate)"""
+        rows = _Rows((loan.transaction_id, loan.item_id, loan.title, loan.author, loan.borrow_date, loan.due_date)
+                     for loan in self._sorted_loans())
+        return SnapshotPager(rows, ITEMS_PER_PAGE, page)
+
+    def borrowed_books(self, page: int = 0) -> SnapshotPager:
+        """Unreturned loans as (ItemID, Title, AuthorCreator, BorrowDate, DueDate, fine so far)"""
+        now = datetime.now(timezone.utc)
+        rows = _Rows((loan.item_id, loan.title, loan.author, loan.borrow_date, loan.due_date, loan.fine(now))
+                     for loan in self._sorted_loans())
+        return SnapshotPager(rows, ITEMS_PER_PAGE, page)
+
+    def borrow(self, item_id: int, branch_id: Optional[int] = None) -> Loan:
+        fines = self.fines_due()
+        if fines > 0:
+            raise FinesOutstanding(fines)
+        try:
+            loan = _lend(self.borrower_id, item_id, check_borrower=False, branch_id=branch_id)
+        except FinesOutstanding:
+            self.reload()
+            raise
+        item = catalog.get(_id(loan.item_id))
+        if item is None:   # catalogued since the snapshot last refreshed
+            catalog.refresh()
+            item = catalog.get(_id(loan.item_id))
+        today = datetime.now(timezone.utc).date()
+        self.loans[loan.transaction_id] = OpenLoan(
+            loan.transaction_id, item.item_id, item.title, item.author, today.isoformat(),
+            (today + timedelta(days=LOAN_DAYS)).isoformat(), 0, False)
+        return loan
+
+    def return_loan(self, transaction_id: int) -> None:
+        loan = self.loans.get(_id(transaction_id))
+        if loan is None:
+            raise NotFound("That is not one of your loans.")
+        try:
+            fine_amount, paid_status = _close_loan(loan.transaction_id)
+        except Conflict:
+            self.reload()
+            raise
+        # Returned, the loan keeps its stored FineAmount as FINE_AMOUNT does, which
+        # for a late return is the fine the ApplyFineIfLate trigger just wrote
+        del self.loans[loan.transaction_id]
+        if paid_status == "Unpaid":
+            self.settled_fines += fine_amount or 0
+
+    def pay_fines(self) -> float:
+        amount = _settle(self.borrower_id, check_borrower=False)
+        self.settled_fines = 0
+        self.loans = {transaction_id: replace(loan, fine_amount=0, paid=True)
+                      for transaction_id, loan in self.loans.items()}
+        return amount
+
+
+def login(borrower_id: int) -> BorrowerSession:
+    """Starts a BorrowerSession, raising NotFound for an unknown Borrower ID"""
+    return BorrowerSession(borrower_id)
+
+
+def donate(title: str, item_type: str, author: str, year: str, branch_id: int = MAIN_BRANCH) -> Donation:
+    """Adds a copy to a branch's shelf, cataloguing the item first if (title, author) is new"""
+    def work(cursor):
+        item = cursor.execute(FIND_ITEM, (title, author)).fetchone()
+        if item:
+            item_id = item[0]
+        else:
+            cursor.execute(INSERT_ITEM, (title, item_type, author, year))
+            item_id = cursor.lastrowid
+        cursor.execute(INSERT_COPY, (item_id, branch_id))
+        copy_id = cursor.lastrowid
+        if item and assign_hold(cursor, copy_id, item_id):
+            cursor.execute(MOVE_COPY, ("onHold", copy_id, "onShelf"))
+        return Donation(item_id, new_item=not item)
+
+    donation = database.run_transaction(work)
+    # A new item can appear on any list or search page; a new copy only changes its own counts
+    read_cache.invalidate((ITEM, donation.item_id), *((CATALOG_LISTS,) if donation.new_item else ()))
+    return donation
+
+
+def register_borrower(name: str, email: str, phone: str = "", address: str = "") -> int:
+    """Opens a borrower account and returns its Borrower ID"""
+    def work(cursor):
+        cursor.execute(INSERT_BORROWER, (name, email, phone, address))
+        return cursor.lastrowid
+
+    try:
+        return database.run_transaction(work)
+    except sql.Error as error:
+        raise ServiceError(f"Error registering account: {error}") from error
+
+
+def upcoming_events(name: Optional[str] = None, event_type: Optional[str] = None, page: int = 0,
+                    branch_id: Optional[int] = None) -> KeysetPager:
+    """Events from now on, optionally narrowed to a name fragment, one type or one branch"""
+    if branch_id is not None:
+        return _paged(EVENTS_AT_BRANCH, EVENT_ORDER, (branch_id,), page, tags=(EVENT_LISTS,))
+    if name:
+        return _paged(EVENTS_BY_NAME, EVENT_ORDER, (f"%{name}%",), page, tags=(EVENT_LISTS,))
+    if event_type:
+        return _paged(EVENTS_BY_TYPE, EVENT_ORDER, (event_type,), page, tags=(EVENT_LISTS,))
+    return _paged(UPCOMING_EVENTS, EVENT_ORDER, page=page, tags=(EVENT_LISTS,))
+
+
+def event_types() -> List[str]:
+    def load():
+        with unit_of_work() as cursor:
+            return [row[0] for row in cursor.execute(EVENT_TYPES)]
+
+    return list(read_cache.get_or_load(EVENT_TYPES, (EVENT_TYPE_LIST,), load))
+
+
+def get_event(event_id: int) -> Event:
+    row = _fetch_one(EVENT_DETAILS, (event_id,), ((EVENT, _id(event_id)),))
+    if not row:
+        raise NotFound("No event found with that ID.")
+    return Event(*row)
+
+
+def register_for_event(event_id: int, borrower_id: int) -> int:
+    """Signs a borrower up for an event and returns the spots left after them"""
+    def work(cursor):
+        _require_borrower(cursor, borrower_id)
+        if not take_seat(cursor, event_id, borrower_id):
+            if not cursor.execute(EVENT_CAPACITY, (event_id,)).fetchone():
+                raise NotFound("No event found with that ID.")
+            if cursor.execute(EXISTING_REGISTRATION, (event_id, borrower_id)).fetchone():
+                raise Conflict("You are already registered for this event.")
+            raise Unavailable("This event is already at full capacity.")
+        # A seat that opened up without a promotion (say, capacity was raised) ends their wait
+        cursor.execute(LEAVE_WAITLIST, (event_id, borrower_id))
+        capacity, registered = cursor.execute(EVENT_CAPACITY, (event_id,)).fetchone()
+        return capacity - registered
+
+    try:
+        remaining = database.run_transaction(work)
+    except sql.Error as error:
+        raise ServiceError(f"Error registering for event: {error}") from error
+    # Spots left shows on the event and on every list it appears in
+    read_cache.invalidate((EVENT, _id(event_id)), EVENT_LISTS)
+    return remaining
+
+
+def join_waitlist(event_id: int, borrower_id: int) -> int:
+    """Queues a borrower for a seat at a full event and returns their place in line"""
+    def work(cursor):
+        _require_borrower(cursor, borrower_id)
+        event = cursor.execute(EVENT_CAPACITY, (event_id,)).fetchone()
+        if not event:
+            raise NotFound("No event found with that ID.")
+        if cursor.execute(EXISTING_REGISTRATION, (event_id, borrower_id)).fetchone():
+            raise Conflict("You are already registered for this event.")
+        capacity, registered = event
+        if registered < capacity:
+            raise Conflict("This event still has spots; register instead.")
+        try:
+            cursor.execute(INSERT_WAITLIST, (event_id, borrower_id))
+        except sql.IntegrityError:
+            raise Conflict("You are already on the waitlist for this event.") from None
+        return cursor.execute(WAITLIST_POSITION, (event_id, cursor.lastrowid)).fetchone()[0]
+
+    return database.run_transaction(work)
+
+
+def cancel_registration(event_id: int, borrower_id: int) -> None:
+    """Takes a borrower off an event or its waitlist; a freed seat goes to the waitlist in order"""
+    def work(cursor):
+        if cursor.execute(CANCEL_REGISTRATION, (event_id, borrower_id)).rowcount:
+            promote_waitlist(cursor, event_id)
+        elif not cursor.execute(LEAVE_WAITLIST, (event_id, borrower_id)).rowcount:
+            raise NotFound("You are not registered or waitlisted for this event.")
+
+    database.run_transaction(work)
+    read_cache.invalidate((EVENT, _id(event_id)), EVENT_LISTS)
+
+
+def volunteer(name: str, email: str, phone: str) -> int:
+    """Signs someone up as a volunteer and returns their Volunteer ID"""
+    def work(cursor):
+        if cursor.execute(FIND_VOLUNTEER, (name, email)).fetchone():
+            raise Conflict("You are already a registered volunteer.")
+        cursor.execute(INSERT_VOLUNTEER, (name, email, phone))
+        return cursor.lastrowid
+
+    try:
+        return database.run_transaction(work)
+    except sql.IntegrityError as error:
+        raise Conflict("Error registering as a volunteer (duplicate or constraint issue).") from error
+
+
+def librarians(page: int = 0) -> KeysetPager:
+    """Staff rows (StaffID, Name, Role, Email, PhoneNumber) whose role is a librarian one"""
+    return _paged(LIBRARIANS, LIBRARIAN_ORDER, page=page)
+
+
+def outstanding_fines(cursor, borrower_id):
+    """Returns a borrower's unpaid fines, accruing open overdue loans at read time"""
+    cursor.execute(UNPAID_FINES, (borrower_id,))
+    return cursor.fetchone()[0] or 0
+
+
+def checkout_item(cursor, borrower_id, item_id, branch_id=None):
+    """Claims the copy held for the borrower, or else an on-shelf copy, and records a 14-day loan of it
+
+    Given a branch, only a hold ready there or a copy on its shelf will do. Returns
+    (transaction ID, copy ID), or None when no copy is on the shelf. Run it in a write
+    transaction (database.run_transaction) so the claim and the loan land together.
+    """
+    held = cursor.execute(COLLECT_HOLD, (borrower_id, item_id, branch_id)).fetchall()
+    if held:
+        copy_id = held[0][0]
+        cursor.execute(MOVE_COPY, ("Borrow", copy_id, "onHold"))
+    else:
+        if branch_id is None:
+            cursor.execute(CLAIM_COPY, (item_id,))
+        else:
+            cursor.execute(CLAIM_BRANCH_COPY, ("Borrow", item_id, branch_id))
+        claimed = cursor.fetchall()
+        if not claimed:
+            return None
+        copy_id = claimed[0][0]
+    cursor.execute(INSERT_LOAN, (borrower_id, copy_id))
+    return cursor.lastrowid, copy_id
+
+
+def checkin_loan(cursor, transaction_id):
+    """Closes an open loan as returned today, and holds its copy for the next in line or shelves it
+
+    Returns the ItemID of the returned copy, or None if the loan was already closed.
+    """
+    cursor.execute(CLOSE_LOAN, (transaction_id,))
+    closed = cursor.fetchall()
+    if not closed:
+        return None
+    copy_id, item_id = closed[0]
+    status = "onHold" if assign_hold(cursor, copy_id, item_id) else "onShelf"
+    cursor.execute(MOVE_COPY, (status, copy_id, "Borrow"))
+    return item_id
+
+
+def assign_hold(cursor, copy_id, item_id):
+    """Sets a copy aside for the oldest waiting hold on its item; returns (HoldID, BorrowerID, Status) or None
+
+    A hold picked up at another branch than the copy's is left 'InTransit' with a
+    transfer requested to its pickup branch.
+    """
+    branch_id = cursor.execute(COPY_BRANCH, (copy_id,)).fetchone()[0]
+    assigned = cursor.execute(ASSIGN_HOLD, (copy_id, branch_id, item_id)).fetchall()
+    if not assigned:
+        return None
+    hold_id, borrower_id, status, pickup = assigned[0]
+    if status == "InTransit":
+        cursor.execute(INSERT_TRANSFER, (copy_id, hold_id, branch_id, pickup))
+    return hold_id, borrower_id, status
+
+
+def pass_on_copy(cursor, copy_id, item_id):
+    """Gives a held copy whose hold has ended to the next hold in line, or back to the shelf"""
+    if not assign_hold(cursor, copy_id, item_id):
+        cursor.execute(MOVE_COPY, ("onShelf", copy_id, "onHold"))
+
+
+def take_seat(cursor, event_id, borrower_id):
+    """Registers a borrower if the event has a free seat; returns whether they got one
+
+    Raises Conflict if they already hold a seat. Run it in a write transaction.
+    """
+    try:
+        return cursor.execute(REGISTER_IF_ROOM, (borrower_id, event_id)).rowcount == 1
+    except sql.IntegrityError:
+        raise Conflict("You are already registered for this event.") from None
+
+
+def promote_waitlist(cursor, event_id):
+    """Fills free seats at an event from the front of its waitlist; returns the promoted BorrowerIDs"""
+    promoted = []
+    capacity, registered = cursor.execute(EVENT_CAPACITY, (event_id,)).fetchone()
+    for _ in range(capacity - registered):
+        row = cursor.execute(NEXT_ON_WAITLIST, (event_id,)).fetchone()
+        if not row or not take_seat(cursor, event_id, row[0]):
+            break
+        promoted.append(row[0])
+    return promoted
+
+
+def calculate_fines(borrower_id=None):
+    """Writes accrued fines into FineAmount for one borrower, or every open loan if none is given"""
+    with unit_of_work() as cursor:
+        if borrower_id is None:
+            cursor.execute(ACCRUE_FINES)
+        else:
+            cursor.execute(ACCRUE_FINES + "AND BorrowerID = ?", (borrower_id,))
+
+
+# Each pair finds rows whose stored counter differs from a fresh count, then repairs them
+COUNTER_CHECKS = [
+    ("LibraryItem.AvailableCopies", """
+        SELECT COUNT(*) FROM LibraryItem li
+        WHERE AvailableCopies != (SELECT COUNT(*) FROM LibraryCopy lc WHERE lc.ItemID = li.ItemID AND lc.Status = 'onShelf')
+    """, """
+        UPDATE LibraryItem SET AvailableCopies =
+            (SELECT COUNT(*) FROM LibraryCopy lc WHERE lc.ItemID = LibraryItem.ItemID AND lc.Status = 'onShelf')
+    """),
+    ("Events.RegisteredCount", """
+        SELECT COUNT(*) FROM Events e
+        WHERE RegisteredCount != (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = e.EventID)
+    """, """
+        UPDATE Events SET RegisteredCount =
+            (SELECT COUNT(*) FROM EventRegistration er WHERE er.EventID = Events.EventID)
+    """),
+    ("BranchStock.AvailableCopies", """
+        SELECT COUNT(*)
+        FROM (SELECT ItemID, BranchID FROM BranchStock
+              UNION SELECT ItemID, BranchID FROM LibraryCopy WHERE Status = 'onShelf') k
+        WHERE COALESCE((SELECT AvailableCopies FROM BranchStock s WHERE s.ItemID = k.ItemID AND s.BranchID = k.BranchID), 0)
+              != (SELECT COUNT(*) FROM LibraryCopy lc
+                  WHERE lc.ItemID = k.ItemID AND lc.BranchID = k.BranchID AND lc.Status = 'onShelf')
+    """, """
+        INSERT INTO BranchStock (ItemID, BranchID, AvailableCopies)
+            SELECT k.ItemID, k.BranchID,
+                   (SELECT COUNT(*) FROM LibraryCopy lc
+                    WHERE lc.ItemID = k.ItemID AND lc.BranchID = k.BranchID AND lc.Status = 'onShelf')
+            FROM (SELECT ItemID, BranchID FROM BranchStock
+                  UNION SELECT ItemID, BranchID FROM LibraryCopy WHERE Status = 'onShelf') k
+            WHERE true
+        ON CONFLICT (ItemID, BranchID) DO UPDATE SET AvailableCopies = excluded.AvailableCopies
+    """),
+]
+
+
+def counter_drift(repair: bool = False) -> Dict[str, int]:
+    """Counts rows whose trigger-maintained counter differs from a fresh count, rebuilding them if asked"""
+    drifted = {}
+    for name, find_drift, rebuild in COUNTER_CHECKS:
+        with unit_of_work(immediate=repair) as cursor:
+            drifted[name] = cursor.execute(find_drift).fetchone()[0]
+            if drifted[name] and repair:
+                cursor.execute(rebuild)
+    return drifted
+
+
+def query_plans(checks=QUERY_PLAN_CHECKS) -> List[Tuple[str, List[str]]]:
+    """EXPLAIN QUERY PLAN steps for each (name, statement, sample parameters) in checks"""
+    plans = []
+    for name, query, params in checks:
+        with unit_of_work() as cursor:
+            plans.append((name, [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)]))
+    return plans